@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Import time benchmark for a headless worker
+
+Measures the cold start time of importing the simulation modules in fresh
+interpreters, and reports which heavy optional dependencies were loaded.
+
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+MODULES = (
+    'farms_mujoco.simulation.simulation',
+    'farms_mujoco.simulation.task',
+    'farms_mujoco.simulation.mjcf',
+    'farms_mujoco.sensors.camera',
+)
+HEAVY = (
+    'trimesh', 'pywavefront', 'imageio', 'scipy', 'matplotlib', 'glfw',
+    'dm_control.viewer',
+)
+WORKER = '''
+import sys, json, time
+tic = time.perf_counter()
+import {module}
+toc = time.perf_counter()
+print(json.dumps({{
+    'time': toc - tic,
+    'heavy': [name for name in {heavy!r} if name in sys.modules],
+}}))
+'''
+
+
+def parse_args():
+    """Parse arguments"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--modules', nargs='+', default=MODULES,
+        help='Modules to import',
+    )
+    parser.add_argument(
+        '--repeats', type=int, default=5,
+        help='Number of fresh interpreters per module',
+    )
+    parser.add_argument(
+        '--importtime', action='store_true',
+        help='Show the slowest imports from python -X importtime',
+    )
+    return parser.parse_args()
+
+
+def cold_import(module: str) -> dict:
+    """Import module in fresh headless interpreter"""
+    env = dict(os.environ, MUJOCO_GL=os.environ.get('MUJOCO_GL', 'egl'))
+    result = subprocess.run(
+        [sys.executable, '-c', WORKER.format(module=module, heavy=HEAVY)],
+        env=env, check=True, capture_output=True, text=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(module: str, number: int = 15) -> list:
+    """Slowest cumulative imports reported by python -X importtime"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        check=True, capture_output=True, text=True,
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        entries.append((int(cumulative), name.strip()))
+    return sorted(entries, reverse=True)[:number]
+
+
+def main():
+    """Main"""
+    args = parse_args()
+    for module in args.modules:
+        results = [cold_import(module) for _ in range(args.repeats)]
+        times = [result['time'] for result in results]
+        print(
+            f'{module}: {1e3*statistics.median(times):.1f} ms'
+            f' (min {1e3*min(times):.1f} ms, {args.repeats} runs)'
+            f', heavy modules loaded: {results[0]["heavy"] or "none"}'
+        )
+        if args.importtime:
+            for cumulative, name in slowest_imports(module):
+                print(f'    {cumulative/1e3:>8.1f} ms  {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Log storage benchmark
+
+Measures the write throughput and the file size of the streaming logger
+datasets for each storage dtype and compression, on synthetic arrays
+shaped like the animat data: smooth signals for the links and joints,
+and mostly zero signals for the contacts.
+
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from farms_mujoco.simulation.writer import COMPRESSIONS, HDF5Appender
+
+
+DTYPES = ('float64', 'float32', 'float16')
+
+
+def parse_args():
+    """Parse arguments"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--iterations', type=int, default=20000,
+        help='Number of iterations',
+    )
+    parser.add_argument(
+        '--links', type=int, default=20,
+        help='Number of links',
+    )
+    parser.add_argument(
+        '--joints', type=int, default=19,
+        help='Number of joints',
+    )
+    parser.add_argument(
+        '--contacts', type=int, default=4,
+        help='Number of contacts',
+    )
+    parser.add_argument(
+        '--chunk', type=int, default=1000,
+        help='Rows per chunk',
+    )
+    parser.add_argument(
+        '--dtypes', nargs='+', default=DTYPES,
+        help='Storage dtypes',
+    )
+    parser.add_argument(
+        '--compressions', nargs='+', default=('none',) + COMPRESSIONS,
+        help='Compressions',
+    )
+    parser.add_argument(
+        '--level', type=int, default=None,
+        help='Compression level (gzip and zstd)',
+    )
+    return parser.parse_args()
+
+
+def synthetic_data(args) -> dict:
+    """Synthetic sensors arrays"""
+    rng = np.random.default_rng(0)
+    n_iterations = args.iterations
+
+    def smooth(*shape):
+        """Random walk signals"""
+        return np.cumsum(rng.normal(0, 1e-3, (n_iterations,)+shape), axis=0)
+
+    contacts = np.zeros((n_iterations, args.contacts, 12))
+    stance = rng.random((n_iterations, args.contacts)) > 0.5
+    contacts[stance] = rng.normal(0, 1, (np.count_nonzero(stance), 12))
+    return {
+        'links': smooth(args.links, 20),
+        'joints': smooth(args.joints, 16),
+        'contacts': contacts,
+        'xfrc': np.zeros((n_iterations, args.links, 6)),
+    }
+
+
+def benchmark(path: str, data: dict, args, dtype, compression) -> dict:
+    """Write data by chunks, returns time and file size"""
+    appender = HDF5Appender(
+        path=path,
+        shapes={name: array.shape[1:] for name, array in data.items()},
+        chunk_rows=args.chunk,
+        dtype=dtype,
+        mode='w',
+        compression=compression,
+        compression_level=args.level,
+    )
+    tic = time.perf_counter()
+    for start in range(0, args.iterations, args.chunk):
+        stop = min(start + args.chunk, args.iterations)
+        appender.append(
+            rows={
+                name: array[start:stop].astype(dtype, copy=False)
+                for name, array in data.items()
+            },
+            start=start,
+        )
+    appender.close()
+    duration = time.perf_counter() - tic
+    return {'time': duration, 'size': os.path.getsize(path)}
+
+
+def main():
+    """Main"""
+    args = parse_args()
+    data = synthetic_data(args)
+    raw_size = sum(array.nbytes for array in data.values())
+    print(f'Raw float64 data: {raw_size/1e6:.1f} MB')
+    print(
+        f'{"dtype":>8} {"compression":>12} {"MB/s":>9}'
+        f' {"size [MB]":>10} {"ratio":>7}'
+    )
+    with tempfile.TemporaryDirectory() as folder:
+        for dtype in args.dtypes:
+            for compression in args.compressions:
+                path = os.path.join(folder, f'{dtype}_{compression}.hdf5')
+                try:
+                    result = benchmark(
+                        path=path,
+                        data=data,
+                        args=args,
+                        dtype=dtype,
+                        compression=(
+                            None if compression == 'none' else compression
+                        ),
+                    )
+                except ImportError as err:
+                    print(f'{dtype:>8} {compression:>12} skipped: {err}')
+                    continue
+                print(
+                    f'{dtype:>8} {compression:>12}'
+                    f' {raw_size/1e6/result["time"]:>9.1f}'
+                    f' {result["size"]/1e6:>10.2f}'
+                    f' {raw_size/result["size"]:>7.1f}'
+                )
+
+
+if __name__ == '__main__':
+    main()
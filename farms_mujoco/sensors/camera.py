@@ -3,9 +3,7 @@
 import numpy as np
 from tqdm import tqdm
 
-import matplotlib.pyplot as plt
-import matplotlib.animation as manimation
-from mpl_toolkits.axes_grid1 import make_axes_locatable
+# NOTE: matplotlib is only imported when saving videos
 
 from farms_core import pylog
 from farms_mujoco.simulation.task import TaskCallback
@@ -66,6 +64,8 @@ class CameraCallback(TaskCallback):
             writer: str = 'ffmpeg',
     ):
         """Save recording"""
+        import matplotlib.pyplot as plt
+        import matplotlib.animation as manimation
         if iteration is not None:
             assert iteration//(self.skips+1) <= self.sample, (
                 f'{iteration//(self.skips+1)} !<= {self.sample}'
@@ -107,6 +107,7 @@ class CameraCallback(TaskCallback):
 
 def render_matplotlib_image(fig_ax, img, ims=None, cbar_label='', clim=None):
     """Render matplotlib image"""
+    import matplotlib.pyplot as plt
     if ims is None:
         ims = plt.imshow(img)
         fig_ax.spines['top'].set_visible(False)
@@ -121,6 +122,7 @@ def render_matplotlib_image(fig_ax, img, ims=None, cbar_label='', clim=None):
         plt.axis('off')
         plt.tight_layout(pad=0)
         if cbar_label:
+            from mpl_toolkits.axes_grid1 import make_axes_locatable
             divider = make_axes_locatable(fig_ax)
             cax = divider.append_axes("right", size="5%", pad=0.1)
             cbar = plt.colorbar(ims, cax=cax)
@@ -134,6 +136,7 @@ def render_matplotlib_image(fig_ax, img, ims=None, cbar_label='', clim=None):
 
 def save_video(camera, video_path, iteration=None):
     """Save video"""
+    import matplotlib.animation as manimation
     if 'ffmpeg' in manimation.writers.list():
         camera.save(
             filename=f'{video_path}.mp4',
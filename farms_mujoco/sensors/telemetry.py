@@ -0,0 +1,230 @@
+"""Shared memory telemetry"""
+
+import os
+import json
+import time
+import itertools
+from multiprocessing import shared_memory, resource_tracker
+from typing import Dict, List
+
+import numpy as np
+
+from farms_core import pylog
+from farms_mujoco.simulation.task import TaskCallback
+from farms_mujoco.simulation.physics import SENSORS_GROUPS, sensors_arrays
+
+
+# Header layout, after the layout size
+SEQUENCE, ITERATION, TIME, STEP_DURATION, PERIOD = range(5)
+HEADER_SIZE = 5
+ALIGNMENT = 64
+# Copies counter, for segments names of copies
+_COPIES = itertools.count(1)
+
+
+def telemetry_layout(arrays: Dict[str, np.ndarray]) -> Dict:
+    """Layout of the telemetry segment for arrays rows"""
+    fields = {}
+    offset = 0
+    for name, array in arrays.items():
+        shape = list(array.shape[1:])
+        fields[name] = {'offset': offset, 'shape': shape}
+        offset += int(np.prod(shape))
+    return {'header': HEADER_SIZE, 'fields': fields, 'size': offset}
+
+
+class TelemetryCallback(TaskCallback):
+    """Publish the current data slot to a named shared memory segment
+
+    Every rate iterations, the rows of the sensors arrays of the step
+    are copied into the segment, together with the iteration, the
+    simulation time, the wall time of the step and the wall time between
+    publications. The segment starts with the size of a JSON layout,
+    followed by the layout and by the float64 data, see TelemetryReader.
+    Writes are protected by a seqlock: the sequence number is odd while
+    the data is being written, so readers never wait for the simulation
+    and retry when the sequence changed during their copy. Copies, e.g.
+    of forked simulations, publish to their own segments, and segments
+    are only removed by the process which created them.
+
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.name: str = kwargs.pop('name', f'farms_telemetry_{os.getpid()}')
+        self.rate: int = kwargs.pop('rate', 1)
+        self.fields: List[str] = kwargs.pop('fields', None)
+        assert not kwargs, kwargs
+        assert self.rate >= 1, f'{self.rate=}'
+        # Sensors groups collected for publication
+        fields = SENSORS_GROUPS if self.fields is None else self.fields
+        self.sensors_subscriptions: Dict = {
+            group: True
+            for group in fields
+            if group in SENSORS_GROUPS
+        }
+        self._block: shared_memory.SharedMemory = None
+        self._pid: int = None
+        self._layout: Dict = None
+        self._header: np.ndarray = None
+        self._values: np.ndarray = None
+        self._tic: float = None
+        self._published: float = None
+
+    def __del__(self):
+        self.close()
+
+    def __deepcopy__(self, memo):
+        """Copy publishing to its own segment"""
+        copy = type(self)(
+            name=f'{self.name}_copy{next(_COPIES)}',
+            rate=self.rate,
+            fields=None if self.fields is None else list(self.fields),
+        )
+        memo[id(self)] = copy
+        return copy
+
+    def arrays(self, task) -> Dict[str, np.ndarray]:
+        """Published sensors arrays"""
+        arrays = sensors_arrays(task.data)
+        if self.fields is None:
+            return arrays
+        return {name: arrays[name] for name in self.fields}
+
+    def initialize_episode(self, task, physics):
+        """Create shared memory segment"""
+        layout = telemetry_layout(self.arrays(task))
+        if layout != self._layout:
+            self.close()
+            self._layout = layout
+            encoded = json.dumps(layout).encode()
+            offset = -(-(8 + len(encoded))//ALIGNMENT)*ALIGNMENT
+            nbytes = offset + 8*(HEADER_SIZE + layout['size'])
+            try:
+                self._block = shared_memory.SharedMemory(
+                    name=self.name, create=True, size=nbytes,
+                )
+            except FileExistsError:
+                pylog.warning('Replacing shared memory segment %s', self.name)
+                stale = shared_memory.SharedMemory(name=self.name)
+                stale.close()
+                stale.unlink()
+                self._block = shared_memory.SharedMemory(
+                    name=self.name, create=True, size=nbytes,
+                )
+            self._pid = os.getpid()
+            buffer = self._block.buf
+            buffer[:8] = np.array([offset], dtype=np.int64).tobytes()
+            buffer[8:8+len(encoded)] = encoded
+            self._header = np.ndarray(
+                (HEADER_SIZE,), dtype=np.float64, buffer=buffer, offset=offset,
+            )
+            self._values = np.ndarray(
+                (layout['size'],),
+                dtype=np.float64,
+                buffer=buffer,
+                offset=offset + 8*HEADER_SIZE,
+            )
+            self._header[:] = 0
+            pylog.info('Publishing telemetry to shared memory %s', self.name)
+        self._published = None
+
+    def before_step(self, task, action, physics):
+        """Step start time"""
+        self._tic = time.perf_counter()
+
+    def after_step(self, task, physics):
+        """Publish data of step"""
+        if self._values is None or (task.iteration - 1) % self.rate:
+            return
+        toc = time.perf_counter()
+        index = (task.iteration - 1) % task.buffer_size
+        header = self._header
+        header[SEQUENCE] += 1  # Odd, writing
+        for name, array in self.arrays(task).items():
+            field = self._layout['fields'][name]
+            offset = field['offset']
+            row = array[index].ravel()
+            self._values[offset:offset+row.size] = row
+        header[ITERATION] = task.iteration - 1
+        header[TIME] = (task.iteration - 1)*task.timestep
+        header[STEP_DURATION] = toc - self._tic if self._tic else 0
+        header[PERIOD] = toc - self._published if self._published else 0
+        header[SEQUENCE] += 1  # Even, consistent
+        self._published = toc
+
+    def close(self):
+        """Release and remove shared memory segment"""
+        self._header = None
+        self._values = None
+        self._layout = None
+        if self._block is not None:
+            self._block.close()
+            if self._pid == os.getpid():
+                self._block.unlink()
+            self._block = None
+
+
+class TelemetryReader:
+    """Read telemetry published by TelemetryCallback
+
+    The reader never blocks the simulation, read retries until it
+    obtains a copy which was not modified while being copied.
+
+    """
+
+    def __init__(self, name: str):
+        super().__init__()
+        try:
+            self._block = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:  # Python < 3.13, segment owned by the publisher
+            self._block = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(
+                self._block._name,  # pylint: disable=protected-access
+                'shared_memory',
+            )
+        buffer = self._block.buf
+        offset = int(np.frombuffer(buffer[:8], dtype=np.int64)[0])
+        self.layout: Dict = json.loads(bytes(buffer[8:offset]).rstrip(b'\0'))
+        self._header = np.ndarray(
+            (HEADER_SIZE,), dtype=np.float64, buffer=buffer, offset=offset,
+        )
+        self._values = np.ndarray(
+            (self.layout['size'],),
+            dtype=np.float64,
+            buffer=buffer,
+            offset=offset + 8*HEADER_SIZE,
+        )
+
+    def read(self, retries: int = 1000) -> Dict:
+        """Consistent copy of the latest publication, None if no data"""
+        for _ in range(retries):
+            sequence = self._header[SEQUENCE]
+            if sequence % 2:
+                continue
+            header = np.copy(self._header)
+            values = np.copy(self._values)
+            if self._header[SEQUENCE] != sequence:
+                continue
+            if not sequence:
+                return None
+            telemetry = {
+                'iteration': int(header[ITERATION]),
+                'time': header[TIME],
+                'step_duration': header[STEP_DURATION],
+                'period': header[PERIOD],
+            }
+            for name, field in self.layout['fields'].items():
+                offset = field['offset']
+                size = int(np.prod(field['shape']))
+                telemetry[name] = values[offset:offset+size].reshape(
+                    field['shape']
+                )
+            return telemetry
+        raise RuntimeError('Telemetry could not be read consistently')
+
+    def close(self):
+        """Detach from shared memory segment"""
+        self._header = None
+        self._values = None
+        self._block.close()
@@ -0,0 +1,91 @@
+"""Adaptive number of physics substeps per control iteration"""
+
+from typing import Dict
+
+import numpy as np
+
+from dm_control.mujoco.wrapper import mjbindings
+from dm_control.mjcf.physics import Physics
+
+
+LIMIT_JOINT = mjbindings.enums.mjtConstraint.mjCNSTR_LIMIT_JOINT
+
+
+class AdaptiveSubsteps:
+    """Vary the number of physics substeps of each control iteration
+
+    At each control iteration, the state is checked for activity, namely
+    active contacts (including those within the geoms margins), active
+    joint limits and generalised velocities above velocity_max. The
+    iteration is integrated with max_substeps physics steps if activity
+    was found within the last hold iterations, and with min_substeps
+    otherwise, the control timestep staying constant. Sensors, control
+    and callbacks remain on the iteration grid, and substep callbacks are
+    called between the physics substeps of each iteration.
+
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.min_substeps: int = kwargs.pop('min_substeps', 1)
+        self.max_substeps: int = kwargs.pop('max_substeps')
+        self.velocity_max: float = kwargs.pop('velocity_max', np.inf)
+        self.hold: int = kwargs.pop('hold', 1)
+        assert not kwargs, kwargs
+        assert 1 <= self.min_substeps <= self.max_substeps, (
+            f'{self.min_substeps=} {self.max_substeps=}'
+        )
+        self.history: np.ndarray = None
+        self._inactive: int = 0
+
+    def reset(self, n_iterations: int):
+        """Reset at episode start"""
+        self.history = np.zeros(n_iterations, dtype=np.uint16)
+        self._inactive = self.hold  # Coarse until activity is found
+
+    def active(self, physics: Physics) -> bool:
+        """Contacts, joint limits or high velocities in current state"""
+        data = physics.data
+        if data.ncon:
+            return True
+        if np.any(data.efc_type[:data.nefc] == LIMIT_JOINT):
+            return True
+        return bool(np.max(np.abs(data.qvel), initial=0) > self.velocity_max)
+
+    def substeps(self, physics: Physics) -> int:
+        """Number of substeps for the next iteration"""
+        self._inactive = 0 if self.active(physics) else self._inactive + 1
+        return (
+            self.max_substeps
+            if self._inactive < self.hold
+            else self.min_substeps
+        )
+
+    def step(self, task, physics: Physics):
+        """Integrate all but the last substep of the iteration
+
+        Called at the end of the task before_step, the last substep being
+        integrated by the environment.
+
+        """
+        watchdog = task.watchdog
+        if watchdog is not None and watchdog.recovering:
+            return  # Timestep refined by the watchdog
+        substeps = self.substeps(physics)
+        self.history[task.iteration] = substeps
+        physics.model.opt.timestep = task.timestep/substeps
+        for _ in range(substeps-1):
+            physics.step()
+            task.before_substep(physics=physics)
+
+    def statistics(self) -> Dict:
+        """Substeps statistics up to current iteration"""
+        history = self.history[self.history > 0]
+        return {
+            'mean_substeps': float(np.mean(history)) if len(history) else 0,
+            'fine_ratio': (
+                float(np.mean(history == self.max_substeps))
+                if len(history)
+                else 0
+            ),
+        }
@@ -0,0 +1,344 @@
+"""Performance advisor for compiled models"""
+
+import json
+from typing import Dict, List, Union
+
+import numpy as np
+
+from dm_control import mjcf
+from dm_control.mjcf.physics import Physics
+
+from farms_core import pylog
+
+
+# Default thresholds, can be overridden as keyword arguments of advise
+ADVISOR_THRESHOLDS = {
+    'mesh_faces': 2000,  # Faces of a colliding mesh
+    'pairs_total': 200,  # Explicit contact pairs in the model
+    'pairs_per_bodies': 16,  # Contact pairs expanded from a pair of bodies
+    'period_points_min': 10,  # Timesteps per period of stiffest joint
+    'period_points_max': 100,  # Timesteps per period of stiffest joint
+    'solver_iterations': 100,
+    'mpr_iterations': 100,
+}
+# Sensors compiled by sdf2mjcf but not read by physics2data, which reads
+# the corresponding values directly from the MuJoCo data
+UNUSED_SENSORS = ('framepos', 'framequat', 'jointpos', 'jointvel', 'touch')
+SEVERITIES = ('info', 'warning', 'error')
+GEOM_MESH = 7  # mjGEOM_MESH
+JOINT_SLIDE, JOINT_HINGE = 2, 3  # mjJNT_SLIDE, mjJNT_HINGE
+TRN_JOINT = 0  # mjTRN_JOINT
+
+
+def finding(code: str, severity: str, message: str, **kwargs) -> Dict:
+    """Advisor finding
+
+    The impact is a rough estimate of the factor by which the cost of the
+    affected part of the step could be reduced by addressing the finding.
+
+    """
+    assert severity in SEVERITIES, severity
+    element = kwargs.pop('element', None)
+    value = kwargs.pop('value', None)
+    threshold = kwargs.pop('threshold', None)
+    impact = kwargs.pop('impact', None)
+    assert not kwargs, kwargs
+    return {
+        'code': code,
+        'severity': severity,
+        'element': element,
+        'value': value,
+        'threshold': threshold,
+        'impact': float(impact) if impact is not None else None,
+        'message': message,
+    }
+
+
+def check_meshes(physics: Physics, thresholds: Dict) -> List[Dict]:
+    """Colliding meshes with high face counts"""
+    model = physics.model
+    findings = []
+    for geom_id in range(model.ngeom):
+        colliding = (
+            model.geom_contype[geom_id] or model.geom_conaffinity[geom_id]
+        )
+        if model.geom_type[geom_id] != GEOM_MESH or not colliding:
+            continue
+        mesh_id = model.geom_dataid[geom_id]
+        faces = int(model.mesh_facenum[mesh_id])
+        if faces <= thresholds['mesh_faces']:
+            continue
+        findings.append(finding(
+            code='mesh_faces',
+            severity='warning',
+            element=model.id2name(geom_id, 'geom'),
+            value=faces,
+            threshold=thresholds['mesh_faces'],
+            impact=faces/thresholds['mesh_faces'],
+            message=(
+                f'Colliding mesh {model.id2name(mesh_id, "mesh")} has'
+                f' {faces} faces, consider a simplified or primitive'
+                ' collision geometry'
+            ),
+        ))
+    return findings
+
+
+def check_pairs(physics: Physics, thresholds: Dict) -> List[Dict]:
+    """Explicit contact pairs, such as expanded self_collisions"""
+    model = physics.model
+    findings = []
+    if model.npair > thresholds['pairs_total']:
+        findings.append(finding(
+            code='pairs_total',
+            severity='warning',
+            element='contact',
+            value=int(model.npair),
+            threshold=thresholds['pairs_total'],
+            impact=model.npair/thresholds['pairs_total'],
+            message=(
+                f'{model.npair} explicit contact pairs are checked at every'
+                ' step, consider reducing self_collisions'
+            ),
+        ))
+    bodies = np.sort(np.stack([
+        model.geom_bodyid[model.pair_geom1],
+        model.geom_bodyid[model.pair_geom2],
+    ], axis=1), axis=1) if model.npair else np.zeros([0, 2], dtype=int)
+    body_pairs, counts = np.unique(bodies, axis=0, return_counts=True)
+    for (body1, body2), count in zip(body_pairs, counts):
+        if count <= thresholds['pairs_per_bodies']:
+            continue
+        name1 = model.id2name(body1, 'body')
+        name2 = model.id2name(body2, 'body')
+        findings.append(finding(
+            code='pairs_per_bodies',
+            severity='warning',
+            element=f'{name1}/{name2}',
+            value=int(count),
+            threshold=thresholds['pairs_per_bodies'],
+            impact=count/thresholds['pairs_per_bodies'],
+            message=(
+                f'Self-collision between {name1} and {name2} expands to'
+                f' {count} geom pairs, consider fewer collision geometries'
+            ),
+        ))
+    return findings
+
+
+def check_sensors(physics: Physics, thresholds: Dict) -> List[Dict]:
+    """Sensors compiled into the model but never read"""
+    # pylint: disable=unused-argument
+    model = physics.model
+    if not model.nsensor:
+        return []
+    names = [model.id2name(i, 'sensor') for i in range(model.nsensor)]
+    findings = []
+    for sensor in UNUSED_SENSORS:
+        indices = [
+            i for i, name in enumerate(names) if name.startswith(f'{sensor}_')
+        ]
+        if not indices:
+            continue
+        dims = int(np.sum(model.sensor_dim[indices]))
+        findings.append(finding(
+            code='unused_sensors',
+            severity='info',
+            element=sensor,
+            value=len(indices),
+            threshold=0,
+            impact=model.nsensordata/max(1, model.nsensordata - dims),
+            message=(
+                f'{len(indices)} {sensor} sensors ({dims} values) are'
+                ' evaluated at every step but not collected'
+            ),
+        ))
+    return findings
+
+
+def joints_stiffness(physics: Physics) -> np.ndarray:
+    """Stiffness of each joint, including position actuators gains"""
+    model = physics.model
+    stiffness = np.array(model.jnt_stiffness, dtype=float)
+    for actuator_id in range(model.nu):
+        if model.actuator_trntype[actuator_id] != TRN_JOINT:
+            continue
+        # Position actuators have a bias of -kp*length
+        gain = -model.actuator_biasprm[actuator_id, 1]
+        if gain > 0:
+            joint_id = model.actuator_trnid[actuator_id, 0]
+            stiffness[joint_id] += gain*model.actuator_gear[actuator_id, 0]**2
+    return stiffness
+
+
+def check_timestep(physics: Physics, thresholds: Dict) -> List[Dict]:
+    """Timestep against the period of the stiffest joint"""
+    model = physics.model
+    stiffness = joints_stiffness(physics)
+    periods = np.full(model.njnt, np.inf)
+    for joint_id in range(model.njnt):
+        if model.jnt_type[joint_id] not in (JOINT_SLIDE, JOINT_HINGE):
+            continue
+        invweight = model.dof_invweight0[model.jnt_dofadr[joint_id]]
+        if stiffness[joint_id] > 0 and invweight > 0:
+            periods[joint_id] = 2*np.pi*np.sqrt(
+                1/(invweight*stiffness[joint_id])
+            )
+    if not np.isfinite(periods).any():
+        return []
+    joint_id = int(np.argmin(periods))
+    period = float(periods[joint_id])
+    timestep = float(model.opt.timestep)
+    points = period/timestep
+    name = model.id2name(joint_id, 'joint')
+    if points < thresholds['period_points_min']:
+        return [finding(
+            code='timestep_large',
+            severity='error',
+            element=name,
+            value=points,
+            threshold=thresholds['period_points_min'],
+            impact=None,
+            message=(
+                f'Timestep {timestep:.3e} s resolves the {period:.3e} s period'
+                f' of joint {name} with only {points:.1f} steps, the'
+                ' simulation may be unstable'
+            ),
+        )]
+    if points > thresholds['period_points_max']:
+        return [finding(
+            code='timestep_small',
+            severity='info',
+            element=name,
+            value=points,
+            threshold=thresholds['period_points_max'],
+            impact=points/thresholds['period_points_max'],
+            message=(
+                f'Timestep {timestep:.3e} s resolves the {period:.3e} s period'
+                f' of the stiffest joint {name} with {points:.0f} steps, a'
+                ' larger timestep may suffice if contacts allow it'
+            ),
+        )]
+    return []
+
+
+def check_iterations(physics: Physics, thresholds: Dict) -> List[Dict]:
+    """Solver and collision iterations caps"""
+    model = physics.model
+    opt = model.opt
+    findings = []
+    if opt.iterations > thresholds['solver_iterations']:
+        findings.append(finding(
+            code='solver_iterations',
+            severity='error' if opt.tolerance <= 0 else 'warning',
+            element='option',
+            value=int(opt.iterations),
+            threshold=thresholds['solver_iterations'],
+            impact=opt.iterations/thresholds['solver_iterations'],
+            message=(
+                f'Solver iterations cap of {opt.iterations} bounds the cost'
+                ' of steps which do not converge'
+                + (
+                    ', with a zero tolerance every step runs to the cap'
+                    if opt.tolerance <= 0
+                    else ''
+                )
+            ),
+        ))
+    colliding_meshes = np.any(
+        (model.geom_type == GEOM_MESH)
+        & ((model.geom_contype != 0) | (model.geom_conaffinity != 0))
+    )
+    if opt.mpr_iterations > thresholds['mpr_iterations']:
+        findings.append(finding(
+            code='mpr_iterations',
+            severity='warning' if colliding_meshes else 'info',
+            element='option',
+            value=int(opt.mpr_iterations),
+            threshold=thresholds['mpr_iterations'],
+            impact=opt.mpr_iterations/thresholds['mpr_iterations'],
+            message=(
+                f'MPR iterations cap of {opt.mpr_iterations} bounds the cost'
+                ' of convex collisions which do not converge'
+                + ('' if colliding_meshes else ', no colliding meshes')
+            ),
+        ))
+    if opt.noslip_iterations > 0:
+        findings.append(finding(
+            code='noslip_iterations',
+            severity='info',
+            element='option',
+            value=int(opt.noslip_iterations),
+            threshold=0,
+            impact=None,
+            message=(
+                f'Noslip solver runs {opt.noslip_iterations} additional'
+                ' iterations after the main solver at every step'
+            ),
+        ))
+    return findings
+
+
+CHECKS = (
+    check_meshes,
+    check_pairs,
+    check_sensors,
+    check_timestep,
+    check_iterations,
+)
+
+
+def advise(model: Union[Physics, mjcf.RootElement], **kwargs) -> List[Dict]:
+    """Findings of likely throughput problems in model
+
+    The model can be the MJCF from sdf2mjcf or setup_mjcf_xml, which is
+    then compiled, or the compiled physics. Thresholds from
+    ADVISOR_THRESHOLDS can be overridden with keyword arguments. Findings
+    are sorted by severity and impact, and can be serialised to JSON.
+
+    """
+    verbose = kwargs.pop('verbose', False)
+    thresholds = dict(ADVISOR_THRESHOLDS)
+    for key in list(kwargs.keys()):
+        assert key in thresholds, f'Unknown threshold {key}'
+        thresholds[key] = kwargs.pop(key)
+    physics = (
+        Physics.from_mjcf_model(model)
+        if isinstance(model, mjcf.RootElement)
+        else model
+    )
+    findings = [
+        item
+        for check in CHECKS
+        for item in check(physics, thresholds)
+    ]
+    findings.sort(key=lambda item: (
+        -SEVERITIES.index(item['severity']),
+        -(item['impact'] if item['impact'] is not None else np.inf),
+    ))
+    if verbose:
+        pylog.info(advice_report(findings))
+    return findings
+
+
+def advice_report(findings: List[Dict]) -> str:
+    """Advisor findings as text"""
+    if not findings:
+        return 'Performance advisor: no findings'
+    lines = [f'Performance advisor: {len(findings)} findings']
+    for item in findings:
+        impact = (
+            f' (impact x{item["impact"]:.1f})'
+            if item['impact'] is not None
+            else ''
+        )
+        lines.append(
+            f'  [{item["severity"]:<7}] {item["code"]}: {item["message"]}'
+            + impact
+        )
+    return '\n'.join(lines)
+
+
+def advice_json(findings: List[Dict], **kwargs) -> str:
+    """Advisor findings as JSON"""
+    return json.dumps(findings, **kwargs)
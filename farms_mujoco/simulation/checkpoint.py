@@ -0,0 +1,165 @@
+"""Crash-safe periodic checkpoints"""
+
+import os
+from typing import Dict, List
+
+import numpy as np
+
+from farms_core import pylog
+
+from .physics import sensors_arrays
+from .snapshot import physics_state, flatten, load_snapshot
+from .writer import BackgroundWriter, HDF5Appender
+
+
+STATE_FILE = 'state.npz'
+
+
+def data_filename(prefix: str) -> str:
+    """Checkpoint data file of animat with prefix"""
+    return f'data_{prefix.strip("_")}.hdf5' if prefix else 'data.hdf5'
+
+
+def write_state(path: str, state: Dict):
+    """Write state file atomically"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as state_file:
+        np.savez(state_file, **flatten(state))
+        state_file.flush()
+        os.fsync(state_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def buffer_rows(array: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """Copy of rows of iterations start to stop from ring buffer"""
+    return np.take(array, np.arange(start, stop) % array.shape[0], axis=0)
+
+
+class Checkpointer:
+    """Periodic checkpoints of a simulation
+
+    At each checkpoint, the rows of the animats data buffers collected
+    since the previous checkpoint are appended to one HDF5 file per
+    animat, after which the physics and tasks states are written to the
+    state file, replacing the previous one atomically. Both are written in
+    order by a background thread, so that the state file always refers to
+    rows already in the data files. The data buffers must hold more than
+    the interval of iterations between checkpoints, which defaults to
+    1000 iterations or less to fit the buffers.
+
+    """
+
+    def __init__(self, path: str, interval: int = None):
+        super().__init__()
+        assert interval is None or interval >= 1, f'{interval=}'
+        self.path: str = path
+        self.interval: int = interval
+        self.rows: int = 0
+        self._writer: BackgroundWriter = None
+        self._appenders: List[HDF5Appender] = None
+
+    @property
+    def state_path(self) -> str:
+        """State file path"""
+        return os.path.join(self.path, STATE_FILE)
+
+    def open(self, tasks: List, rows: int = 0):
+        """Open data files and writer, continuing from rows"""
+        self.close()
+        os.makedirs(self.path, exist_ok=True)
+        # The slot of the current iteration may already be collected
+        if self.interval is None:
+            self.interval = min(
+                [1000] + [task.buffer_size - 1 for task in tasks]
+            )
+        for task in tasks:
+            assert self.interval < task.buffer_size, (
+                f'Checkpoint interval {self.interval} must be smaller than'
+                f' data buffer size {task.buffer_size}'
+            )
+        self._appenders = [
+            HDF5Appender(
+                path=os.path.join(self.path, data_filename(task.prefix)),
+                shapes={
+                    name: array.shape[1:]
+                    for name, array in sensors_arrays(task.data).items()
+                },
+            )
+            for task in tasks
+        ]
+        self._writer = BackgroundWriter()
+        self.rows = rows
+
+    def due(self, iteration: int) -> bool:
+        """Checkpoint is due at iteration, or files are not opened yet"""
+        if self._writer is None:
+            return True
+        return iteration - self.rows >= self.interval
+
+    def checkpoint(self, simulation):
+        """Write checkpoint of simulation at current iteration"""
+        tasks = simulation.tasks
+        if self._writer is None:
+            self.open(tasks)
+        iteration = tasks[0].iteration
+        # Copies are made in the simulation thread, before it continues
+        for task, appender in zip(tasks, self._appenders):
+            self._writer.submit(
+                appender.append,
+                rows={
+                    name: buffer_rows(array, self.rows, iteration)
+                    for name, array in sensors_arrays(task.data).items()
+                },
+                start=self.rows,
+            )
+        self._writer.submit(
+            write_state,
+            path=self.state_path,
+            state={
+                'physics': physics_state(simulation.physics),
+                'task': simulation.task.get_state(data=False),
+                'rows': iteration,
+            },
+        )
+        self.rows = iteration
+
+    def flush(self):
+        """Wait for checkpoints to be written"""
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self):
+        """Complete checkpoints and close files"""
+        if self._writer is not None:
+            for appender in self._appenders:
+                self._writer.submit(appender.close)
+            writer, self._writer = self._writer, None
+            writer.close()
+        self._appenders = None
+
+
+def load_checkpoint(path: str, tasks: List) -> Dict:
+    """Load last consistent checkpoint and restore data buffers
+
+    The data rows of the last buffer_size iterations before the
+    checkpoint are copied into the animats data buffers. Returns the
+    snapshot to restore, with the number of rows in the data files.
+
+    """
+    import h5py
+    snapshot = load_snapshot(os.path.join(path, STATE_FILE))
+    rows = int(snapshot['rows'])
+    for task in tasks:
+        filename = os.path.join(path, data_filename(task.prefix))
+        with h5py.File(filename, 'r') as hfile:
+            assert int(hfile.attrs['rows']) >= rows, (
+                f'Inconsistent checkpoint: {filename} has'
+                f' {hfile.attrs["rows"]} rows, state has {rows}'
+            )
+            for name, array in sensors_arrays(task.data).items():
+                start = max(0, rows - array.shape[0])
+                array[np.arange(start, rows) % array.shape[0]] = (
+                    hfile[name][start:rows]
+                )
+    pylog.info('Loaded checkpoint at iteration %s from %s', rows, path)
+    return snapshot
@@ -0,0 +1,141 @@
+"""Array-based control interface"""
+
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from farms_core.model.control import ControlType, AnimatController
+
+
+# Control blocks, in the order of the preallocated control vector
+CONTROL_KEYS = ('pos', 'vel', 'trq', 'mus')
+
+
+class ControlArrays:
+    """Preallocated control arrays
+
+    Positions, velocities, torques and excitations are contiguous views
+    of a single control vector, aligned with the task maps['ctrl'] indices,
+    so that the task can copy all of them into the physics controls with
+    one indexed assignment. Spring references are aligned with the
+    springref_names, and are initialised from the model so that entries a
+    controller does not write keep their value.
+
+    """
+
+    def __init__(
+            self,
+            names: Dict[str, List[str]],
+            springref_names: List[str],
+            springrefs: np.ndarray = None,
+    ):
+        super().__init__()
+        self.names: Dict[str, List[str]] = {
+            key: list(names.get(key, []))
+            for key in CONTROL_KEYS
+        }
+        self.slices: Dict[str, slice] = {}
+        start = 0
+        for key in CONTROL_KEYS:
+            self.slices[key] = slice(start, start+len(self.names[key]))
+            start += len(self.names[key])
+        self.ctrl: np.ndarray = np.zeros(start)
+        self.springref_names: List[str] = list(springref_names)
+        self.springrefs: np.ndarray = (
+            np.array(springrefs, dtype=float)
+            if springrefs is not None
+            else np.zeros(len(self.springref_names))
+        )
+        assert len(self.springrefs) == len(self.springref_names)
+        self.springref_index: Dict[str, int] = {
+            joint: joint_i
+            for joint_i, joint in enumerate(self.springref_names)
+        }
+
+    @property
+    def positions(self) -> np.ndarray:
+        """Joints positions"""
+        return self.ctrl[self.slices['pos']]
+
+    @property
+    def velocities(self) -> np.ndarray:
+        """Joints velocities"""
+        return self.ctrl[self.slices['vel']]
+
+    @property
+    def torques(self) -> np.ndarray:
+        """Joints torques"""
+        return self.ctrl[self.slices['trq']]
+
+    @property
+    def excitations(self) -> np.ndarray:
+        """Muscles excitations"""
+        return self.ctrl[self.slices['mus']]
+
+
+class DictControllerAdapter:
+    """Array control interface for controllers returning dicts
+
+    Wraps an AnimatController implementing positions, torques, springrefs
+    and excitations as dicts keyed by names, and writes them into the
+    control arrays in the order of their names. Velocities are not
+    written, as they are not part of the dict interface.
+
+    """
+
+    control_types: Tuple[str] = ('pos', 'trq', 'mus')
+
+    def __init__(self, controller: AnimatController):
+        super().__init__()
+        self.controller = controller
+
+    def springref_names(self, joints: List[str]) -> List[str]:
+        """Spring references written by controller among joints"""
+        if not self.controller.joints_names[ControlType.TORQUE]:
+            return []
+        return joints
+
+    def write_controls(
+            self,
+            iteration: int,
+            time: float,
+            timestep: float,
+            arrays: ControlArrays,
+    ):
+        """Write controller outputs into control arrays"""
+        controller = self.controller
+        kwargs = {'iteration': iteration, 'time': time, 'timestep': timestep}
+        if arrays.names['pos']:
+            positions = controller.positions(**kwargs)
+            arrays.positions[:] = [
+                positions[joint]
+                for joint in arrays.names['pos']
+            ]
+        if arrays.names['trq']:
+            torques = controller.torques(**kwargs)
+            arrays.torques[:] = [
+                torques[joint]
+                for joint in arrays.names['trq']
+            ]
+            if arrays.springref_names:
+                springrefs = controller.springrefs(**kwargs)
+                index = arrays.springref_index
+                for joint, value in springrefs.items():
+                    arrays.springrefs[index[joint]] = value
+        if arrays.names['mus']:
+            excitations = controller.excitations(**kwargs)
+            arrays.excitations[:] = excitations
+
+
+def array_controller(controller: AnimatController):
+    """Controller implementing the array interface, adapted if required
+
+    Controllers implement the array interface with a write_controls method
+    filling the ControlArrays in place. They can optionally restrict the
+    control blocks written with control_types, and select the joints
+    spring references they write with a springref_names method.
+
+    """
+    if hasattr(controller, 'write_controls'):
+        return controller
+    return DictControllerAdapter(controller)
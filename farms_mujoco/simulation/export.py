@@ -0,0 +1,182 @@
+"""Columnar export of simulation results"""
+
+import os
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from farms_core import pylog
+from farms_core.model.data import AnimatData
+
+from .physics import sensors_arrays
+from .observation import OBSERVATION_FIELDS
+from .logger import logged_fields
+
+
+# Columnar formats and file extensions
+EXPORT_FORMATS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+
+def default_run_id(path: str) -> str:
+    """Run id of simulation.hdf5 file at path
+
+    The run id is the name of the log folder of the run, identified by its
+    simulation_options.yaml file. Population animats are saved in
+    subfolders of the log folder, their run id is then the log folder name
+    followed by the animat subfolder name, e.g. run_animat0.
+
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    parent = os.path.dirname(folder)
+    options = 'simulation_options.yaml'
+    if (
+            not os.path.isfile(os.path.join(folder, options))
+            and os.path.isfile(os.path.join(parent, options))
+    ):
+        return f'{os.path.basename(parent)}_{os.path.basename(folder)}'
+    return os.path.basename(folder)
+
+
+def field_columns(
+        data: AnimatData,
+        fields: List[str] = None,
+) -> Dict[str, np.ndarray]:
+    """Sensors channels columns of animat data, one row per iteration
+
+    Columns are named field/element for scalar fields, and
+    field/element/component for vector fields, see logged_fields, all
+    observation fields being exported if fields is None.
+
+    """
+    arrays = sensors_arrays(data)
+    columns = {}
+    selection = logged_fields(
+        data,
+        list(OBSERVATION_FIELDS) if fields is None else fields,
+    )
+    for field, (group, index) in selection.items():
+        if group not in arrays:
+            continue
+        values = arrays[group][:, :, index]
+        sensors = getattr(data.sensors, group)
+        names = getattr(sensors, 'names', None) or range(values.shape[1])
+        for element_i, name in enumerate(names):
+            if values.ndim == 2:
+                columns[f'{field}/{name}'] = values[:, element_i]
+                continue
+            for component in range(values.shape[2]):
+                columns[f'{field}/{name}/{component}'] = (
+                    values[:, element_i, component]
+                )
+    return columns
+
+
+def run_table(
+        data: AnimatData,
+        run_id: str,
+        parameters: Dict = None,
+        fields: List[str] = None,
+):
+    """Arrow table of run, with run id, parameters and sensors columns"""
+    import pyarrow as pa
+    columns = field_columns(data, fields)
+    n_rows = len(next(iter(columns.values()))) if columns else 0
+    table = {
+        'run_id': pa.DictionaryArray.from_arrays(
+            np.zeros(n_rows, dtype=np.int32),
+            pa.array([run_id]),
+        ),
+    }
+    for name, value in (parameters or {}).items():
+        table[name] = pa.array([value]*n_rows)
+    table['iteration'] = pa.array(np.arange(n_rows))
+    table['time'] = pa.array(np.arange(n_rows)*data.timestep)
+    for name, values in columns.items():
+        table[name] = pa.array(values)
+    return pa.table(table)
+
+
+def export_run(
+        path: str,
+        output: str,
+        run_id: str = None,
+        parameters: Dict = None,
+        **kwargs,
+) -> str:
+    """Export simulation.hdf5 file at path into columnar dataset output
+
+    The run is written to its own file in the output folder, named after
+    the run id, which defaults to default_run_id, so that runs can be
+    appended and the folder read as a dataset, e.g. with
+    pyarrow.dataset.dataset(output, format=export_format). Returns the
+    path of the written file.
+
+    """
+    import pyarrow as pa
+    fields = kwargs.pop('fields', None)
+    export_format = kwargs.pop('export_format', 'parquet')
+    compression = kwargs.pop('compression', 'zstd')
+    row_group_size = kwargs.pop('row_group_size', 65536)
+    assert not kwargs, kwargs
+    assert export_format in EXPORT_FORMATS, (
+        f'Unknown format {export_format} (available: {list(EXPORT_FORMATS)})'
+    )
+    if run_id is None:
+        run_id = default_run_id(path)
+    table = run_table(
+        data=AnimatData.from_file(path),
+        run_id=run_id,
+        parameters=parameters,
+        fields=fields,
+    )
+    os.makedirs(output, exist_ok=True)
+    filename = os.path.join(
+        output, f'{run_id}.{EXPORT_FORMATS[export_format]}',
+    )
+    if export_format == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(
+            table,
+            filename,
+            compression=compression,
+            row_group_size=row_group_size,
+        )
+    else:
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        with pa.OSFile(filename, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema, options=options) as ipc:
+                ipc.write_table(table, max_chunksize=row_group_size)
+    return filename
+
+
+def export_runs(
+        runs: Iterable[Tuple[str, Dict]],
+        output: str,
+        **kwargs,
+) -> List[str]:
+    """Export runs, as simulation.hdf5 paths and parameters, see export_run
+
+    Runs already exported to output are skipped unless overwrite is set,
+    so that an interrupted or growing sweep can be exported again.
+
+    """
+    overwrite = kwargs.pop('overwrite', False)
+    export_format = kwargs.get('export_format', 'parquet')
+    filenames = []
+    for path, parameters in runs:
+        run_id = default_run_id(path)
+        filename = os.path.join(
+            output, f'{run_id}.{EXPORT_FORMATS[export_format]}',
+        )
+        if not overwrite and os.path.isfile(filename):
+            filenames.append(filename)
+            continue
+        filenames.append(export_run(
+            path=path,
+            output=output,
+            run_id=run_id,
+            parameters=parameters,
+            **kwargs,
+        ))
+    pylog.info('Exported %s runs to %s', len(filenames), output)
+    return filenames
@@ -0,0 +1,181 @@
+"""Streaming data logger"""
+
+import os
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from farms_core import pylog
+
+from .physics import sensors_arrays
+from .observation import OBSERVATION_FIELDS
+from .checkpoint import data_filename
+from .writer import BackgroundWriter, HDF5Appender
+
+
+def logged_fields(
+        data,
+        fields: List[str] = None,
+) -> Dict[str, Tuple[str, Union[int, slice]]]:
+    """Logged fields, as sensors array and channels index
+
+    Fields are either sensors arrays names (links, joints, contacts,
+    muscles, xfrc), logged with all channels, or observation fields names
+    (e.g. joints_positions), logged with their channels only. All sensors
+    arrays are logged if fields is None.
+
+    """
+    arrays = sensors_arrays(data)
+    if fields is None:
+        fields = list(arrays)
+    selection = {}
+    for field in fields:
+        if field in arrays:
+            selection[field] = (field, slice(None))
+        else:
+            assert field in OBSERVATION_FIELDS, (
+                f'Unknown field {field} (available: {list(arrays)}'
+                f' and {list(OBSERVATION_FIELDS)})'
+            )
+            selection[field] = OBSERVATION_FIELDS[field]
+    return selection
+
+
+def field_rows(
+        array: np.ndarray,
+        index: Union[int, slice],
+        start: int,
+        stop: int,
+        dtype,
+) -> np.ndarray:
+    """Copy of field channels of iterations start to stop from ring buffer"""
+    rows = np.arange(start, stop) % array.shape[0]
+    return array[:, :, index][rows].astype(dtype, copy=False)
+
+
+class StreamingLogger:
+    """Stream animats data buffers to HDF5 files during the simulation
+
+    Every chunk iterations, the rows collected since the previous chunk
+    are copied from the data ring buffers and appended by a background
+    thread to one HDF5 file per animat, with one resizable dataset per
+    sensors array and the sensors names as attributes. The data buffers
+    can then be smaller than the number of iterations, as long as they
+    hold more than a chunk, so that memory remains constant for long
+    simulations.
+    At most max_jobs chunks are queued, after which the simulation waits
+    for the writer.
+
+    Only the given fields are stored, see logged_fields, with the given
+    dtype (e.g. float32 or float16) and compression (gzip, lzf, or lz4
+    and zstd with hdf5plugin) at compression_level, see
+    compression_kwargs. Rows are converted to dtype before being queued.
+
+    """
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__()
+        self.path: str = path
+        self.chunk: int = kwargs.pop('chunk', None)
+        self.max_jobs: int = kwargs.pop('max_jobs', 4)
+        self.fields: List[str] = kwargs.pop('fields', None)
+        self.dtype = np.dtype(kwargs.pop('dtype', np.float64))
+        self.compression: str = kwargs.pop('compression', None)
+        self.compression_level: int = kwargs.pop('compression_level', None)
+        assert not kwargs, kwargs
+        self.rows: int = 0
+        self._writer: BackgroundWriter = None
+        self._appenders: List[HDF5Appender] = None
+        self._fields: List[Dict] = None
+
+    def open(self, tasks: List, rows: int = 0):
+        """Open data files and writer, continuing from rows"""
+        self.close()
+        os.makedirs(self.path, exist_ok=True)
+        buffer_size = min(task.buffer_size for task in tasks)
+        # The slot of the current iteration may already be collected
+        if self.chunk is None:
+            self.chunk = buffer_size - 1
+        assert 0 < self.chunk < buffer_size, (
+            f'Logger chunk {self.chunk} must be smaller than data buffer'
+            f' size {buffer_size}'
+        )
+        self._appenders = []
+        self._fields = []
+        for task in tasks:
+            arrays = sensors_arrays(task.data)
+            fields = logged_fields(task.data, self.fields)
+            appender = HDF5Appender(
+                path=os.path.join(self.path, data_filename(task.prefix)),
+                shapes={
+                    field: arrays[group][0, :, index].shape
+                    for field, (group, index) in fields.items()
+                },
+                chunk_rows=self.chunk,
+                dtype=self.dtype,
+                compression=self.compression,
+                compression_level=self.compression_level,
+            )
+            appender.file.attrs['timestep'] = task.timestep
+            for field, (group, _) in fields.items():
+                sensors = getattr(task.data.sensors, group)
+                names = getattr(sensors, 'names', None) or []
+                appender.datasets[field].attrs['names'] = [
+                    str(sensor_name) for sensor_name in names
+                ]
+            self._appenders.append(appender)
+            self._fields.append(fields)
+        self._writer = BackgroundWriter(max_jobs=self.max_jobs)
+        self.rows = rows
+
+    def due(self, iteration: int) -> bool:
+        """Chunk is complete at iteration, or files are not opened yet"""
+        if self._writer is None:
+            return True
+        return iteration - self.rows >= self.chunk
+
+    def log(self, tasks: List):
+        """Write rows collected up to the current iteration"""
+        if self._writer is None:
+            self.open(tasks)
+        iteration = tasks[0].iteration
+        if iteration <= self.rows:
+            return
+        # Copies are made in the simulation thread, before it continues
+        for task, appender, fields in zip(
+                tasks, self._appenders, self._fields,
+        ):
+            arrays = sensors_arrays(task.data)
+            self._writer.submit(
+                appender.append,
+                rows={
+                    field: field_rows(
+                        array=arrays[group],
+                        index=index,
+                        start=self.rows,
+                        stop=iteration,
+                        dtype=self.dtype,
+                    )
+                    for field, (group, index) in fields.items()
+                },
+                start=self.rows,
+            )
+        self.rows = iteration
+
+    def flush(self):
+        """Wait for chunks to be written"""
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self, tasks: List = None):
+        """Write remaining rows of tasks if provided and close files"""
+        if self._writer is not None:
+            if tasks is not None:
+                self.log(tasks)
+            for appender in self._appenders:
+                self._writer.submit(appender.close)
+            writer, self._writer = self._writer, None
+            writer.close()
+            pylog.info('Logged %s iterations to %s', self.rows, self.path)
+        self._appenders = None
+        self._fields = None
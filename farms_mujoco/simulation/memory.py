@@ -0,0 +1,218 @@
+"""Buffers sizing and memory footprint"""
+
+from typing import Dict, List
+
+import numpy as np
+
+from dm_control import mjcf
+from dm_control.rl.control import PhysicsError
+from dm_control.mjcf.physics import Physics
+from dm_control.mujoco.wrapper import mjbindings
+
+from farms_core import pylog
+from farms_core.model.data import AnimatData
+
+
+# MuJoCo warnings raised when contacts or constraints buffers are full
+BUFFERS_WARNINGS = {
+    'nconmax': mjbindings.enums.mjtWarning.mjWARN_CONTACTFULL,
+    'njmax': mjbindings.enums.mjtWarning.mjWARN_CNSTRFULL,
+}
+# Default contacts and constraints buffers sizes
+BUFFERS_SIZES = {'nconmax': 2**12, 'njmax': 2**12}  # 4096
+
+
+class BuffersOverflowError(PhysicsError):
+    """Contacts or constraints buffers full"""
+
+
+def is_true(value) -> bool:
+    """MJCF boolean attribute"""
+    return value is True or str(value).lower() == 'true'
+
+
+def body_is_dynamic(body: mjcf.Element) -> bool:
+    """Body or any of its ancestors has degrees of freedom"""
+    while body is not None and body.tag == 'body':
+        if body.joint or body.freejoint is not None:
+            return True
+        body = body.parent
+    return False
+
+
+def estimate_buffer_sizes(mjcf_model: mjcf.RootElement, **kwargs) -> Dict:
+    """Estimate contacts and constraints capacity from model structure
+
+    Each colliding geom of a moving body is expected to generate up to
+    contacts_per_geom contacts, as are explicit contact pairs, and up to
+    terrain_contacts contacts with each static heightfield or mesh, which
+    generate many contacts per pair (up to 50 in MuJoCo). The number of
+    constraint rows is then derived from the contacts dimensions and cone
+    type, with the joint limits, frictional joints and equalities.
+
+    """
+    contacts_per_geom = kwargs.pop('contacts_per_geom', 4)
+    terrain_contacts = kwargs.pop('terrain_contacts', 50)
+    safety = kwargs.pop('safety', 2)
+    minimum = kwargs.pop('minimum', 64)
+    assert not kwargs, kwargs
+
+    # Contacts
+    condim = 1
+    n_geoms = 0
+    n_terrains = 0
+    for geom in mjcf_model.find_all('geom'):
+        colliding = (
+            (geom.contype is None or geom.contype != 0)
+            or (geom.conaffinity is None or geom.conaffinity != 0)
+        )
+        if not colliding:
+            continue
+        if body_is_dynamic(geom.parent):
+            n_geoms += 1
+            condim = max(condim, geom.condim if geom.condim else 3)
+        elif geom.type in ('hfield', 'mesh'):
+            n_terrains += 1
+    pairs = mjcf_model.contact.pair
+    for pair in pairs:
+        condim = max(condim, pair.condim if pair.condim else 3)
+    n_contacts = (
+        contacts_per_geom*(n_geoms + len(pairs))
+        + terrain_contacts*n_geoms*n_terrains
+    )
+
+    # Constraints rows
+    elliptic = mjcf_model.option.cone == 'elliptic'
+    rows_per_contact = condim if elliptic or condim == 1 else 2*(condim-1)
+    joints = mjcf_model.find_all('joint')
+    n_limits = sum(is_true(joint.limited) for joint in joints)
+    n_frictionloss = sum(bool(joint.frictionloss) for joint in joints)
+    n_equality = 6*len(mjcf_model.equality.all_children())
+    n_rows = (
+        n_contacts*rows_per_contact
+        + n_limits + n_frictionloss + n_equality
+    )
+
+    return {
+        'nconmax': max(minimum, int(np.ceil(safety*n_contacts))),
+        'njmax': max(minimum, int(np.ceil(safety*n_rows))),
+    }
+
+
+def calibrate_buffer_sizes(
+        mjcf_model: mjcf.RootElement,
+        n_iterations: int,
+        **kwargs,
+) -> Dict:
+    """Contacts and constraints capacity from a short passive rollout
+
+    The model is compiled with its current sizes and stepped from its
+    first keyframe without control. The peak usage reported by MuJoCo is
+    then scaled by the safety factor.
+
+    """
+    safety = kwargs.pop('safety', 2)
+    minimum = kwargs.pop('minimum', 64)
+    assert not kwargs, kwargs
+    physics = Physics.from_mjcf_model(mjcf_model)
+    if physics.model.nkey:
+        physics.reset(keyframe_id=0)
+    peak = {'ncon': 0, 'nefc': 0}
+    for _ in range(n_iterations):
+        physics.step()
+        peak['ncon'] = max(peak['ncon'], physics.data.ncon)
+        peak['nefc'] = max(peak['nefc'], physics.data.nefc)
+    # Peak usage tracked by MuJoCo, including within the step
+    peak['ncon'] = max(peak['ncon'], getattr(physics.data, 'maxuse_con', 0))
+    peak['nefc'] = max(peak['nefc'], getattr(physics.data, 'maxuse_efc', 0))
+    pylog.debug('Buffers calibration peak usage: %s', peak)
+    return {
+        'nconmax': max(minimum, int(np.ceil(safety*peak['ncon']))),
+        'njmax': max(minimum, int(np.ceil(safety*peak['nefc']))),
+    }
+
+
+def buffers_overflows(physics: Physics) -> Dict[str, int]:
+    """Number of contacts and constraints buffers overflows, by size"""
+    numbers = physics.data.warning.number
+    return {
+        size: int(numbers[warning])
+        for size, warning in BUFFERS_WARNINGS.items()
+        if numbers[warning]
+    }
+
+
+def check_buffers(physics: Physics):
+    """Raise BuffersOverflowError if contacts or constraints buffers are full
+
+    Under dm_control, a full buffer warning raises a PhysicsError during
+    the step, which is not a divergence of the physics and can not be
+    recovered by refining the timestep.
+
+    """
+    overflows = buffers_overflows(physics)
+    if overflows:
+        raise BuffersOverflowError(
+            f'Contacts or constraints buffers full (overflows: {overflows}),'
+            ' increase the buffers sizes with njmax and nconmax in'
+            ' setup_mjcf_xml'
+        )
+
+
+def physics_memory(physics: Physics) -> Dict[str, int]:
+    """Memory allocated by MuJoCo for model and data in bytes"""
+    model, data = physics.model, physics.data
+    memory = {
+        'mjModel': int(getattr(model, 'nbuffer', 0)),
+        'mjData': int(getattr(data, 'nbuffer', 0)),
+    }
+    if hasattr(data, 'narena'):
+        memory['mjData arena'] = int(data.narena)
+    elif hasattr(data, 'nstack'):
+        memory['mjData stack'] = 8*int(data.nstack)  # mjtNum
+    return memory
+
+
+def data_memory(data: AnimatData) -> Dict[str, int]:
+    """Memory used by sensors data buffers in bytes"""
+    return {
+        f'sensors.{name}': getattr(data.sensors, name).array.nbytes
+        for name in ('links', 'joints', 'contacts', 'xfrc', 'muscles')
+        if getattr(data.sensors, name, None) is not None
+    }
+
+
+def callbacks_memory(callbacks: List) -> Dict[str, int]:
+    """Memory used by callbacks buffers, such as video frames, in bytes"""
+    return {
+        f'{type(callback).__name__}[{callback_i}]': callback.data.nbytes
+        for callback_i, callback in enumerate(callbacks)
+        if isinstance(getattr(callback, 'data', None), np.ndarray)
+    }
+
+
+def memory_report(
+        physics: Physics,
+        data: AnimatData = None,
+        callbacks: List = None,
+) -> str:
+    """Memory footprint of simulation buffers"""
+    memory = physics_memory(physics)
+    if data is not None:
+        memory.update(data_memory(data))
+    if callbacks:
+        memory.update(callbacks_memory(callbacks))
+    sizes = ', '.join(
+        f'{name}={getattr(physics.model, name)}'
+        for name in ('nconmax', 'njmax')
+        if hasattr(physics.model, name)
+    )
+    lines = [f'Memory footprint ({sizes}):']
+    lines += [
+        f'  {name:<24} {nbytes/2**20:>10.3f} MiB'
+        for name, nbytes in memory.items()
+    ]
+    lines.append(
+        f'  {"Total":<24} {sum(memory.values())/2**20:>10.3f} MiB'
+    )
+    return '\n'.join(lines)
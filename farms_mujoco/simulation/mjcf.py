@@ -1,20 +1,21 @@
 """MJCF handling"""
 
+import io
 import os
-import xml.dom.minidom
+import hashlib
 import xml.etree.ElementTree as ET
-from typing import Dict
+from xml.sax.saxutils import escape
+from typing import Dict, List, TextIO, Tuple
 
 import numpy as np
-import trimesh as tri
-import pywavefront as pwf
-from imageio import imread
-from scipy.spatial.transform import Rotation
+# NOTE: trimesh, pywavefront and scipy are imported where they are needed to
+# avoid loading them in processes which do not build models from SDF
 
 from dm_control import mjcf
 
 from farms_core import pylog
 from farms_core.units import SimulationUnitScaling
+from farms_core.model.options import AnimatOptions
 from farms_core.simulation.options import SimulationOptions
 from farms_core.array.types import (
     NDARRAY_3,
@@ -30,9 +31,30 @@ from farms_core.io.sdf import (
     Box, Cylinder, Capsule, Sphere, Plane, Heightmap,
 )
 
+from .terrain import TiledHeightfield, read_heightmap, heightmap_source
+from .memory import (
+    BUFFERS_SIZES,
+    estimate_buffer_sizes,
+    calibrate_buffer_sizes,
+)
+
 
 MIN_MASS = 0  # 1e-6
 MIN_INERTIA = 0  # 1e-12
+# Number of qpos and qvel of joints types, 1 for hinge and slide joints
+JOINTS_DIMENSIONS = {'free': (7, 6), 'ball': (4, 3)}
+XML_ATTRIBUTE_ENTITIES = {'"': '&quot;', '\n': '&#10;', '\t': '&#9;'}
+
+
+def joints_dimensions(joints: List[mjcf.Element]) -> Tuple[int, int]:
+    """Number of qpos and qvel of joints, including freejoints"""
+    nq, nv = 0, 0
+    for joint in joints:
+        joint_type = 'free' if joint.tag == 'freejoint' else joint.type
+        joint_nq, joint_nv = JOINTS_DIMENSIONS.get(joint_type, (1, 1))
+        nq += joint_nq
+        nv += joint_nv
+    return nq, nv
 
 
 def quat2mjcquat(quat: NDARRAY_6) -> NDARRAY_4:
@@ -44,6 +66,7 @@ def quat2mjcquat(quat: NDARRAY_6) -> NDARRAY_4:
 
 def euler2mjcquat(euler: NDARRAY_3) -> NDARRAY_4:
     """Euler to MuJoCo quaternion"""
+    from scipy.spatial.transform import Rotation
     return quat2mjcquat(Rotation.from_euler(
         angles=euler,
         seq='xyz',
@@ -52,6 +75,7 @@ def euler2mjcquat(euler: NDARRAY_3) -> NDARRAY_4:
 
 def euler2mat(euler: NDARRAY_3) -> NDARRAY_33:
     """Euler to 3D matrix"""
+    from scipy.spatial.transform import Rotation
     return Rotation.from_euler(
         angles=euler,
         seq='xyz',
@@ -74,6 +98,7 @@ def get_local_transform(
         child_pose: NDARRAY_6,
 ):
     """Get link local transform"""
+    from scipy.spatial.transform import Rotation
     parent_transform = (
         np.eye(4)
         if parent_pose is None
@@ -127,6 +152,122 @@ def grid_material(mjcf_model: mjcf.Element) -> (mjcf.Element, mjcf.Element):
     return material, texture
 
 
+def file_digest(registry: Dict, path: str) -> str:
+    """SHA1 digest of file contents, cached in registry"""
+    if path not in registry['digests']:
+        with open(path, 'rb') as stream:
+            registry['digests'][path] = hashlib.sha1(stream.read()).hexdigest()
+    return registry['digests'][path]
+
+
+def scale_key(scale) -> tuple:
+    """Hashable mesh scale"""
+    return tuple(
+        np.round(np.asarray(scale if scale is not None else [1, 1, 1]), 12)
+    )
+
+
+def assets_registry(mjcf_model: mjcf.RootElement) -> Dict:
+    """Registry of model mesh and material assets for deduplication"""
+    registry = {'meshes': {}, 'materials': {}, 'convex': {}, 'digests': {}}
+    for mesh in mjcf_model.asset.mesh:
+        contents = getattr(mesh.file, 'contents', None)
+        if contents is not None:
+            registry['meshes'].setdefault(
+                (hashlib.sha1(contents).hexdigest(), scale_key(mesh.scale)),
+                mesh.name,
+            )
+    for material in mjcf_model.asset.material:
+        if material.texture is None and material.rgba is not None:
+            registry['materials'].setdefault(
+                tuple(float(value) for value in material.rgba),
+                material.name,
+            )
+    return registry
+
+
+def add_mesh_asset(
+        mjcf_model: mjcf.RootElement,
+        registry: Dict,
+        name: str,
+        path: str,
+        scale: NDARRAY_3,
+) -> str:
+    """Add mesh asset unless identical one exists, returns asset name"""
+    key = (file_digest(registry, path), scale_key(scale))
+    if key not in registry['meshes']:
+        mjcf_model.asset.add('mesh', name=name, file=path, scale=scale)
+        registry['meshes'][key] = name
+    return registry['meshes'][key]
+
+
+def add_material_asset(
+        mjcf_model: mjcf.RootElement,
+        registry: Dict,
+        name: str,
+        rgba: NDARRAY_4,
+) -> str:
+    """Add material asset unless identical one exists, returns asset name"""
+    key = tuple(float(value) for value in rgba)
+    if key not in registry['materials']:
+        mjcf_model.asset.add('material', name=name, rgba=rgba)
+        registry['materials'][key] = name
+    return registry['materials'][key]
+
+
+def convex_decomposition(mesh_path: str) -> List[str]:
+    """Convex decomposition of concave mesh, returns paths of convex parts"""
+    import trimesh as tri
+    mesh = tri.load_mesh(mesh_path)
+    if tri.convex.is_convex(mesh):
+        return []
+    pylog.info('Convexifying %s', mesh_path)
+    meshes = tri.interfaces.vhacd.convex_decomposition(
+        mesh,
+        # Original parameters
+        # resolution=100000,
+        # concavity=0.001,
+        # planeDownsampling=4,
+        # convexhullDownsampling=4,
+        # alpha=0.05,
+        # beta=0.05,
+        # maxhulls=1024,
+        # pca=0,
+        # mode=0,
+        # maxNumVerticesPerCH=64,
+        # minVolumePerCH=0.0001,
+        # convexhullApproximation=1,
+        # oclAcceleration=1,
+        # oclPlatformId=0,
+        # oclDevideID=0,
+        # Parameters
+        resolution=int(1e5),
+        concavity=1e-6,
+        planeDownsampling=4,
+        convexhullDownsampling=4,
+        alpha=0.05,
+        beta=0.05,
+        gamma=0.00125,
+        delta=0.05,
+        maxhulls=1024,
+        pca=0,
+        mode=0,
+        maxNumVerticesPerCH=1024,
+        minVolumePerCH=1e-6,
+        convexhullApproximation=1,
+        oclAcceleration=1,
+    )
+    pylog.info('Convex decomposiion complete')
+    original_path, extension = os.path.splitext(mesh_path)
+    paths = []
+    for mesh_i, mesh in enumerate(meshes):
+        path = f'{original_path}_convex_{mesh_i}{extension}'
+        pylog.info('Exporting %s', path)
+        mesh.export(path)
+        paths.append(path)
+    return paths
+
+
 def mjc_add_link(
         mjcf_model: mjcf.RootElement,
         mjcf_map: Dict,
@@ -151,7 +292,12 @@ def mjc_add_link(
     obj_use_composite = kwargs.pop('obj_use_composite', True)
     # NOTE: obj_use_composite seems to be needed for Wavefront meshes which are
     # not watertight or have disconnected parts.
+    heightfield_window = kwargs.pop('heightfield_window', None)
+    prefix = kwargs.pop('prefix', '')
     assert not kwargs, kwargs
+    if 'assets' not in mjcf_map:
+        mjcf_map['assets'] = assets_registry(mjcf_model)
+    registry = mjcf_map['assets']
 
     # Links (bodies)
     link_name = sdf_link.name
@@ -163,7 +309,7 @@ def mjc_add_link(
     )
     body = mjcf_model.worldbody if link_name == 'world' else mjc_parent.add(
         'body',
-        name=link_name,
+        name=f'{prefix}{link_name}',
         pos=[pos*units.meters for pos in link_local_pos],
         quat=euler2mjcquat(link_local_euler),
     )
@@ -173,13 +319,13 @@ def mjc_add_link(
     joint = None
     if isinstance(sdf_link, ModelSDF):
         if free:  # Freejoint
-            joint = body.add('freejoint', name=f'root_{link_name}')
+            joint = body.add('freejoint', name=f'{prefix}root_{link_name}')
         return body, joint
     if not free and sdf_joint is not None:
         if sdf_joint.type in ('revolute', 'continuous'):
             joint = body.add(
                 'joint',
-                name=sdf_joint.name,
+                name=f'{prefix}{sdf_joint.name}',
                 axis=sdf_joint.axis.xyz,
                 pos=[pos*units.meters for pos in sdf_joint.pose[:3]],
                 # euler=sdf_joint.pose[3:],  # Euler not supported in joint
@@ -195,7 +341,7 @@ def mjc_add_link(
         elif sdf_joint.type in ('prismatic'):
             joint = body.add(
                 'joint',
-                name=sdf_joint.name,
+                name=f'{prefix}{sdf_joint.name}',
                 axis=sdf_joint.axis.xyz,
                 pos=[pos*units.meters for pos in sdf_joint.pose[:3]],
                 # euler=sdf_joint.pose[3:],  # Euler not supported in joint
@@ -214,7 +360,7 @@ def mjc_add_link(
         site = body.add(
             'site',
             type='box',
-            name=f'site_{link_name}',
+            name=f'site_{prefix}{link_name}',
             group=4,
             pos=[0, 0, 0],
             quat=[1, 0, 0, 0],
@@ -231,18 +377,18 @@ def mjc_add_link(
         visual_kwargs = {}
         collision_kwargs = {}
         geom_kwargs = {
-            'name': element.name,
+            'name': f'{prefix}{element.name}',
             'pos': [pos*units.meters for pos in element.pose[:3]],
             'quat': euler2mjcquat(element.pose[3:]),
         }
         if isinstance(element, Visual):
             if element.color is not None:
-                mjcf_model.asset.add(  # Add material to assets
-                    'material',
-                    name=f'material_{element.name}',
+                visual_kwargs['material'] = add_material_asset(
+                    mjcf_model=mjcf_model,
+                    registry=registry,
+                    name=f'material_{prefix}{element.name}',
                     rgba=element.color,
                 )
-                visual_kwargs['material'] = f'material_{element.name}'
             visual_kwargs['conaffinity'] = 0  # No self-collisions
             visual_kwargs['contype'] = 0  # No world collisions
             visual_kwargs['group'] = 1
@@ -283,6 +429,7 @@ def mjc_add_link(
                     extension = '.stl'
                     new_path = f'{path}.stl'
                 if overwrite or not os.path.isfile(new_path):
+                    import trimesh as tri
                     mesh = tri.load_mesh(mesh_path)
                     if isinstance(mesh, tri.Scene):
                         mesh = tri.util.concatenate(tuple(
@@ -300,6 +447,7 @@ def mjc_add_link(
 
             # Wavefront textures
             if extension == '.obj':
+                import pywavefront as pwf
                 wavefront = pwf.Wavefront(mesh_path)
                 for mat_id, mat in wavefront.materials.items():
                     if mat.texture is None:
@@ -324,86 +472,45 @@ def mjc_add_link(
                         )
                     geom_kwargs['material'] = f'material_{mat_id}'
 
-            # Convexify
-            mesh = tri.load_mesh(mesh_path)
-            if (
-                    isinstance(element, Collision)
-                    and concave
-                    and not tri.convex.is_convex(mesh)
-            ):
-                pylog.info('Convexifying %s', mesh_path)
-                meshes = tri.interfaces.vhacd.convex_decomposition(
-                    mesh,
-                    # Original parameters
-                    # resolution=100000,
-                    # concavity=0.001,
-                    # planeDownsampling=4,
-                    # convexhullDownsampling=4,
-                    # alpha=0.05,
-                    # beta=0.05,
-                    # maxhulls=1024,
-                    # pca=0,
-                    # mode=0,
-                    # maxNumVerticesPerCH=64,
-                    # minVolumePerCH=0.0001,
-                    # convexhullApproximation=1,
-                    # oclAcceleration=1,
-                    # oclPlatformId=0,
-                    # oclDevideID=0,
-                    # Parameters
-                    resolution=int(1e5),
-                    concavity=1e-6,
-                    planeDownsampling=4,
-                    convexhullDownsampling=4,
-                    alpha=0.05,
-                    beta=0.05,
-                    gamma=0.00125,
-                    delta=0.05,
-                    maxhulls=1024,
-                    pca=0,
-                    mode=0,
-                    maxNumVerticesPerCH=1024,
-                    minVolumePerCH=1e-6,
-                    convexhullApproximation=1,
-                    oclAcceleration=1,
-                )
-                pylog.info('Convex decomposiion complete')
-                original_path, extension = os.path.splitext(mesh_path)
+            # Convexify, decompositions are shared between identical meshes
+            scale = [s*units.meters for s in element.geometry.scale]
+            convex_paths = None
+            if isinstance(element, Collision) and concave:
+                digest = file_digest(registry, mesh_path)
+                if digest not in registry['convex']:
+                    registry['convex'][digest] = convex_decomposition(mesh_path)
+                convex_paths = registry['convex'][digest]
+            if convex_paths:
                 name = geom_kwargs['name']
-                for mesh_i, mesh in enumerate(meshes):
-                    path = f'{original_path}_convex_{mesh_i}{extension}'
-                    pylog.info('Exporting and loading %s', path)
-                    mesh.export(path)
-                    mjcf_model.asset.add(
-                        'mesh',
-                        name=f'mesh_{element.name}_convex_{mesh_i}',
-                        file=path,
-                        scale=[s*units.meters for s in element.geometry.scale],
-                    )
+                for mesh_i, path in enumerate(convex_paths):
                     geom_kwargs['name'] = f'{name}_convex_{mesh_i}'
                     _geom = body.add(
                         'geom',
                         type='mesh',
-                        mesh=f'mesh_{element.name}_convex_{mesh_i}',
+                        mesh=add_mesh_asset(
+                            mjcf_model=mjcf_model,
+                            registry=registry,
+                            name=f'mesh_{prefix}{element.name}_convex_{mesh_i}',
+                            path=path,
+                            scale=scale,
+                        ),
                         **geom_kwargs,
                         **visual_kwargs,
                         **collision_kwargs,
                     )
-                    pylog.info('loaded %s', path)
                     if not mesh_i:
                         geom = _geom
             else:
-                # Add mesh asset
-                mjcf_model.asset.add(
-                    'mesh',
-                    name=f'mesh_{element.name}',
-                    file=mesh_path,
-                    scale=[s*units.meters for s in element.geometry.scale],
-                )
                 geom = body.add(
                     'geom',
                     type='mesh',
-                    mesh=f'mesh_{element.name}',
+                    mesh=add_mesh_asset(
+                        mjcf_model=mjcf_model,
+                        registry=registry,
+                        name=f'mesh_{prefix}{element.name}',
+                        path=mesh_path,
+                        scale=scale,
+                    ),
                     **geom_kwargs,
                     **visual_kwargs,
                     **collision_kwargs,
@@ -485,24 +592,35 @@ def mjc_add_link(
             material, _ = grid_material(mjcf_model)
             path = os.path.join(directory, element.geometry.uri)
             assert os.path.isfile(path), path
-            img = imread(path)  # Read PNG image
-            img = img[:, :, 0] if img.ndim == 3 else img[:, :]  # RGB vs Grey
-            vmin, vmax = (np.iinfo(img.dtype).min, np.iinfo(img.dtype).max)
-            img = (img - vmin)/(vmax-vmin)  # Normalize
-            img = np.flip(img, axis=0)  # Cartesian coordinates
+            hfield_size = [
+                0.5*element.geometry.size[0]*units.meters,
+                0.5*element.geometry.size[1]*units.meters,
+                0.5*element.geometry.size[2]*units.meters,
+                element.geometry.size[2]*units.meters,
+            ]
+            if heightfield_window is not None:
+                # Only a window of the terrain is resident in the model
+                tiles = TiledHeightfield(
+                    source=heightmap_source(path, overwrite=overwrite),
+                    size=hfield_size[:2],
+                    window=heightfield_window,
+                )
+                img = None
+                shape = tiles.window
+                hfield_size[:2] = tiles.window_size
+            else:
+                tiles = None
+                img = read_heightmap(path)
+                shape = img.shape
             mjcf_map['hfield'] = {
                 'data': img,
+                'tiles': tiles,
                 'asset': mjcf_model.asset.add(
                     'hfield',
-                    name=element.name,
-                    nrow=img.shape[0],
-                    ncol=img.shape[1],
-                    size=(
-                        0.5*element.geometry.size[0]*units.meters,
-                        0.5*element.geometry.size[1]*units.meters,
-                        0.5*element.geometry.size[2]*units.meters,
-                        element.geometry.size[2]*units.meters,
-                    )
+                    name=f'{prefix}{element.name}',
+                    nrow=shape[0],
+                    ncol=shape[1],
+                    size=hfield_size,
                 )
             }
             # geom_kwargs['pos'] += mjcf_map['hfield']['asset'].size[:3]
@@ -517,6 +635,7 @@ def mjc_add_link(
                 **visual_kwargs,
                 **collision_kwargs,
             )
+            mjcf_map['hfield']['geom'] = geom
 
         else:
             raise NotImplementedError(
@@ -649,6 +768,7 @@ def sdf2mjcf(
 
     mjcf_model = kwargs.pop('mjcf_model', None)
     model_name = kwargs.pop('model_name', None)
+    prefix = kwargs.pop('prefix', '')
     fixed_base = kwargs.pop('fixed_base', False)
     concave = kwargs.pop('concave', False)
     use_site = kwargs.pop('use_site', False)
@@ -708,6 +828,7 @@ def sdf2mjcf(
                 'actuators', 'tendons', 'muscles'
         ]
     }
+    mjcf_map['assets'] = assets_registry(mjcf_model)
 
     # Add model root link
     mjc_add_link(
@@ -719,6 +840,7 @@ def sdf2mjcf(
         directory=sdf.directory,
         free=not fixed_base,
         mjc_parent=None,
+        prefix=prefix,
         **kwargs,
     )
 
@@ -734,15 +856,19 @@ def sdf2mjcf(
             use_site=use_site,
             concave=concave,
             units=units,
+            prefix=prefix,
             **kwargs
         )
 
-    # Keyframes
+    # Keyframes, only the joints of this model which are appended to any
+    # existing keyframe from previously added models
     if animat_options is not None:
         joint_options = animat_options.morphology.joints
         joint_name_index = {
             joint.name: index
-            for index, joint in enumerate(mjcf_model.find_all('joint'))
+            for index, joint in enumerate(
+                mjcf_map['links'][sdf.name].find_all('joint')
+            )
         }
         # Check if base is fixed
         if not animat_options.mujoco.get('fixed_base', False):
@@ -755,7 +881,7 @@ def sdf2mjcf(
         qpos = ['0.0']*(len(joint_name_index) + base_nq)
         qvel = ['0.0']*(len(joint_name_index) + base_nv)
         for joint in joint_options:
-            index = joint_name_index[joint.name]
+            index = joint_name_index[f'{prefix}{joint.name}']
             qpos[index+base_nq], qvel[index+base_nv] = (
                 str(joint.initial[0]), str(joint.initial[1])
             )
@@ -776,13 +902,29 @@ def sdf2mjcf(
                 for ang_vel in animat_options.spawn.velocity[3:6]
             ]
 
-        mjcf_model.keyframe.add(
-            "key",
-            name="initial",
-            time=0.0,
-            qpos=" ".join(qpos),
-            qvel=" ".join(qvel)
-        )
+        keyframes = [
+            key for key in mjcf_model.keyframe.key
+            if key.name == 'initial'
+        ]
+        if keyframes:
+            keyframes[0].qpos = np.concatenate([
+                keyframes[0].qpos,
+                np.array(qpos, dtype=float),
+            ])
+            keyframes[0].qvel = np.concatenate([
+                keyframes[0].qvel,
+                np.array(qvel, dtype=float),
+            ])
+        else:
+            # Joints from previously added models without keyframe
+            nq, nv = joints_dimensions(mjcf_model.find_all('joint'))
+            mjcf_model.keyframe.add(
+                "key",
+                name="initial",
+                time=0.0,
+                qpos=" ".join(['0.0']*(nq - len(qpos)) + qpos),
+                qvel=" ".join(['0.0']*(nv - len(qvel)) + qvel)
+            )
 
     # Actuators
     if use_actuators:
@@ -797,7 +939,7 @@ def sdf2mjcf(
                 for motor in animat_options.control.motors
             }
         for joint_name in joints_names:
-            joint = mjcf_model.find('joint', joint_name)
+            joint = mjcf_model.find('joint', f'{prefix}{joint_name}')
             assert joint, (
                 f'Joint "{joint_name}" required by animat options'
                 ' not found in newly created MJCF file.'
@@ -813,11 +955,11 @@ def sdf2mjcf(
             #     name=f'act_pos_{joint_name}',
             #     joint=joint_name,
             # )
-            name_pos = f'actuator_position_{joint_name}'
+            name_pos = f'actuator_position_{prefix}{joint_name}'
             mjcf_map['actuators'][name_pos] = mjcf_model.actuator.add(
                 'position',
                 name=name_pos,
-                joint=joint_name,
+                joint=joint.name,
                 kp=(
                     motors_ctrl[joint_name].gains[0]*units.torques
                     if animat_options and motors_ctrl[joint_name].gains
@@ -828,11 +970,11 @@ def sdf2mjcf(
                 forcelimited=act_pos_forcelimited,
                 forcerange=[val*units.torques for val in act_pos_forcerange],
             )
-            name_vel = f'actuator_velocity_{joint_name}'
+            name_vel = f'actuator_velocity_{prefix}{joint_name}'
             mjcf_map['actuators'][name_vel] = mjcf_model.actuator.add(
                 'velocity',
                 name=name_vel,
-                joint=joint_name,
+                joint=joint.name,
                 kv=(
                     motors_ctrl[joint_name].gains[1]*units.angular_damping
                     if animat_options and motors_ctrl[joint_name].gains
@@ -843,11 +985,11 @@ def sdf2mjcf(
                 forcelimited=act_vel_forcelimited,
                 forcerange=[val*units.torques for val in act_vel_forcerange],
             )
-            name_trq = f'actuator_torque_{joint_name}'
+            name_trq = f'actuator_torque_{prefix}{joint_name}'
             mjcf_map['actuators'][name_trq] = mjcf_model.actuator.add(
                 'motor',
                 name=name_trq,
-                joint=joint_name,
+                joint=joint.name,
             )
             if (
                     animat_options is not None
@@ -866,7 +1008,7 @@ def sdf2mjcf(
             # Add sites from muscle config file
             for muscle in animat_options.control.hill_muscles:
                 # Add tendon
-                tendon_name = f'{muscle.name}'
+                tendon_name = f'{prefix}{muscle.name}'
                 mjcf_map['tendons'][tendon_name] = mjcf_model.tendon.add(
                     "spatial",
                     name=tendon_name,
@@ -875,7 +1017,7 @@ def sdf2mjcf(
                     rgba=[0.0, 0.0, 1.0, 1],
                 )
                 # Add actuator
-                muscle_name = f'{muscle.name}'
+                muscle_name = f'{prefix}{muscle.name}'
                 prms = [
                     muscle['max_force']*units.newtons,
                     muscle['optimal_fiber']*units.meters,
@@ -928,7 +1070,10 @@ def sdf2mjcf(
                     body_name = waypoint[0]
                     position = [pos*units.meters for pos in waypoint[1]]
                     # Add sites
-                    body = mjcf_model.worldbody.find('body', body_name)
+                    body = mjcf_model.worldbody.find(
+                        'body',
+                        f'{prefix}{body_name}',
+                    )
                     site_name = f'{muscle_name}_P{pindex}'
                     body.add(
                         'site',
@@ -951,23 +1096,23 @@ def sdf2mjcf(
                 for link_sensor in ('framepos', 'framequat'):
                     mjcf_model.sensor.add(
                         link_sensor,
-                        name=f'{link_sensor}_{link_name}',
-                        objname=link_name,
+                        name=f'{link_sensor}_{prefix}{link_name}',
+                        objname=f'{prefix}{link_name}',
                         objtype='body',
                     )
                 if use_site:
                     for link_sensor in ('touch',):  # 'velocimeter', 'gyro',
                         mjcf_model.sensor.add(
                             link_sensor,
-                            name=f'{link_sensor}_{link_name}',
-                            site=f'site_{link_name}',
+                            name=f'{link_sensor}_{prefix}{link_name}',
+                            site=f'site_{prefix}{link_name}',
                         )
             if use_link_vel_sensors:
                 for link_sensor in ('framelinvel', 'frameangvel'):
                     mjcf_model.sensor.add(
                         link_sensor,
-                        name=f'{link_sensor}_{link_name}',
-                        objname=link_name,
+                        name=f'{link_sensor}_{prefix}{link_name}',
+                        objname=f'{prefix}{link_name}',
                         objtype='body',
                     )
 
@@ -976,8 +1121,8 @@ def sdf2mjcf(
                 for joint_sensor in ('jointpos', 'jointvel', 'jointlimitfrc'):
                     mjcf_model.sensor.add(
                         joint_sensor,
-                        name=f'{joint_sensor}_{joint_name}',
-                        joint=joint_name,
+                        name=f'{joint_sensor}_{prefix}{joint_name}',
+                        joint=f'{prefix}{joint_name}',
                     )
 
         if use_frc_trq_sensors:
@@ -985,7 +1130,7 @@ def sdf2mjcf(
                 for joint_sensor in ('force', 'torque'):
                     mjcf_model.sensor.add(
                         joint_sensor,
-                        name=f'{joint_sensor}_{joint_name}',
+                        name=f'{joint_sensor}_{prefix}{joint_name}',
                         site=joint.parent.site[0]
                     )
 
@@ -1008,7 +1153,7 @@ def sdf2mjcf(
     # Contacts
     if animat_options is not None:
         collision_map = {
-            link.name: [col.name for col in link.collisions]
+            link.name: [f'{prefix}{col.name}' for col in link.collisions]
             for link in sdf.links
         }
         pair_options = {}
@@ -1021,7 +1166,7 @@ def sdf2mjcf(
                 for col2_i, col2_name in enumerate(collision_map[link2]):
                     mjcf_model.contact.add(
                         'pair',
-                        name=f'contact_pair_{pair_i}_{col1_i}_{col2_i}',
+                        name=f'contact_pair_{prefix}{pair_i}_{col1_i}_{col2_i}',
                         geom1=col1_name,
                         geom2=col2_name,
                         condim=3,
@@ -1032,27 +1177,83 @@ def sdf2mjcf(
     return mjcf_model, mjcf_map
 
 
-def mjcf2str(
+def write_xml(
+        xml_element: ET.Element,
+        stream: TextIO,
+        indent: str = 2*' ',
+):
+    """Write indented XML to stream in a single pass"""
+    stream.write('<?xml version="1.0" ?>\n')
+    # Iterative depth-first traversal to support deep kinematic chains
+    stack = [(xml_element, 0, False)]
+    while stack:
+        element, level, closing = stack.pop()
+        padding = indent*level
+        if closing:
+            stream.write(f'{padding}</{element.tag}>\n')
+            continue
+        attributes = ''.join(
+            f' {key}="{escape(str(value), XML_ATTRIBUTE_ENTITIES)}"'
+            for key, value in element.attrib.items()
+        )
+        text = element.text.strip() if element.text else ''
+        children = list(element)
+        if not children:
+            stream.write(
+                f'{padding}<{element.tag}{attributes}>'
+                f'{escape(text)}</{element.tag}>\n'
+                if text
+                else f'{padding}<{element.tag}{attributes}/>\n'
+            )
+            continue
+        stream.write(f'{padding}<{element.tag}{attributes}>\n')
+        if text:
+            stream.write(f'{padding}{indent}{escape(text)}\n')
+        stack.append((element, level, True))
+        stack.extend(
+            (child, level+1, False)
+            for child in reversed(children)
+        )
+
+
+def mjcf2xml(
         mjcf_model: mjcf.RootElement,
         remove_temp: bool = True,
-) -> str:
-    """Export to MJCF string"""
-    # XML
+) -> ET.Element:
+    """Export to MJCF XML element"""
     mjcf_xml = mjcf_model.to_xml()
     # Remove unique identifiers from mesh paths
     if remove_temp:
         for mesh in mjcf_xml.find('asset').findall('mesh'):
             mjcf_mesh = mjcf_model.find('mesh', mesh.attrib['name'])
             mesh.attrib['file'] = mjcf_mesh.file.prefix + mjcf_mesh.file.extension
-    # Convert to string
-    xml_str = ET.tostring(
-        mjcf_xml,
-        encoding='utf8',
-        method='xml',
-    ).decode('utf8')
-    dom = xml.dom.minidom.parseString(xml_str)
-    # for asset in mjcf_model.asset
-    return dom.toprettyxml(indent=2*' ')
+    return mjcf_xml
+
+
+def mjcf2file(
+        mjcf_model: mjcf.RootElement,
+        path: str,
+        remove_temp: bool = True,
+):
+    """Export MJCF directly to file"""
+    with open(path, 'w+', encoding='utf-8') as xml_file:
+        write_xml(
+            xml_element=mjcf2xml(mjcf_model=mjcf_model, remove_temp=remove_temp),
+            stream=xml_file,
+        )
+
+
+def mjcf2str(
+        mjcf_model: mjcf.RootElement,
+        remove_temp: bool = True,
+) -> str:
+    """Export to MJCF string"""
+    buffer = io.StringIO()
+    write_xml(
+        xml_element=mjcf2xml(mjcf_model=mjcf_model, remove_temp=remove_temp),
+        stream=buffer,
+    )
+    return buffer.getvalue()
 
 
 def night_sky(mjcf_model: mjcf.RootElement):
@@ -1102,14 +1303,19 @@ def add_particles(mjcf_model: mjcf.RootElement):
     composite.geom.rgba = [0.8, 0.2, 0.1, 1.0]
 
 
-def add_lights(link: mjcf.RootElement, rot: NDARRAY_3 = None):
+def add_lights(
+        link: mjcf.RootElement,
+        rot: NDARRAY_3 = None,
+        name: str = 'light_animat',
+):
     """Add lights"""
+    from scipy.spatial.transform import Rotation
     if rot is None:
         rot = [0, 0, 0]
     rot_inv = Rotation.from_euler(angles=rot, seq='xyz').inv()
     link.add(
         'light',
-        name='light_animat',
+        name=name,
         mode='trackcom',  # 'targetbody'
         active=str(True).lower(),
         pos=rot_inv.as_matrix() @ [-1, 1, 3],
@@ -1132,6 +1338,7 @@ def add_cameras(
         simulation_options: SimulationOptions = None,
 ):
     """Add cameras"""
+    from scipy.spatial.transform import Rotation
     if rot is None:
         rot = [0, 0, 0]
     rot_inv = Rotation.from_euler(angles=rot, seq='xyz').inv()
@@ -1168,14 +1375,155 @@ def add_cameras(
         )
 
 
+def add_animat(
+        mjcf_model: mjcf.RootElement,
+        animat_options: AnimatOptions,
+        **kwargs,
+) -> mjcf.Element:
+    """Add animat to model and return its base link"""
+    simulation_options = kwargs.pop('simulation_options', None)
+    units = kwargs.pop('units', (
+        simulation_options.units
+        if simulation_options is not None
+        else SimulationUnitScaling()
+    ))
+    prefix = kwargs.pop('prefix', '')
+    assert not kwargs, kwargs
+
+    # Animat
+    mujoco_kwargs = animat_options.mujoco if animat_options is not None else {}
+    sdf_animat = ModelSDF.read(os.path.expandvars(animat_options.sdf))[0]
+    mjcf_model, _ = sdf2mjcf(
+        sdf=sdf_animat,
+        mjcf_model=mjcf_model,
+        model_name=animat_options.name,
+        prefix=prefix,
+        use_sensors=True,
+        use_link_sensors=False,
+        use_link_vel_sensors=True,
+        use_joint_sensors=True,
+        use_actuators=True,
+        animat_options=animat_options,
+        simulation_options=simulation_options,
+        **mujoco_kwargs,
+    )
+    base_link = mjcf_model.find(
+        namespace='body',
+        identifier=f'{prefix}{sdf_animat.name}',
+    )
+
+    # Animat options
+    if animat_options is not None:
+
+        # Spawn
+        animat_spawn = animat_options.spawn
+        base_link.pos = [pos*units.meters for pos in animat_spawn.pose[:3]]
+        base_link.quat = euler2mjcquat(animat_spawn.pose[3:])
+
+        # Links
+        for link in animat_options.morphology.links:
+            mjcf_link = mjcf_model.find(
+                namespace='body',
+                identifier=f'{prefix}{link.name}',
+            )
+            assert mjcf_link, f'Link {link.name} not found'
+            for geom in mjcf_link.geom:
+                if geom.contype:
+                    assert len(link.friction) == 3, len(geom.friction)
+                    assert len(geom.friction) == 3, len(geom.friction)
+                    geom.friction = link.friction
+                    geom.fluidshape = None
+                    geom.fluidcoef = [0, 0, 0, 0, 0]
+
+        # Joints
+        for joint_options in animat_options.morphology.joints:
+            joint = mjcf_model.find(
+                namespace='joint',
+                identifier=f'{prefix}{joint_options.name}',
+            )
+            joint.stiffness += joint_options.stiffness*units.angular_stiffness
+            joint.damping += joint_options.damping*units.angular_damping
+            if _solreflimit := joint_options.extras.get('solreflimit'):
+                # Copied since options can be shared by several animats
+                _solreflimit = list(_solreflimit)
+                if all(sol < 0 for sol in _solreflimit):
+                    _solreflimit[0] *= units.newtons/units.meters
+                    _solreflimit[1] *= units.newtons/units.velocity
+                else:
+                    _solreflimit[0] *= units.seconds
+                joint.solreflimit = _solreflimit
+            if _solimplimit := joint_options.extras.get('solimplimit'):
+                joint.solimplimit = _solimplimit
+            if _margin := joint_options.extras.get('margin'):
+                joint.margin = _margin # radians
+
+        # Joints control
+        joints_equations = {}
+        for motor_options in animat_options.control.motors:
+            if not hasattr(motor_options, 'equation'):
+                continue
+            joint = mjcf_model.find(
+                namespace='joint',
+                identifier=f'{prefix}{motor_options.joint_name}',
+            )
+            joints_equations[motor_options.joint_name] = motor_options.equation
+            if motor_options.passive.is_passive:
+                joint.stiffness += (
+                    motor_options.passive.stiffness_coefficient
+                )*units.angular_stiffness
+                joint.damping += (
+                    motor_options.passive.damping_coefficient
+                )*units.angular_damping
+
+        # Muscles
+        if (
+                hasattr(animat_options.control, 'muscles')
+                and animat_options.control.muscles is not None
+        ):
+            for muscle_options in animat_options.control.muscles:
+                joint = mjcf_model.find(
+                    namespace='joint',
+                    identifier=f'{prefix}{muscle_options.joint_name}',
+                )
+                assert joint, f'Joint {muscle_options.joint_name} not found'
+                if 'ekeberg' in joints_equations[muscle_options.joint_name]:
+                    joint.stiffness += (
+                        muscle_options.beta*muscle_options.gamma
+                    )*units.angular_stiffness
+                    joint.damping += (
+                        muscle_options.delta
+                    )*units.angular_damping
+
+    return base_link
+
+
 def setup_mjcf_xml(**kwargs) -> (mjcf.RootElement, mjcf.RootElement, Dict):
-    """Setup MJCF XML"""
+    """Setup MJCF XML
+
+    If a list of animat options is provided, the animats are all added to
+    the same model with their elements names prefixed by the corresponding
+    prefixes, and the list of base links is returned instead.
+
+    """
 
     hfield = None
     mjcf_model = None
     simulation_options = kwargs.pop('simulation_options', None)
-    animat_options = kwargs.pop('animat_options', None)
+    animats_options = kwargs.pop('animat_options', None)
+    population = isinstance(animats_options, (list, tuple))
+    if not population:
+        animats_options = [animats_options]
+    prefixes = kwargs.pop('prefixes', (
+        [f'animat{index}_' for index in range(len(animats_options))]
+        if population
+        else ['']
+    ))
+    assert len(prefixes) == len(animats_options), (
+        f'{len(prefixes)=} != {len(animats_options)=}'
+    )
+    assert len(set(prefixes)) == len(prefixes), f'Duplicate in {prefixes=}'
     arena_options = kwargs.pop('arena_options', None)
+    heightfield_window = kwargs.pop('heightfield_window', None)
     units = kwargs.pop('units', (
         simulation_options.units
         if simulation_options is not None
@@ -1198,6 +1546,7 @@ def setup_mjcf_xml(**kwargs) -> (mjcf.RootElement, mjcf.RootElement, Dict):
         simulation_options=simulation_options,
         friction=[0, 0, 0],
         all_collisions=True,
+        heightfield_window=heightfield_window,
     )
     if 'hfield' in info:
         hfield = info['hfield']
@@ -1222,22 +1571,17 @@ def setup_mjcf_xml(**kwargs) -> (mjcf.RootElement, mjcf.RootElement, Dict):
         water.quat = [1, 0, 0, 0]
     # add_plane(mjcf_model)
 
-    # Animat
-    mujoco_kwargs = animat_options.mujoco if animat_options is not None else {}
-    sdf_animat = ModelSDF.read(os.path.expandvars(animat_options.sdf))[0]
-    mjcf_model, _ = sdf2mjcf(
-        sdf=sdf_animat,
-        mjcf_model=mjcf_model,
-        model_name=animat_options.name,
-        use_sensors=True,
-        use_link_sensors=False,
-        use_link_vel_sensors=True,
-        use_joint_sensors=True,
-        use_actuators=True,
-        animat_options=animat_options,
-        simulation_options=simulation_options,
-        **mujoco_kwargs,
-    )
+    # Animats
+    base_links = [
+        add_animat(
+            mjcf_model=mjcf_model,
+            animat_options=options,
+            simulation_options=simulation_options,
+            units=units,
+            prefix=prefix,
+        )
+        for options, prefix in zip(animats_options, prefixes)
+    ]
 
     # Compiler
     mjcf_model.compiler.angle = 'radian'
@@ -1321,8 +1665,6 @@ def setup_mjcf_xml(**kwargs) -> (mjcf.RootElement, mjcf.RootElement, Dict):
 
     # Simulation options
     mjcf_model.size.nkey = 1
-    mjcf_model.size.njmax = 2**12  # 4096
-    mjcf_model.size.nconmax = 2**12  # 4096
     mjcf_model.option.timestep = timestep
     mjcf_model.option.impratio = kwargs.pop(
         'impratio',
@@ -1385,111 +1727,75 @@ def setup_mjcf_xml(**kwargs) -> (mjcf.RootElement, mjcf.RootElement, Dict):
         else 1e-6,
     )
 
-    # Animat options
-    if animat_options is not None:
-
-        # Spawn
-        animat_spawn = animat_options.spawn
-        base_link = mjcf_model.find(namespace='body', identifier=sdf_animat.name)
-        base_link.pos = [pos*units.meters for pos in animat_spawn.pose[:3]]
-        base_link.quat = euler2mjcquat(animat_spawn.pose[3:])
-
-        # Links
-        for link in animat_options.morphology.links:
-            mjcf_link = mjcf_model.find(namespace='body', identifier=link.name)
-            assert mjcf_link, f'Link {link.name} not found'
-            for geom in mjcf_link.geom:
-                if geom.contype:
-                    assert len(link.friction) == 3, len(geom.friction)
-                    assert len(geom.friction) == 3, len(geom.friction)
-                    geom.friction = link.friction
-                    geom.fluidshape = None
-                    geom.fluidcoef = [0, 0, 0, 0, 0]
-
-        # Joints
-        for joint_options in animat_options.morphology.joints:
-            joint = mjcf_model.find(
-                namespace='joint',
-                identifier=joint_options.name,
-            )
-            joint.stiffness += joint_options.stiffness*units.angular_stiffness
-            joint.damping += joint_options.damping*units.angular_damping
-            if _solreflimit := joint_options.extras.get('solreflimit'):
-                if all(sol < 0 for sol in _solreflimit):
-                    _solreflimit[0] *= units.newtons/units.meters
-                    _solreflimit[1] *= units.newtons/units.velocity
-                else:
-                    _solreflimit[0] *= units.seconds
-                joint.solreflimit = joint_options.extras['solreflimit']
-            if _solimplimit := joint_options.extras.get('solimplimit'):
-                joint.solimplimit = _solimplimit
-            if _margin := joint_options.extras.get('margin'):
-                joint.margin = _margin # radians
-
-        # Joints control
-        joints_equations = {}
-        for motor_options in animat_options.control.motors:
-            if not hasattr(motor_options, 'equation'):
-                continue
-            joint = mjcf_model.find(
-                namespace='joint',
-                identifier=motor_options.joint_name,
-            )
-            joints_equations[motor_options.joint_name] = motor_options.equation
-            if motor_options.passive.is_passive:
-                joint.stiffness += (
-                    motor_options.passive.stiffness_coefficient
-                )*units.angular_stiffness
-                joint.damping += (
-                    motor_options.passive.damping_coefficient
-                )*units.angular_damping
-
-        # Muscles
-        if (
-                hasattr(animat_options.control, 'muscles')
-                and animat_options.control.muscles is not None
-        ):
-            for muscle_options in animat_options.control.muscles:
-                joint = mjcf_model.find(
-                    namespace='joint',
-                    identifier=muscle_options.joint_name,
-                )
-                assert joint, f'Joint {muscle_options.joint_name} not found'
-                if 'ekeberg' in joints_equations[muscle_options.joint_name]:
-                    joint.stiffness += (
-                        muscle_options.beta*muscle_options.gamma
-                    )*units.angular_stiffness
-                    joint.damping += (
-                        muscle_options.delta
-                    )*units.angular_damping
-
-
     # Add particles
     if kwargs.pop('use_particles', False):
         add_particles(mjcf_model)
 
-    # Light and shadows
-    add_lights(link=base_link, rot=animat_options.spawn.pose[3:])
+    for base_link, options, prefix in zip(
+            base_links,
+            animats_options,
+            prefixes,
+    ):
+
+        # Light and shadows
+        add_lights(
+            link=base_link,
+            rot=options.spawn.pose[3:],
+            name=f'light_{prefix}animat',
+        )
 
-    # Add cameras
-    add_cameras(
-        link=base_link,
-        rot=animat_options.spawn.pose[3:],
-        simulation_options=simulation_options,
-    )
+        # Add cameras
+        add_cameras(
+            link=base_link,
+            rot=options.spawn.pose[3:],
+            simulation_options=simulation_options,
+        )
 
     # Night sky
     night_sky(mjcf_model)
 
-    # XML string
-    mjcf_xml_str = mjcf2str(mjcf_model=mjcf_model)
+    # Contacts and constraints buffers, fixed unless provided, estimated
+    # from the model or calibrated with a short passive rollout on request
+    buffer_sizes = dict(BUFFERS_SIZES)
+    if kwargs.pop('estimate_buffers', False):
+        buffer_sizes = estimate_buffer_sizes(mjcf_model)
+    calibrate_buffers = kwargs.pop('calibrate_buffers', 0)
+    if calibrate_buffers:
+        estimate = estimate_buffer_sizes(mjcf_model)
+        mjcf_model.size.njmax = 4*max(
+            estimate['njmax'], BUFFERS_SIZES['njmax'],
+        )
+        mjcf_model.size.nconmax = 4*max(
+            estimate['nconmax'], BUFFERS_SIZES['nconmax'],
+        )
+        buffer_sizes = estimate
+        calibrated = calibrate_buffer_sizes(
+            mjcf_model=mjcf_model,
+            n_iterations=calibrate_buffers,
+        )
+        buffer_sizes = {
+            key: max(value, calibrated[key])
+            for key, value in buffer_sizes.items()
+        }
+    mjcf_model.size.njmax = kwargs.pop('njmax', buffer_sizes['njmax'])
+    mjcf_model.size.nconmax = kwargs.pop('nconmax', buffer_sizes['nconmax'])
+    pylog.debug(
+        'Buffers sizes: njmax=%s, nconmax=%s',
+        mjcf_model.size.njmax,
+        mjcf_model.size.nconmax,
+    )
+
+    # XML export, only serialised when requested
     if kwargs.pop('show_mjcf', False):
-        pylog.info(mjcf_xml_str)
+        pylog.info(mjcf2str(mjcf_model=mjcf_model))
     save_mjcf = kwargs.pop('save_mjcf', False)
     if save_mjcf:
         path = save_mjcf if isinstance(save_mjcf, str) else 'simulation_mjcf.xml'
-        with open(path, 'w+', encoding='utf-8') as xml_file:
-            xml_file.write(mjcf_xml_str)
+        mjcf2file(mjcf_model=mjcf_model, path=path)
 
     assert not kwargs, kwargs
-    return mjcf_model, base_link, hfield
+    return (
+        mjcf_model,
+        base_links if population else base_links[0],
+        hfield,
+    )
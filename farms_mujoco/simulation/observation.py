@@ -0,0 +1,156 @@
+"""Observations from animat data"""
+
+from typing import Dict, List
+
+import numpy as np
+from dm_env import specs
+
+from farms_core.model.data import AnimatData
+# pylint: disable=no-name-in-module
+from farms_core.sensors.sensor_convention import sc
+
+
+# Observation fields, as sensors group and index in the sensors convention
+OBSERVATION_FIELDS = {
+    'links_positions': (
+        'links', slice(sc.link_urdf_position_x, sc.link_urdf_position_z+1),
+    ),
+    'links_orientations': (
+        'links',
+        slice(sc.link_urdf_orientation_x, sc.link_urdf_orientation_w+1),
+    ),
+    'links_com_positions': (
+        'links', slice(sc.link_com_position_x, sc.link_com_position_z+1),
+    ),
+    'links_linear_velocities': (
+        'links',
+        slice(sc.link_com_velocity_lin_x, sc.link_com_velocity_lin_z+1),
+    ),
+    'links_angular_velocities': (
+        'links',
+        slice(sc.link_com_velocity_ang_x, sc.link_com_velocity_ang_z+1),
+    ),
+    'joints_positions': ('joints', sc.joint_position),
+    'joints_velocities': ('joints', sc.joint_velocity),
+    'joints_torques': ('joints', sc.joint_torque),
+    'joints_limits_forces': ('joints', sc.joint_limit_force),
+    'contacts_forces': (
+        'contacts', slice(sc.contact_total_x, sc.contact_total_z+1),
+    ),
+    'muscles_forces': ('muscles', sc.muscle_tendon_unit_force),
+}
+
+
+def readonly(array: np.ndarray) -> np.ndarray:
+    """Read-only view of array"""
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+class ObservationPipeline:
+    """Observations as read-only views into the animat data
+
+    Observations are dicts of views of the fields of the animat
+    data buffer slot of the current iteration, no data is copied. The
+    views of each buffer slot are built once and cached, unless the
+    buffer is larger than max_cached_slots, in which case they are built
+    at each step. Views are only valid until the slot is overwritten, they
+    must be copied to be stored.
+
+    """
+
+    def __init__(self, data: AnimatData, fields: List[str], **kwargs):
+        super().__init__()
+        for field in fields:
+            assert field in OBSERVATION_FIELDS, (
+                f'Unknown observation field {field}'
+                f' (available: {list(OBSERVATION_FIELDS)})'
+            )
+        self.data = data
+        self.fields: List[str] = list(fields)
+        self.prefix: str = kwargs.pop('prefix', '')
+        max_cached_slots = kwargs.pop('max_cached_slots', 1024)
+        assert not kwargs, kwargs
+        self._arrays: Dict[str, np.ndarray] = {
+            group: np.asarray(getattr(data.sensors, group).array)
+            for group in {OBSERVATION_FIELDS[field][0] for field in fields}
+        }
+        buffer_size = max(
+            [array.shape[0] for array in self._arrays.values()],
+            default=0,
+        )
+        self._cache: List[Dict] = (
+            [None]*buffer_size
+            if buffer_size <= max_cached_slots
+            else None
+        )
+
+    def views(self, index: int) -> Dict[str, np.ndarray]:
+        """Read-only views of observation fields at buffer slot index"""
+        return {
+            f'{self.prefix}{field}': readonly(
+                self._arrays[OBSERVATION_FIELDS[field][0]][
+                    index, :, OBSERVATION_FIELDS[field][1]
+                ]
+            )
+            for field in self.fields
+        }
+
+    def observation(self, index: int) -> Dict[str, np.ndarray]:
+        """Observation at buffer slot index"""
+        if self._cache is None:
+            return self.views(index)
+        if self._cache[index] is None:
+            self._cache[index] = self.views(index)
+        return self._cache[index]
+
+    def observation_spec(self) -> Dict[str, specs.Array]:
+        """Observation specifications"""
+        return {
+            name: specs.Array(shape=view.shape, dtype=view.dtype, name=name)
+            for name, view in self.views(0).items()
+        }
+
+
+def batch_spec(
+        spec: Dict[str, specs.Array],
+        batch_size: int,
+) -> Dict[str, specs.Array]:
+    """Observation specifications of a batch of environments"""
+    return {
+        name: specs.Array(
+            shape=(batch_size,) + tuple(array_spec.shape),
+            dtype=array_spec.dtype,
+            name=name,
+        )
+        for name, array_spec in spec.items()
+    }
+
+
+class ObservationBatcher:
+    """Batch observations of several environments into preallocated arrays
+
+    Each step copies the observations views of the environments into the
+    same batch arrays, which are returned without further allocation.
+
+    """
+
+    def __init__(self, spec: Dict[str, specs.Array], batch_size: int):
+        super().__init__()
+        self.batch_size: int = batch_size
+        self.spec: Dict[str, specs.Array] = batch_spec(spec, batch_size)
+        self.arrays: Dict[str, np.ndarray] = {
+            name: np.zeros(array_spec.shape, dtype=array_spec.dtype)
+            for name, array_spec in self.spec.items()
+        }
+
+    def batch(self, observations: List[Dict]) -> Dict[str, np.ndarray]:
+        """Copy environments observations into batch arrays"""
+        assert len(observations) == self.batch_size, (
+            f'{len(observations)=} != {self.batch_size=}'
+        )
+        for name, array in self.arrays.items():
+            for env_i, observation in enumerate(observations):
+                array[env_i] = observation[name]
+        return self.arrays
@@ -0,0 +1,434 @@
+"""Patch compiled physics for parameter-only option changes"""
+
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from dm_control.mjcf.physics import Physics
+
+from farms_core.model.options import AnimatOptions
+from farms_core.simulation.options import SimulationOptions
+from farms_core.units import SimulationUnitScaling
+
+from .mjcf import euler2mjcquat
+
+
+# Options values which setup_mjcf_xml copies into mjModel.opt
+OPTION_ENUMS = {
+    'solver': {'PGS': 0, 'CG': 1, 'Newton': 2},
+    'integrator': {'Euler': 0, 'RK4': 1, 'implicit': 2, 'implicitfast': 3},
+    'cone': {'pyramidal': 0, 'elliptic': 1},
+}
+SIMULATION_OPTIONS_PATCHABLE = (
+    'timestep', 'gravity', 'impratio', 'cone', 'solver', 'n_solver_iters',
+    'integrator', 'mpr_iterations', 'mpr_tolerance',
+    'noslip_iterations', 'noslip_tolerance',
+)
+# Simulation options which are compiled into the model structure
+SIMULATION_OPTIONS_STRUCTURAL = (
+    'units', 'num_sub_steps', 'headless', 'video', 'visual_scale',
+    'mujoco_extent', 'video_resolution', 'video_distance', 'video_pitch',
+    'video_yaw', 'video_offset',
+)
+# Simulation options only read at runtime, applied by the simulation
+SIMULATION_OPTIONS_RUNTIME = (
+    'n_iterations', 'play', 'fast', 'show_progress',
+)
+# MuJoCo defaults of the joints limits parameters, used by setup_mjcf_xml
+# when the animat options do not provide them
+JOINTS_LIMITS_DEFAULTS = {
+    'solreflimit': [0.02, 1],
+    'solimplimit': [0.9, 0.95, 0.001, 0.5, 2],
+    'margin': 0,
+}
+# Actuators torque limits of setup_mjcf_xml when the motors options do not
+# provide them, as forcelimited and forcerange before units scaling
+ACTUATORS_TORQUE_DEFAULTS = {
+    'position': (False, [-1e6, 1e6]),
+    'velocity': (False, [-1e6, 1e6]),
+    'torque': (False, [0, 0]),
+}
+# Animat options paths ('*' matches any list index)
+ANIMAT_OPTIONS_PATCHABLE = {
+    'joints': (
+        ('morphology', 'joints', '*', 'stiffness'),
+        ('morphology', 'joints', '*', 'damping'),
+        ('control', 'motors', '*', 'passive', 'stiffness_coefficient'),
+        ('control', 'motors', '*', 'passive', 'damping_coefficient'),
+        ('control', 'muscles', '*', 'beta'),
+        ('control', 'muscles', '*', 'gamma'),
+        ('control', 'muscles', '*', 'delta'),
+    ),
+    'limits': (
+        ('morphology', 'joints', '*', 'extras', 'solreflimit'),
+        ('morphology', 'joints', '*', 'extras', 'solreflimit', '*'),
+        ('morphology', 'joints', '*', 'extras', 'solimplimit'),
+        ('morphology', 'joints', '*', 'extras', 'solimplimit', '*'),
+        ('morphology', 'joints', '*', 'extras', 'margin'),
+    ),
+    'friction': (
+        ('morphology', 'links', '*', 'friction'),
+        ('morphology', 'links', '*', 'friction', '*'),
+    ),
+    'gains': (
+        ('control', 'motors', '*', 'gains'),
+        ('control', 'motors', '*', 'gains', '*'),
+    ),
+    'torque_limits': (
+        ('control', 'motors', '*', 'limits_torque'),
+        ('control', 'motors', '*', 'limits_torque', '*'),
+    ),
+    'keyframe': (
+        ('morphology', 'joints', '*', 'initial'),
+        ('morphology', 'joints', '*', 'initial', '*'),
+        ('spawn', 'pose', 0),
+        ('spawn', 'pose', 1),
+        ('spawn', 'pose', 2),
+        ('spawn', 'velocity'),
+        ('spawn', 'velocity', '*'),
+    ),
+}
+
+
+def options_diff(previous, current, path: Tuple = ()) -> List[Tuple]:
+    """Paths of the values which differ between two options trees"""
+    if isinstance(previous, dict) and isinstance(current, dict):
+        return [
+            diff
+            for key in sorted(set(previous) | set(current), key=str)
+            for diff in (
+                options_diff(previous[key], current[key], path + (key,))
+                if key in previous and key in current
+                else [path + (key,)]
+            )
+        ]
+    if (
+            isinstance(previous, (list, tuple))
+            and isinstance(current, (list, tuple))
+    ):
+        if len(previous) != len(current):
+            return [path]
+        return [
+            diff
+            for index, (prev, curr) in enumerate(zip(previous, current))
+            for diff in options_diff(prev, curr, path + (index,))
+        ]
+    return [] if np.array_equal(previous, current) else [path]
+
+
+def path_match(path: Tuple, pattern: Tuple) -> bool:
+    """Check if options path matches pattern"""
+    return len(path) == len(pattern) and all(
+        expected == '*' and isinstance(key, int) or key == expected
+        for key, expected in zip(path, pattern)
+    )
+
+
+def animat_patch_groups(
+        previous: AnimatOptions,
+        current: AnimatOptions,
+) -> List[str]:
+    """Groups of model parameters to patch for animat options change"""
+    groups = set()
+    for path in options_diff(previous, current):
+        group = next(
+            (
+                group
+                for group, patterns in ANIMAT_OPTIONS_PATCHABLE.items()
+                if any(path_match(path, pattern) for pattern in patterns)
+            ),
+            None,
+        )
+        if group is None:
+            raise ValueError(
+                f'Animat option {"/".join(map(str, path))} is structural,'
+                ' the model must be rebuilt'
+            )
+        groups.add(group)
+    return sorted(groups)
+
+
+def simulation_patch_keys(
+        previous: SimulationOptions,
+        current: SimulationOptions,
+) -> List[str]:
+    """Simulation options to patch for simulation options change"""
+    keys = sorted(
+        {path[0] for path in options_diff(previous, current)},
+        key=str,
+    )
+    for key in keys:
+        if key in SIMULATION_OPTIONS_STRUCTURAL:
+            raise ValueError(
+                f'Simulation option {key} is structural,'
+                ' the model must be rebuilt'
+            )
+        supported = SIMULATION_OPTIONS_PATCHABLE + SIMULATION_OPTIONS_RUNTIME
+        if key not in supported:
+            raise ValueError(
+                f'Simulation option {key} can not be patched,'
+                ' the simulation must be rebuilt'
+            )
+    return [key for key in keys if key in SIMULATION_OPTIONS_PATCHABLE]
+
+
+def physics_set_options(physics: Physics, **kwargs):
+    """Set mjModel.opt values using setup_mjcf_xml keyword names"""
+    opt = physics.model.opt
+    for key, value in kwargs.items():
+        if key in OPTION_ENUMS and isinstance(value, str):
+            value = OPTION_ENUMS[key][value]
+        elif key == 'solver_iterations':
+            key = 'iterations'
+        if key == 'gravity':
+            opt.gravity[:] = value
+        else:
+            setattr(opt, key, value)
+
+
+def joints_passive_parameters(
+        animat_options: AnimatOptions,
+        units: SimulationUnitScaling,
+) -> Dict[str, List[float]]:
+    """Joints stiffness and damping as set by setup_mjcf_xml"""
+    parameters = {
+        joint.name: [
+            joint.stiffness*units.angular_stiffness,
+            joint.damping*units.angular_damping,
+        ]
+        for joint in animat_options.morphology.joints
+    }
+    joints_equations = {}
+    for motor in animat_options.control.motors:
+        if not hasattr(motor, 'equation'):
+            continue
+        joints_equations[motor.joint_name] = motor.equation
+        if motor.passive.is_passive:
+            parameters.setdefault(motor.joint_name, [0.0, 0.0])
+            parameters[motor.joint_name][0] += (
+                motor.passive.stiffness_coefficient
+            )*units.angular_stiffness
+            parameters[motor.joint_name][1] += (
+                motor.passive.damping_coefficient
+            )*units.angular_damping
+    if (
+            hasattr(animat_options.control, 'muscles')
+            and animat_options.control.muscles is not None
+    ):
+        for muscle in animat_options.control.muscles:
+            if 'ekeberg' in joints_equations[muscle.joint_name]:
+                parameters.setdefault(muscle.joint_name, [0.0, 0.0])
+                parameters[muscle.joint_name][0] += (
+                    muscle.beta*muscle.gamma
+                )*units.angular_stiffness
+                parameters[muscle.joint_name][1] += (
+                    muscle.delta
+                )*units.angular_damping
+    return parameters
+
+
+def patch_joints(physics, animat_options, units, prefix=''):
+    """Patch joints stiffness and damping"""
+    named = physics.named.model
+    for name, (stiffness, damping) in joints_passive_parameters(
+            animat_options=animat_options,
+            units=units,
+    ).items():
+        named.jnt_stiffness[f'{prefix}{name}'] = stiffness
+        named.dof_damping[f'{prefix}{name}'] = damping
+
+
+def patch_limits(physics, animat_options, units, prefix=''):
+    """Patch joints limits parameters, removed values are reset to default"""
+    named = physics.named.model
+    for joint in animat_options.morphology.joints:
+        name = f'{prefix}{joint.name}'
+        if solreflimit := joint.extras.get('solreflimit'):
+            solreflimit = list(solreflimit)
+            if all(sol < 0 for sol in solreflimit):
+                solreflimit[0] *= units.newtons/units.meters
+                solreflimit[1] *= units.newtons/units.velocity
+            else:
+                solreflimit[0] *= units.seconds
+            named.jnt_solref[name] = solreflimit
+        else:
+            named.jnt_solref[name] = JOINTS_LIMITS_DEFAULTS['solreflimit']
+        named.jnt_solimp[name] = (
+            joint.extras.get('solimplimit')
+            or JOINTS_LIMITS_DEFAULTS['solimplimit']
+        )
+        named.jnt_margin[name] = (
+            joint.extras.get('margin')
+            or JOINTS_LIMITS_DEFAULTS['margin']
+        )
+
+
+def patch_friction(physics, animat_options, units, prefix=''):
+    """Patch links collisions friction"""
+    # pylint: disable=unused-argument
+    model = physics.model
+    bodies_row = physics.named.model.body_pos.axes.row
+    for link in animat_options.morphology.links:
+        body_id = bodies_row.convert_key_item(f'{prefix}{link.name}')
+        geoms = np.flatnonzero(
+            (model.geom_bodyid == body_id)
+            & (model.geom_contype != 0)
+        )
+        model.geom_friction[geoms] = link.friction
+
+
+def patch_gains(physics, animat_options, units, prefix=''):
+    """Patch position and velocity actuators gains"""
+    named = physics.named.model
+    actuators = named.actuator_gainprm.axes.row.names
+    for motor in animat_options.control.motors:
+        name_pos = f'actuator_position_{prefix}{motor.joint_name}'
+        name_vel = f'actuator_velocity_{prefix}{motor.joint_name}'
+        if name_pos not in actuators:
+            continue
+        kp, kv = (
+            (
+                motor.gains[0]*units.torques,
+                motor.gains[1]*units.angular_damping,
+            )
+            if motor.gains
+            else (0, 0)
+        )
+        named.actuator_gainprm[name_pos, 0] = kp
+        named.actuator_biasprm[name_pos, 1] = -kp
+        named.actuator_gainprm[name_vel, 0] = kv
+        named.actuator_biasprm[name_vel, 2] = -kv
+
+
+def patch_torque_limits(physics, animat_options, units, prefix=''):
+    """Patch actuators torque limits
+
+    Removed torque limits are reset to the defaults of setup_mjcf_xml,
+    see ACTUATORS_TORQUE_DEFAULTS.
+
+    """
+    named = physics.named.model
+    actuators = named.actuator_forcerange.axes.row.names
+    for motor in animat_options.control.motors:
+        for act_type, defaults in ACTUATORS_TORQUE_DEFAULTS.items():
+            name = f'actuator_{act_type}_{prefix}{motor.joint_name}'
+            if name not in actuators:
+                continue
+            forcelimited, forcerange = (
+                (True, motor.limits_torque)
+                if motor.limits_torque is not None
+                else defaults
+            )
+            named.actuator_forcelimited[name] = forcelimited
+            named.actuator_forcerange[name] = [
+                trq*units.torques
+                for trq in forcerange
+            ]
+
+
+def patch_keyframe(physics, animat_options, units, prefix=''):
+    """Patch initial keyframe"""
+    named = physics.named.model
+    for joint in animat_options.morphology.joints:
+        named.key_qpos['initial', f'{prefix}{joint.name}'] = joint.initial[0]
+        named.key_qvel['initial', f'{prefix}{joint.name}'] = joint.initial[1]
+    if animat_options.mujoco.get('fixed_base', False):
+        return
+    jnt_type = named.jnt_type
+    root = next(
+        name
+        for name in jnt_type.axes.row.names
+        if name.startswith(f'{prefix}root_') and jnt_type[name] == 0
+    )
+    spawn = animat_options.spawn
+    named.key_qpos['initial', root] = np.concatenate([
+        [pos*units.meters for pos in spawn.pose[:3]],
+        euler2mjcquat(spawn.pose[3:]),
+    ])
+    named.key_qvel['initial', root] = [
+        vel*units.velocity for vel in spawn.velocity[:3]
+    ] + [
+        ang_vel*units.angular_velocity for ang_vel in spawn.velocity[3:6]
+    ]
+
+
+ANIMAT_PATCHES = {
+    'joints': patch_joints,
+    'limits': patch_limits,
+    'friction': patch_friction,
+    'gains': patch_gains,
+    'torque_limits': patch_torque_limits,
+    'keyframe': patch_keyframe,
+}
+
+
+def patch_physics(physics: Physics, **kwargs):
+    """Write parameter-only option changes into compiled physics
+
+    Compares the previous and new options, and writes the values which
+    setup_mjcf_xml and sdf2mjcf would have copied into the model
+    directly into the mjModel arrays, without rebuilding or recompiling
+    the model. Raises a ValueError if any of the changes is structural.
+    The new keyframe values are used at the next physics reset.
+
+    """
+    animat_options = kwargs.pop('animat_options', None)
+    previous_animat_options = kwargs.pop('previous_animat_options', None)
+    simulation_options = kwargs.pop('simulation_options', None)
+    previous_simulation_options = kwargs.pop(
+        'previous_simulation_options', None,
+    )
+    prefix = kwargs.pop('prefix', '')
+    units = kwargs.pop('units', (
+        simulation_options.units
+        if simulation_options is not None
+        else SimulationUnitScaling()
+    ))
+    assert not kwargs, kwargs
+
+    # Validate all changes before modifying the model
+    simulation_keys = (
+        simulation_patch_keys(
+            previous=previous_simulation_options,
+            current=simulation_options,
+        )
+        if simulation_options is not None
+        else []
+    )
+    animat_groups = (
+        animat_patch_groups(
+            previous=previous_animat_options,
+            current=animat_options,
+        )
+        if animat_options is not None
+        else []
+    )
+
+    # Simulation options
+    options = {}
+    for key in simulation_keys:
+        if key == 'timestep':
+            options['timestep'] = (
+                simulation_options.timestep
+                / max(1, simulation_options.num_sub_steps)
+            )
+        elif key == 'gravity':
+            options['gravity'] = [
+                gravity*units.acceleration
+                for gravity in simulation_options.gravity
+            ]
+        elif key == 'n_solver_iters':
+            options['solver_iterations'] = simulation_options.n_solver_iters
+        else:
+            options[key] = simulation_options[key]
+    physics_set_options(physics, **options)
+
+    # Animat options
+    for group in animat_groups:
+        ANIMAT_PATCHES[group](
+            physics=physics,
+            animat_options=animat_options,
+            units=units,
+            prefix=prefix,
+        )
+    return simulation_keys, animat_groups
@@ -185,13 +185,23 @@ def get_sensor_maps(physics, verbose=True):
     return sensor_maps
 
 
-def get_physics2data_maps(physics, sensor_data, sensor_maps):
-    """Sensor to data maps"""
+def get_physics2data_maps(
+        physics, sensor_data, sensor_maps,
+        prefix='', contacts=None,
+):
+    """Sensor to data maps
+
+    The data names are those of the animat model, which are prefixed by
+    prefix in the physics when several animats share the same model. If
+    contacts indices are provided, only those contacts pairs are mapped,
+    and the others are not collected.
+
+    """
 
     # Names from data
-    links_names = sensor_data.links.names
-    joints_names = sensor_data.joints.names
-    muscles_names = sensor_data.muscles.names
+    links_names = [f'{prefix}{name}' for name in sensor_data.links.names]
+    joints_names = [f'{prefix}{name}' for name in sensor_data.joints.names]
+    muscles_names = [f'{prefix}{name}' for name in sensor_data.muscles.names]
 
     # Links from physics
     xpos_row = physics.named.data.xpos.axes.row
@@ -356,13 +366,21 @@ def get_physics2data_maps(physics, sensor_data, sensor_maps):
             for joint_name in actuator_momentcol.names
         ]).ravel()
 
-    # Contacts
+    # Contacts, with bodies of this animat matched without prefix
     contacts_pairs = sensor_data.contacts.names
-    body_names = physics.named.model.body_pos.axes.row.names
+    mapped_pairs = set(
+        contacts_pairs
+        if contacts is None
+        else [contacts_pairs[pair_i] for pair_i in contacts]
+    )
+    body_names = [
+        name[len(prefix):] if prefix and name.startswith(prefix) else name
+        for name in physics.named.model.body_pos.axes.row.names
+    ]
     sensor_maps['geompair2data'] = {
         (geom_id, -1): contacts_pairs.index((body_names[body_id], ''))
         for geom_id, body_id in enumerate(physics.model.geom_bodyid)
-        if (body_names[body_id], '') in contacts_pairs
+        if (body_names[body_id], '') in mapped_pairs
     }
     sensor_maps['geompair2data'].update({
         (geom_id1, geom_id2): contacts_pairs.index(
@@ -370,10 +388,12 @@ def get_physics2data_maps(physics, sensor_data, sensor_maps):
         )
         for geom_id1, body_id1 in enumerate(physics.model.geom_bodyid)
         for geom_id2, body_id2 in enumerate(physics.model.geom_bodyid)
-        if (body_names[body_id1], body_names[body_id2]) in contacts_pairs
+        if (body_names[body_id1], body_names[body_id2]) in mapped_pairs
     })
     geompair2data_values = sensor_maps['geompair2data'].values()
     for pair_i, pair in enumerate(contacts_pairs):
+        if pair not in mapped_pairs:
+            continue
         assert not isinstance(pair, str) and len(pair) == 2, (
             f'Contact "{pair}" should be a pair of strings'
         )
@@ -384,12 +404,12 @@ def get_physics2data_maps(physics, sensor_data, sensor_maps):
     # External forces
     row = physics.named.data.xfrc_applied.axes.row
     sensor_maps['data2xfrc'] = np.array([
-        row2index(row=row, name=name, single=True)
+        row2index(row=row, name=f'{prefix}{name}', single=True)
         for name in sensor_data.xfrc.names
     ])
     sensor_maps['datalinks2xfrc'] = np.array([
         row2index(row=row, name=name, single=True)
-        for name in sensor_data.links.names
+        for name in links_names
     ])
 
 
@@ -497,16 +517,27 @@ def physicsjointssensors2data(physics, iteration, data, sensor_maps, units):
         )/units.torques
 
 
-def physicsjoints2data(physics, iteration, data, sensor_maps, units):
+def physicsjointspositions2data(physics, iteration, data, sensor_maps, units):
     """Sensors data collection"""
+    # pylint: disable=unused-argument
     data.sensors.joints.array[iteration, :, sc.joint_position] = (
         physics.data.qpos[sensor_maps['qpos2data']]
     )
+
+
+def physicsjointsvelocities2data(physics, iteration, data, sensor_maps, units):
+    """Sensors data collection"""
     data.sensors.joints.array[iteration, :, sc.joint_velocity] = (
         physics.data.qvel[sensor_maps['qvel2data']]
     )/units.angular_velocity
 
 
+def physicsjoints2data(physics, iteration, data, sensor_maps, units):
+    """Sensors data collection"""
+    physicsjointspositions2data(physics, iteration, data, sensor_maps, units)
+    physicsjointsvelocities2data(physics, iteration, data, sensor_maps, units)
+
+
 def physicsactuators2data(physics, iteration, data, sensor_maps, units):
     """Sensors data collection"""
     itorques = 1./units.torques
@@ -524,22 +555,161 @@ def physicsactuators2data(physics, iteration, data, sensor_maps, units):
         )*itorques
 
 
-def physics2data(physics, iteration, data, maps, units, links_only=False):
+def physicscontacts2data(physics, iteration, data, sensor_maps, units):
     """Sensors data collection"""
-    sensor_maps = maps['sensors']
-    physicslinks2data(physics, iteration, data, sensor_maps, units)
-    physicslinksvelsensors2data(physics, iteration, data, sensor_maps, units)
-    if not links_only:
-        physicsjointssensors2data(physics, iteration, data, sensor_maps, units)
-        physicsjoints2data(physics, iteration, data, sensor_maps, units)
-        physicsactuators2data(physics, iteration, data, sensor_maps, units)
-        cycontacts2data(
-            physics=physics,
-            iteration=iteration,
-            data=data.sensors.contacts,
-            geompair2data=sensor_maps['geompair2data'],
-            meters=units.meters,
-            newtons=units.newtons,
+    cycontacts2data(
+        physics=physics,
+        iteration=iteration,
+        data=data.sensors.contacts,
+        geompair2data=sensor_maps['geompair2data'],
+        meters=units.meters,
+        newtons=units.newtons,
+    )
+
+
+def physicsmuscles2data(physics, iteration, data, sensor_maps, units):
+    """Sensors data collection"""
+    if data.sensors.muscles.names:
+        physics_muscles_sensors2data(physics, iteration, data, sensor_maps, units)
+
+
+# Sensors groups, which can be sampled at different rates, and the
+# collection functions of their fields
+SENSORS_GROUPS = ('links', 'joints', 'contacts', 'muscles')
+SENSORS_FIELDS = {
+    'links': {
+        'positions': (physicslinks2data,),
+        'velocities': (physicslinksvelsensors2data,),
+    },
+    'joints': {
+        'positions': (physicsjointspositions2data,),
+        'velocities': (physicsjointsvelocities2data,),
+        'forces': (physicsjointssensors2data,),
+        'torques': (physicsactuators2data,),
+    },
+    'contacts': {
+        'forces': (physicscontacts2data,),
+    },
+    'muscles': {
+        'states': (physicsmuscles2data,),
+    },
+}
+SENSORS_COLLECTORS = {
+    group: tuple(
+        collector
+        for collectors in fields.values()
+        for collector in collectors
+    )
+    for group, fields in SENSORS_FIELDS.items()
+}
+
+
+def merge_subscriptions(*subscriptions):
+    """Union of sensors subscriptions
+
+    A subscription maps sensors groups to True for all their fields or to
+    a list of fields from SENSORS_FIELDS. For contacts, the list contains
+    the indices or names of the contacts pairs instead. None subscriptions
+    are ignored.
+
+    """
+    merged = {}
+    for subscription in subscriptions:
+        if subscription is None:
+            continue
+        for group, fields in subscription.items():
+            assert group in SENSORS_GROUPS, f'Unknown sensors group {group}'
+            if fields is True or merged.get(group) is True:
+                merged[group] = True
+            elif fields:
+                merged[group] = list(merged.get(group, [])) + [
+                    field
+                    for field in fields
+                    if field not in merged.get(group, [])
+                ]
+    return merged
+
+
+def subscribed_collectors(subscriptions):
+    """Collection functions of subscribed sensors groups and fields"""
+    collectors = {}
+    for group, fields in subscriptions.items():
+        if fields is True or group == 'contacts':
+            collectors[group] = SENSORS_COLLECTORS[group]
+            continue
+        for field in fields:
+            assert field in SENSORS_FIELDS[group], (
+                f'Unknown {group} field {field}'
+                f' (available: {list(SENSORS_FIELDS[group])})'
+            )
+        collectors[group] = tuple(
+            collector
+            for field, field_collectors in SENSORS_FIELDS[group].items()
+            if field in fields
+            for collector in field_collectors
         )
-        if data.sensors.muscles.names:
-            physics_muscles_sensors2data(physics, iteration, data, sensor_maps, units)
+    return collectors
+
+
+def subscribed_contacts(subscriptions, contacts_names):
+    """Indices of subscribed contacts pairs, None if all are subscribed"""
+    fields = subscriptions.get('contacts', [])
+    if fields is True:
+        return None
+    return [
+        field if isinstance(field, int) else contacts_names.index(tuple(field))
+        for field in fields
+    ]
+
+
+def physics2data(
+        physics, iteration, data, maps, units,
+        links_only=False, groups=None,
+):
+    """Sensors data collection
+
+    Only the given sensors groups are collected if provided, otherwise all
+    groups are collected, or only the links if links_only is set. If the
+    maps contain subscribed collectors, only those are run.
+
+    """
+    sensor_maps = maps['sensors']
+    collectors = maps.get('collectors')
+    if collectors is None:
+        collectors = SENSORS_COLLECTORS
+    if groups is None:
+        groups = ('links',) if links_only else SENSORS_GROUPS
+    for group in groups:
+        for collector in collectors.get(group, ()):
+            collector(physics, iteration, data, sensor_maps, units)
+
+
+def sensors_arrays(data):
+    """Sensors arrays of animat data, including external forces"""
+    return {
+        name: np.asarray(getattr(data.sensors, name).array)
+        for name in SENSORS_GROUPS + ('xfrc',)
+        if getattr(data.sensors, name, None) is not None
+    }
+
+
+def clear_sensors(data, groups, iteration):
+    """Clear accumulated sensors of groups at iteration before collection
+
+    Contacts and actuators torques are summed into the data rows, which
+    must then be cleared before a row is collected again, e.g. when the
+    ring buffer wraps around or when steps are integrated again.
+
+    """
+    if 'contacts' in groups:
+        np.asarray(data.sensors.contacts.array)[iteration] = 0
+    if 'joints' in groups:
+        joints = np.asarray(data.sensors.joints.array)
+        joints[iteration, :, sc.joint_torque] = 0
+
+
+def hold_sensors(data, groups, iteration, previous):
+    """Hold previous samples of sensors groups which are not collected"""
+    for group in groups:
+        array = np.asarray(getattr(data.sensors, group).array)
+        array[iteration] = array[previous]
@@ -0,0 +1,228 @@
+"""Out-of-process controller execution"""
+
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from farms_core import pylog
+from farms_core.model.control import AnimatController
+from farms_core.model.data import AnimatData
+
+from .control import CONTROL_KEYS, ControlArrays
+from .physics import sensors_arrays
+
+
+# Synchronisation modes
+LOCKSTEP = 'lockstep'  # Controls computed from the current sensors
+DELAYED = 'delayed'  # Controls computed from the previous step sensors
+# Command array layout
+CMD_ITERATION, CMD_TIME, CMD_TIMESTEP, CMD_STOP, CMD_ERROR = range(5)
+
+
+def shared_array(
+        shape: Tuple[int],
+        blocks: List[shared_memory.SharedMemory],
+        dtype=np.float64,
+) -> np.ndarray:
+    """Array in new shared memory block, appended to blocks"""
+    nbytes = max(1, int(np.prod(shape))*np.dtype(dtype).itemsize)
+    block = shared_memory.SharedMemory(create=True, size=nbytes)
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def controller_worker(control, controller, data, shared, request, done, pipe):
+    """Controller loop run in the child process"""
+    # pylint: disable=too-many-arguments
+    arrays = shared['arrays']
+    command = shared['command']
+    sensors = sensors_arrays(data)
+    while True:
+        request.acquire()
+        if command[CMD_STOP]:
+            break
+        try:
+            iteration = int(command[CMD_ITERATION])
+            for name, array in sensors.items():
+                array[iteration] = shared['sensors'][name]
+            kwargs = {
+                'iteration': iteration,
+                'time': command[CMD_TIME],
+                'timestep': command[CMD_TIMESTEP],
+            }
+            controller.step(**kwargs)
+            control.write_controls(arrays=arrays, **kwargs)
+        except Exception:  # pylint: disable=broad-except
+            command[CMD_ERROR] = 1
+            pipe.send(traceback.format_exc())
+        done.release()
+
+
+class ProcessController:
+    """Array controller running in a separate process
+
+    The controller is forked into a child process together with the
+    animat data. At each control step, the current sensors rows are
+    copied into shared memory, from which the child updates its own data
+    before stepping the controller, which writes its outputs into control
+    arrays also in shared memory. Data written by the controller into the
+    animat data, such as its internal state, remains in the child.
+
+    In lockstep mode, the task waits for the controller at each step. In
+    delayed mode, the physics step runs concurrently with the controller,
+    and the controls applied are those computed from the previous sensors,
+    except for the first step which is computed in lockstep.
+
+    """
+
+    def __init__(self, control, controller: AnimatController, **kwargs):
+        super().__init__()
+        self._blocks: List[shared_memory.SharedMemory] = []
+        self._shared: Dict = None
+        self._arrays: ControlArrays = None
+        self._process = None
+        self._pipe = None
+        self._request = None
+        self._done = None
+        self._pending = False
+        self._sensors: Dict[str, np.ndarray] = None
+        self.control = control
+        self.controller = controller
+        self.data: AnimatData = kwargs.pop('data')
+        self.mode: str = kwargs.pop('mode', LOCKSTEP)
+        self.timeout: float = kwargs.pop('timeout', None)
+        self._context = mp.get_context(kwargs.pop('start_method', 'fork'))
+        assert not kwargs, kwargs
+        assert self.mode in (LOCKSTEP, DELAYED), f'Unknown mode {self.mode}'
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def control_types(self) -> Tuple[str]:
+        """Control blocks written by controller"""
+        return getattr(self.control, 'control_types', CONTROL_KEYS)
+
+    def springref_names(self, joints: List[str]) -> List[str]:
+        """Spring references written by controller among joints"""
+        if not hasattr(self.control, 'springref_names'):
+            return []
+        return self.control.springref_names(joints)
+
+    def start(self, arrays: ControlArrays):
+        """Start child process with control arrays layout"""
+        self.close()
+        blocks = self._blocks
+        shared_arrays = ControlArrays(
+            names=arrays.names,
+            springref_names=arrays.springref_names,
+            springrefs=arrays.springrefs,
+        )
+        shared_arrays.ctrl = shared_array(arrays.ctrl.shape, blocks)
+        shared_arrays.ctrl[:] = arrays.ctrl
+        springrefs = shared_array(arrays.springrefs.shape, blocks)
+        springrefs[:] = arrays.springrefs
+        shared_arrays.springrefs = springrefs
+        self._shared = {
+            'arrays': shared_arrays,
+            'command': shared_array((5,), blocks),
+            'sensors': {
+                name: shared_array(array.shape[1:], blocks)
+                for name, array in sensors_arrays(self.data).items()
+            },
+        }
+        self._shared['command'][:] = 0
+        self._request = self._context.Semaphore(0)
+        self._done = self._context.Semaphore(0)
+        self._pipe, child_pipe = self._context.Pipe(duplex=False)
+        self._process = self._context.Process(
+            target=controller_worker,
+            args=(
+                self.control, self.controller, self.data, self._shared,
+                self._request, self._done, child_pipe,
+            ),
+            daemon=True,
+        )
+        self._process.start()
+        self._sensors = sensors_arrays(self.data)
+        self._arrays = arrays
+        self._pending = False
+
+    def close(self):
+        """Stop child process and release shared memory"""
+        if self._process is not None:
+            if self._pending:
+                try:
+                    self.wait()
+                except RuntimeError as err:
+                    pylog.warning('Closing failed controller process: %s', err)
+            self._shared['command'][CMD_STOP] = 1
+            self._request.release()
+            self._process.join(timeout=self.timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+        # Views must be released before closing the blocks
+        self._shared = None
+        self._sensors = None
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+        self._arrays = None
+
+    def submit(self, iteration: int, time: float, timestep: float):
+        """Share current sensors and request controller step"""
+        command = self._shared['command']
+        for name, array in self._shared['sensors'].items():
+            array[:] = self._sensors[name][iteration]
+        command[CMD_ITERATION] = iteration
+        command[CMD_TIME] = time
+        command[CMD_TIMESTEP] = timestep
+        self._request.release()
+        self._pending = True
+
+    def wait(self):
+        """Wait for requested controller step"""
+        if not self._done.acquire(timeout=self.timeout):
+            raise RuntimeError(
+                f'Controller process did not respond within {self.timeout} s'
+                f' (alive: {self._process.is_alive()})'
+            )
+        self._pending = False
+        if self._shared['command'][CMD_ERROR]:
+            error = self._pipe.recv()
+            self._shared['command'][CMD_ERROR] = 0
+            pylog.error(error)
+            raise RuntimeError(f'Controller process failed:\n{error}')
+
+    def write_controls(
+            self,
+            iteration: int,
+            time: float,
+            timestep: float,
+            arrays: ControlArrays,
+    ):
+        """Write controller outputs into control arrays"""
+        kwargs = {'iteration': iteration, 'time': time, 'timestep': timestep}
+        pipeline = False
+        if arrays is not self._arrays:
+            # New episode, first step always computed in lockstep
+            self.start(arrays)
+            self.submit(**kwargs)
+            self.wait()
+        elif self.mode == LOCKSTEP:
+            self.submit(**kwargs)
+            self.wait()
+        else:
+            if self._pending:
+                self.wait()
+            pipeline = True
+        shared_arrays = self._shared['arrays']
+        arrays.ctrl[:] = shared_arrays.ctrl
+        arrays.springrefs[:] = shared_arrays.springrefs
+        if pipeline:
+            self.submit(**kwargs)
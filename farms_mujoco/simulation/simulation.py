@@ -1,24 +1,39 @@
 """Simulation"""
 
 import os
+import copy
+import atexit
 import warnings
 import traceback
-from typing import List, Dict
+from typing import Callable, List, Dict, Union
 
 import numpy as np
 from tqdm import tqdm
 
 from dm_control import mjcf
-from dm_control import viewer
 from dm_control.rl.control import Environment, PhysicsError
 
 from farms_core import pylog
+from farms_core.model.data import AnimatData
 from farms_core.model.options import AnimatOptions, ArenaOptions
 from farms_core.simulation.options import SimulationOptions
 
-from .mjcf import setup_mjcf_xml, mjcf2str
-from .task import ExperimentTask
-from .application import FarmsApplication
+from .mjcf import setup_mjcf_xml, mjcf2str, mjcf2file
+from .task import ExperimentTask, PopulationTask
+from .process import ProcessController
+from .memory import check_buffers
+from .physics import SENSORS_GROUPS
+from .checkpoint import Checkpointer, load_checkpoint
+from .logger import StreamingLogger
+from .writer import BackgroundWriter
+from .storage import write_external
+from .snapshot import (
+    physics_state,
+    set_physics_state,
+    save_snapshot,
+    load_snapshot,
+)
+from .patch import patch_physics, animat_patch_groups
 
 
 def extract_sub_dict(dictionary: Dict, keys: List[str]) -> Dict:
@@ -30,27 +45,146 @@ def extract_sub_dict(dictionary: Dict, keys: List[str]) -> Dict:
     }
 
 
+def sensors_rates(task: ExperimentTask, iteration: int) -> Dict:
+    """Sensors groups sampling rates and sampling times up to iteration"""
+    return {
+        name: (
+            task.sensors_rates.get(name, 1),
+            task.sensors_times(group=name, iteration=iteration),
+        )
+        for name in SENSORS_GROUPS
+    }
+
+
+def write_sensors_rates(path: str, rates: Dict):
+    """Write sensors groups sampling rates and times to data file
+
+    The sampling times are stored with the data of each sensors group, as
+    sensors/<group>/times, with the rate as attribute, see
+    read_sensors_times. The arrays keep one row per iteration, decimated
+    groups holding their previous samples in between.
+
+    """
+    import h5py
+    with h5py.File(path, 'a') as hfile:
+        for name, (rate, times) in rates.items():
+            if f'sensors/{name}' not in hfile:
+                continue
+            group = hfile[f'sensors/{name}']
+            group.attrs['rate'] = rate
+            if 'times' in group:
+                del group['times']
+            group.create_dataset('times', data=times)
+
+
+def read_sensors_times(path: str) -> Dict[str, np.ndarray]:
+    """Sampling times of sensors groups in data file, see write_sensors_rates
+
+    Groups without sampling times were sampled at every iteration.
+
+    """
+    import h5py
+    with h5py.File(path, 'r') as hfile:
+        return {
+            name: group['times'][()]
+            for name, group in hfile['sensors'].items()
+            if isinstance(group, h5py.Group) and 'times' in group
+        }
+
+
+def write_animat(
+        path: str,
+        data: AnimatData,
+        animat_options: AnimatOptions,
+        iteration: int,
+        rates: Dict = None,
+        memmaps: Dict[str, np.memmap] = None,
+):
+    """Write animat data and options to log folder
+
+    Memory-mapped data is referenced by the data file rather than
+    copied, see write_external.
+
+    """
+    os.makedirs(path, exist_ok=True)
+    if memmaps:
+        write_external(
+            path=os.path.join(path, 'simulation.hdf5'),
+            data=data,
+            memmaps=memmaps,
+            iteration=iteration,
+        )
+    else:
+        data.to_file(os.path.join(path, 'simulation.hdf5'), iteration)
+    if rates:
+        write_sensors_rates(
+            path=os.path.join(path, 'simulation.hdf5'),
+            rates=rates,
+        )
+    animat_options.save(os.path.join(path, 'animat_options.yaml'))
+
+
+# Background writer shared by simulations for asynchronous postprocessing
+_POSTPROCESS_WRITER: BackgroundWriter = None
+
+
+def postprocess_writer(max_jobs: int = 2) -> BackgroundWriter:
+    """Background writer of asynchronous postprocessing, closed at exit"""
+    global _POSTPROCESS_WRITER  # pylint: disable=global-statement
+    if _POSTPROCESS_WRITER is None:
+        _POSTPROCESS_WRITER = BackgroundWriter(max_jobs=max_jobs, daemon=True)
+        atexit.register(_POSTPROCESS_WRITER.close)
+    return _POSTPROCESS_WRITER
+
+
+def flush_postprocess():
+    """Wait for asynchronous postprocessing to be written to disk"""
+    if _POSTPROCESS_WRITER is not None:
+        _POSTPROCESS_WRITER.flush()
+
+
 class Simulation:
     """Simulation"""
 
     def __init__(
             self,
             mjcf_model: mjcf.element.RootElement,
-            base_link: str,
+            base_link: Union[str, List[str]],
             simulation_options: SimulationOptions,
             **kwargs,
     ):
+        """Simulation
+
+        If a list of base links is provided, a population task is created
+        with one experiment task per animat, in which case the data,
+        controller and animat_options keyword arguments are lists with one
+        element per animat and the prefixes are those used in setup_mjcf_xml.
+        The callbacks are either a list per animat, or a single list which
+        is attached to the first animat only.
+
+        """
         super().__init__()
         self._mjcf_model: mjcf.element.RootElement = mjcf_model
         self.options: SimulationOptions = simulation_options
         self.pause: bool = not self.options.play
         self.physics: mjcf.Physics = mjcf.Physics.from_mjcf_model(mjcf_model)
         self.handle_exceptions = kwargs.pop('handle_exceptions', False)
+        checkpoint_path = kwargs.pop('checkpoint_path', None)
+        checkpoint_interval = kwargs.pop('checkpoint_interval', None)
+        self.checkpointer: Checkpointer = (
+            Checkpointer(path=checkpoint_path, interval=checkpoint_interval)
+            if checkpoint_path is not None
+            else None
+        )
+        # Stream data to files during simulation, with StreamingLogger kwargs
+        streaming_logger = kwargs.pop('streaming_logger', None)
+        self.logger: StreamingLogger = (
+            StreamingLogger(**streaming_logger)
+            if streaming_logger is not None
+            else None
+        )
 
         # Simulator configuration
-        # pylint: disable=protected-access
-        viewer.util._MIN_TIME_MULTIPLIER = 2**-10
-        viewer.util._MAX_TIME_MULTIPLIER = 2**10
         if 'MUJOCO_GL' not in os.environ:
             os.environ['MUJOCO_GL'] = (
                 'egl'
@@ -65,19 +199,67 @@ class Simulation:
             dictionary=kwargs,
             keys=('control_timestep', 'n_sub_steps', 'flat_observation'),
         )
-        self.task: ExperimentTask = ExperimentTask(
-            base_link=base_link,
+        task_kwargs = dict(
             n_iterations=self.options.n_iterations,
             timestep=self.options.timestep,
             units=self.options.units,
             substeps=self.options.num_sub_steps,
-            **kwargs,
         )
-        self._env: Environment = Environment(
+        if isinstance(base_link, (list, tuple)):
+            n_animats = len(base_link)
+            prefixes = kwargs.pop('prefixes', [
+                f'animat{index}_' for index in range(n_animats)
+            ])
+            animats_kwargs = {
+                key: kwargs.pop(key, [None]*n_animats)
+                for key in ('data', 'controller', 'animat_options')
+            }
+            hfield = kwargs.pop('hfield', None)
+            # Callbacks are either one list per animat, or a single list
+            # attached to the first animat so that they run once per step
+            callbacks = kwargs.pop('callbacks', [])
+            animats_kwargs['callbacks'] = (
+                [list(animat_callbacks) for animat_callbacks in callbacks]
+                if callbacks and isinstance(callbacks[0], (list, tuple))
+                else [list(callbacks)] + [[] for _ in range(n_animats-1)]
+            )
+            assert len(animats_kwargs['callbacks']) == n_animats, (
+                f'{len(animats_kwargs["callbacks"])=} != {n_animats=}'
+            )
+            population_kwargs = {
+                key: kwargs.pop(key, None)
+                for key in ('watchdog', 'adaptive_substeps')
+            }
+            self.task: PopulationTask = PopulationTask(tasks=[
+                ExperimentTask(
+                    base_link=animat_base_link,
+                    prefix=prefixes[index],
+                    hfield=hfield if index == 0 else None,
+                    **{
+                        key: values[index]
+                        for key, values in animats_kwargs.items()
+                    },
+                    **task_kwargs,
+                    **kwargs,
+                )
+                for index, animat_base_link in enumerate(base_link)
+            ], **population_kwargs)
+        else:
+            self.task: ExperimentTask = ExperimentTask(
+                base_link=base_link,
+                **task_kwargs,
+                **kwargs,
+            )
+        self._env_kwargs: Dict = env_kwargs
+        self._env: Environment = self.create_environment()
+
+    def create_environment(self) -> Environment:
+        """Create environment"""
+        return Environment(
             physics=self.physics,
             task=self.task,
             time_limit=self.options.n_iterations*self.options.timestep,
-            **env_kwargs,
+            **self._env_kwargs,
         )
 
     @property
@@ -85,6 +267,13 @@ class Simulation:
         """Iteration"""
         return self.task.iteration
 
+    @property
+    def tasks(self) -> List[ExperimentTask]:
+        """Experiment tasks, one per animat"""
+        if isinstance(self.task, PopulationTask):
+            return self.task.tasks
+        return [self.task]
+
     @classmethod
     def from_sdf(
             cls,
@@ -94,38 +283,249 @@ class Simulation:
             **kwargs,
     ):
         """From SDF"""
+        setup_kwargs = extract_sub_dict(
+            dictionary=kwargs,
+            keys=(
+                'spawn_position', 'spawn_rotation',
+                'save_mjcf', 'use_particles', 'heightfield_window',
+                'njmax', 'nconmax', 'estimate_buffers', 'calibrate_buffers',
+            ),
+        )
+        if 'prefixes' in kwargs:  # Also required by population task
+            setup_kwargs['prefixes'] = kwargs['prefixes']
         mjcf_model, base_link, hfield = setup_mjcf_xml(
             simulation_options=simulation_options,
             animat_options=animat_options,
             arena_options=arena_options,
-            **extract_sub_dict(
-                dictionary=kwargs,
-                keys=(
-                    'spawn_position', 'spawn_rotation',
-                    'save_mjcf', 'use_particles',
-                ),
-            )
+            **setup_kwargs,
         )
         return cls(
             mjcf_model=mjcf_model,
-            base_link=base_link.name,
+            base_link=(
+                [link.name for link in base_link]
+                if isinstance(base_link, list)
+                else base_link.name
+            ),
             simulation_options=simulation_options,
             animat_options=animat_options,
             hfield=hfield,
             **kwargs,
         )
 
+    def snapshot(self, path: str = None, compress: bool = False) -> Dict:
+        """Snapshot of physics, tasks, data and controllers states
+
+        Controllers states are included if they implement get_state and
+        set_state. The snapshot is also saved to path if provided.
+
+        """
+        snapshot = {
+            'physics': physics_state(self.physics),
+            'task': self.task.get_state(),
+        }
+        if path is not None:
+            save_snapshot(path=path, snapshot=snapshot, compress=compress)
+        return snapshot
+
+    def restore(self, snapshot: Union[Dict, str]):
+        """Restore snapshot, or snapshot saved at path"""
+        if isinstance(snapshot, str):
+            snapshot = load_snapshot(snapshot)
+        # The episode must be initialised before restoring its state,
+        # otherwise the first environment step would reset it
+        # pylint: disable=protected-access
+        if self._env._reset_next_step:
+            self._env.reset()
+        set_physics_state(self.physics, snapshot['physics'])
+        self.task.set_state(physics=self.physics, state=snapshot['task'])
+
+    def resume(self, path: str = None):
+        """Resume from last consistent checkpoint
+
+        The checkpoint is loaded from path, or from the checkpoints path of
+        the simulation, and further checkpoints continue appending to it.
+
+        """
+        if path is None:
+            assert self.checkpointer is not None, 'No checkpoint path'
+            path = self.checkpointer.path
+        # pylint: disable=protected-access
+        if self._env._reset_next_step:
+            self._env.reset()
+        snapshot = load_checkpoint(path=path, tasks=self.tasks)
+        self.restore(snapshot)
+        if self.checkpointer is not None:
+            self.checkpointer.open(
+                tasks=self.tasks,
+                rows=int(snapshot['rows']),
+            )
+        if self.logger is not None:
+            self.logger.open(tasks=self.tasks, rows=int(snapshot['rows']))
+
+    def step_checkpoint(self):
+        """Checkpoint and log data if due at current iteration"""
+        if self.checkpointer is not None:
+            if self.checkpointer.due(self.tasks[0].iteration):
+                self.checkpointer.checkpoint(self)
+        if self.logger is not None:
+            if self.logger.due(self.tasks[0].iteration):
+                self.logger.log(self.tasks)
+
+    def close_writers(self):
+        """Write remaining data and close checkpoints and logger files"""
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+        if self.logger is not None:
+            self.logger.close(tasks=self.tasks)
+
+    def fork(
+            self,
+            n_children: int,
+            snapshot: Union[Dict, str] = None,
+            factory: Callable[[], 'Simulation'] = None,
+    ) -> List['Simulation']:
+        """Child simulations starting from snapshot, current state if None
+
+        Children are deep copies of this simulation, which avoids
+        recompiling the model, or are created by factory, for example if
+        the controller or callbacks can not be copied. Copies do not share
+        the controller processes, observations views, checkpointer and
+        logger of this simulation, see fork_copy.
+
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+        elif isinstance(snapshot, str):
+            snapshot = load_snapshot(snapshot)
+        children = []
+        for _ in range(n_children):
+            child = factory() if factory is not None else self.fork_copy()
+            child.restore(snapshot)
+            children.append(child)
+        return children
+
+    def fork_copy(self) -> 'Simulation':
+        """Deep copy without processes, views and writers
+
+        Controller processes and their shared memory, cached observations
+        views into the data buffers and background writers can not be
+        meaningfully copied. They are left out of the copy, controller
+        processes are restarted in the copy and observations views are
+        recreated on first use. The copy has no checkpointer and logger,
+        which would otherwise write into the files of this simulation, and
+        its data is held in memory instead of memory-mapped files.
+
+        """
+        # pylint: disable=protected-access
+        memo = {id(self.checkpointer): None, id(self.logger): None}
+        processes = []
+        for task_i, task in enumerate(self.tasks):
+            memo[id(task._observations)] = None
+            memo[id(task.memmaps)] = {}
+            if isinstance(task._control, ProcessController):
+                memo[id(task._control)] = None
+                memo[id(task._control_arrays)] = None
+                processes.append(task_i)
+        child = copy.deepcopy(self, memo)
+        for task in child.tasks:
+            task.memmap_path = None
+        for task_i in processes:
+            child.tasks[task_i].initialize_control(child.physics)
+        return child
+
     def save_mjcf_xml(self, path: str, verbose: bool = False):
         """Save simulation to mjcf xml"""
-        mjcf_xml_str = mjcf2str(mjcf_model=self._mjcf_model)
         if verbose:
-            pylog.info(mjcf_xml_str)
-        with open(path, 'w+', encoding='utf-8') as xml_file:
-            xml_file.write(mjcf_xml_str)
+            pylog.info(mjcf2str(mjcf_model=self._mjcf_model))
+        mjcf2file(mjcf_model=self._mjcf_model, path=path)
+
+    def patch_options(
+            self,
+            simulation_options: SimulationOptions = None,
+            animat_options: Union[AnimatOptions, List[AnimatOptions]] = None,
+    ):
+        """Apply parameter-only options changes without recompiling
+
+        For a population, animat_options is a list with one element per
+        animat, where None leaves the corresponding animat unchanged.
+        Runtime simulation options such as n_iterations are applied to the
+        tasks and environment, other unsupported changes raise a
+        ValueError before anything is modified.
+
+        """
+        tasks = self.tasks
+        animats_options = (
+            animat_options
+            if isinstance(animat_options, (list, tuple))
+            else [animat_options] + [None]*(len(tasks)-1)
+        )
+        assert len(animats_options) == len(tasks), (
+            f'{len(animats_options)=} != {len(tasks)=}'
+        )
+        # Validate all animats before modifying the model
+        for task, options in zip(tasks, animats_options):
+            if options is not None:
+                animat_patch_groups(
+                    previous=task.animat_options,
+                    current=options,
+                )
+        patch_physics(
+            physics=self.physics,
+            simulation_options=simulation_options,
+            previous_simulation_options=self.options,
+            units=self.options.units,
+        )
+        for task, options in zip(tasks, animats_options):
+            if options is None:
+                continue
+            patch_physics(
+                physics=self.physics,
+                animat_options=options,
+                previous_animat_options=task.animat_options,
+                units=self.options.units,
+                prefix=task.prefix,
+            )
+            task.animat_options = options
+        if simulation_options is not None:
+            timestep_changed = (
+                simulation_options.timestep != self.options.timestep
+            )
+            n_iterations_changed = (
+                simulation_options.n_iterations != self.options.n_iterations
+            )
+            self.options = simulation_options
+            if timestep_changed:
+                for task in tasks:
+                    task.timestep = self.options.timestep
+                    task.sim_timestep = task.timestep/task.substeps
+            if n_iterations_changed:
+                for task in tasks:
+                    task.n_iterations = self.options.n_iterations
+                    task.sim_iterations = task.n_iterations*task.substeps
+            if timestep_changed or n_iterations_changed:
+                self._env = self.create_environment()
+
+    def step_environment(self):
+        """Step environment, recovering from physics errors with watchdog"""
+        try:
+            self._env.step(action=None)
+        except PhysicsError as err:
+            check_buffers(self.physics)  # Full buffers are not divergences
+            watchdog = self.task.watchdog
+            if watchdog is None or watchdog.recovering:
+                raise err
+            pylog.warning('%s, rolling back', err)
+            watchdog.recover(task=self.task, physics=self.physics)
 
     def run(self):
         """Run simulation"""
         if not self.options.headless:
+            # Viewer only imported when needed, it loads the GUI backend
+            from dm_control import viewer
+            from .application import FarmsApplication
+            # pylint: disable=protected-access
+            viewer.util._MIN_TIME_MULTIPLIER = 2**-10
+            viewer.util._MAX_TIME_MULTIPLIER = 2**10
             app = FarmsApplication()
             app.set_speed(multiplier=(
                 # pylint: disable=protected-access
@@ -138,37 +538,42 @@ class Simulation:
                 app.toggle_pause()
             app.launch(environment_loader=self._env)
         else:
+            # Resumed simulations continue from their current iteration
+            n_steps = self.task.sim_iterations - self.tasks[0].sim_iteration
             _iterator = (
-                tqdm(range(self.task.sim_iterations))
+                tqdm(range(n_steps))
                 if self.options.show_progress
-                else range(self.task.sim_iterations)
+                else range(n_steps)
             )
             try:
                 for _ in _iterator:
-                    self._env.step(action=None)
+                    self.step_environment()
+                    self.step_checkpoint()
             except PhysicsError as err:
                 pylog.error(traceback.format_exc())
                 if self.handle_exceptions:
                     return
                 raise err
+            finally:
+                self.close_writers()
         pylog.info('Closing simulation')
 
     def iterator(self, show_progress: bool = True, verbose: bool = True):
         """Run simulation"""
-        _iterator = (
-            tqdm(range(self.task.n_iterations))
-            if show_progress
-            else range(self.task.n_iterations)
-        )
+        iterations = range(self.tasks[0].iteration, self.task.n_iterations)
+        _iterator = tqdm(iterations) if show_progress else iterations
         try:
             for iteration in _iterator:
                 yield iteration
                 for _ in range(self.task.substeps):
-                    self._env.step(action=None)
+                    self.step_environment()
+                self.step_checkpoint()
         except PhysicsError as err:
             if verbose:
                 pylog.error(traceback.format_exc())
             raise err
+        finally:
+            self.close_writers()
 
     def postprocess(
             self,
@@ -177,7 +582,16 @@ class Simulation:
             plot: bool = False,
             **kwargs,
     ):
-        """Postprocessing after simulation"""
+        """Postprocessing after simulation
+
+        If asynchronous, the data and options are copied and written by a
+        background writer shared by all simulations, at most max_jobs
+        postprocessings being queued before blocking, and this returns
+        immediately, see flush. Plots are always made synchronously.
+
+        """
+        asynchronous = kwargs.pop('asynchronous', False)
+        max_jobs = kwargs.pop('max_jobs', 2)
 
         # Times
         times = np.arange(
@@ -189,17 +603,58 @@ class Simulation:
         # Log
         if log_path:
             pylog.info('Saving data to %s', log_path)
-            self.task.data.to_file(
-                os.path.join(log_path, 'simulation.hdf5'),
-                iteration,
-            )
-            self.options.save(
-                os.path.join(log_path, 'simulation_options.yaml')
-            )
-            self.task.animat_options.save(
-                os.path.join(log_path, 'animat_options.yaml')
-            )
+            jobs = [(
+                self.options.save,
+                os.path.join(log_path, 'simulation_options.yaml'),
+            )]
+            population = isinstance(self.task, PopulationTask)
+            for task in self.tasks:
+                if iteration > task.buffer_size and self.logger is None:
+                    pylog.warning(
+                        'Data buffer of size %s only holds the last'
+                        ' iterations of %s, use a streaming logger to save'
+                        ' all iterations',
+                        task.buffer_size, iteration,
+                    )
+                # Population animats are saved in their own subfolders
+                animat_path = (
+                    os.path.join(log_path, task.prefix.strip('_'))
+                    if population
+                    else log_path
+                )
+                job = (
+                    write_animat,
+                    animat_path,
+                    task.data,
+                    task.animat_options,
+                    iteration,
+                    (
+                        sensors_rates(task=task, iteration=iteration)
+                        if task.sensors_rates
+                        else None
+                    ),
+                )
+                if task.memmaps and iteration <= task.buffer_size:
+                    # Written without copy, already on disk
+                    write_animat(*job, memmaps=task.memmaps)
+                else:
+                    jobs.append(job)
+            if asynchronous:
+                os.makedirs(log_path, exist_ok=True)
+                writer = postprocess_writer(max_jobs=max_jobs)
+                # Copies of data and options, the simulation can continue
+                for function, *args in copy.deepcopy(jobs):
+                    writer.submit(function, *args)
+            else:
+                for function, *args in jobs:
+                    function(*args)
 
         # Plot
         if plot:
-            self.task.data.plot(times)
+            for task in self.tasks:
+                task.data.plot(times)
+
+    @staticmethod
+    def flush():
+        """Wait for asynchronous postprocessing to be written to disk"""
+        flush_postprocess()
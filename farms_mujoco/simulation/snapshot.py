@@ -0,0 +1,154 @@
+"""Simulation state snapshots"""
+
+import json
+from typing import Dict
+
+import numpy as np
+
+from dm_control.mjcf.physics import Physics
+
+from farms_core import pylog
+from farms_core.model.data import AnimatData
+
+from .physics import sensors_arrays
+
+
+# MuJoCo data fields describing the simulation state
+PHYSICS_STATE = (
+    'time', 'qpos', 'qvel', 'act', 'qacc_warmstart', 'ctrl',
+    'qfrc_applied', 'xfrc_applied', 'mocap_pos', 'mocap_quat', 'userdata',
+)
+# MuJoCo model fields modified during the simulation by the control
+PHYSICS_MODEL_STATE = ('qpos_spring',)
+# Suffix of flattened paths of values stored as JSON strings
+JSON_SUFFIX = '@json'
+
+
+def physics_state(physics: Physics) -> Dict[str, np.ndarray]:
+    """Copy of physics state"""
+    state = {
+        name: np.copy(getattr(physics.data, name))
+        for name in PHYSICS_STATE
+        if hasattr(physics.data, name)
+    }
+    state.update({
+        f'model_{name}': np.copy(getattr(physics.model, name))
+        for name in PHYSICS_MODEL_STATE
+    })
+    return state
+
+
+def set_physics_state(physics: Physics, state: Dict[str, np.ndarray]):
+    """Restore physics state and recompute derived quantities"""
+    for name, value in state.items():
+        if name.startswith('model_'):
+            getattr(physics.model, name[len('model_'):])[:] = value
+        elif name == 'time':
+            physics.data.time = value
+        else:
+            getattr(physics.data, name)[:] = value
+    physics.forward()
+
+
+def data_state(data: AnimatData) -> Dict[str, np.ndarray]:
+    """Copy of animat data buffers"""
+    return {
+        name: np.copy(array)
+        for name, array in sensors_arrays(data).items()
+    }
+
+
+def set_data_state(data: AnimatData, state: Dict[str, np.ndarray]):
+    """Restore animat data buffers"""
+    arrays = sensors_arrays(data)
+    for name, value in state.items():
+        arrays[name][:] = value
+
+
+def controller_state(controller) -> Dict:
+    """Controller state, if the controller implements get_state"""
+    if controller is None:
+        return None
+    if not hasattr(controller, 'get_state'):
+        pylog.debug(
+            'Controller %s does not implement get_state, its state is not'
+            ' part of the snapshot',
+            type(controller).__name__,
+        )
+        return None
+    return controller.get_state()
+
+
+def set_controller_state(controller, state: Dict):
+    """Restore controller state, if the controller implements set_state"""
+    if state is not None:
+        controller.set_state(state)
+
+
+def flatten(state: Dict, prefix: str = '') -> Dict[str, np.ndarray]:
+    """Flatten nested state into arrays keyed by paths
+
+    Values which can not be stored as numeric or string arrays, such as
+    None, are stored as JSON strings, so that archives can be loaded
+    without pickle.
+
+    """
+    arrays = {}
+    for key, value in state.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            arrays.update(flatten(value, prefix=f'{path}/'))
+        elif isinstance(value, (list, tuple)) and all(
+                isinstance(item, dict) or item is None for item in value
+        ):
+            arrays[f'{path}/#'] = np.array(len(value))
+            for index, item in enumerate(value):
+                if item is not None:
+                    arrays.update(flatten(item, prefix=f'{path}/{index}/'))
+        else:
+            array = np.asarray(value)
+            if array.dtype.hasobject:
+                arrays[f'{path}{JSON_SUFFIX}'] = np.array(json.dumps(
+                    value, default=lambda item: np.asarray(item).tolist(),
+                ))
+            else:
+                arrays[path] = array
+    return arrays
+
+
+def unflatten(arrays: Dict[str, np.ndarray]) -> Dict:
+    """Nested state from arrays keyed by paths"""
+    state = {}
+    for path, value in arrays.items():
+        node = state
+        *keys, name = path.split('/')
+        for key in keys:
+            node = node.setdefault(key, {})
+        if name.endswith(JSON_SUFFIX):
+            node[name[:-len(JSON_SUFFIX)]] = json.loads(str(value[()]))
+        else:
+            node[name] = value[()] if value.ndim == 0 else value
+    return unflatten_lists(state)
+
+
+def unflatten_lists(state):
+    """Convert nodes flattened from lists back into lists"""
+    if not isinstance(state, dict):
+        return state
+    if '#' in state:
+        return [
+            unflatten_lists(state.get(str(index)))
+            for index in range(int(state['#']))
+        ]
+    return {key: unflatten_lists(value) for key, value in state.items()}
+
+
+def save_snapshot(path: str, snapshot: Dict, compress: bool = False):
+    """Save snapshot to numpy archive"""
+    (np.savez_compressed if compress else np.savez)(path, **flatten(snapshot))
+
+
+def load_snapshot(path: str) -> Dict:
+    """Load snapshot from numpy archive"""
+    with np.load(path) as archive:
+        return unflatten({key: archive[key] for key in archive.files})
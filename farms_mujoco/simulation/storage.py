@@ -0,0 +1,85 @@
+"""Memory-mapped animat data storage"""
+
+import os
+from typing import Dict, Tuple
+
+import numpy as np
+
+from farms_core import pylog
+from farms_core.model.data import AnimatData
+
+
+def memmap_data(
+        data: AnimatData,
+        path: str,
+        buffer_size: int,
+) -> Tuple[AnimatData, Dict[str, np.memmap]]:
+    """Animat data with sensors arrays memory-mapped to files in path
+
+    Each sensors array is backed by a .npy file in path, with buffer_size
+    rows initialised with the first row of data, so that data can be
+    created with a single row and the full buffers are never allocated
+    in memory. The files can be opened by an external reader during the
+    simulation, e.g. with np.load(filename, mmap_mode='r'). Empty arrays
+    remain in memory. Returns the new animat data and the memmaps.
+
+    """
+    os.makedirs(path, exist_ok=True)
+    dictionary = data.to_dict()
+    memmaps = {}
+    for name, sensors in dictionary['sensors'].items():
+        if not isinstance(sensors, dict) or sensors.get('array') is None:
+            continue
+        array = np.asarray(sensors['array'])
+        shape = (buffer_size,) + array.shape[1:]
+        if not np.prod(shape):
+            continue
+        memmap = np.lib.format.open_memmap(
+            os.path.join(path, f'{name}.npy'),
+            mode='w+',
+            dtype=np.float64,
+            shape=shape,
+        )
+        memmap[:] = array[0]
+        sensors['array'] = memmap
+        memmaps[name] = memmap
+    pylog.info('Animat data memory-mapped to %s', path)
+    return AnimatData.from_dict(dictionary), memmaps
+
+
+def write_external(
+        path: str,
+        data: AnimatData,
+        memmaps: Dict[str, np.memmap],
+        iteration: int,
+):
+    """Write HDF5 data file referencing the memory-mapped arrays
+
+    The data dictionary up to iteration is written as by
+    AnimatData.to_file, except for the memory-mapped sensors arrays, which
+    are flushed and referenced as HDF5 external storage with their first
+    iteration rows instead of being written, so that the file can be
+    loaded with AnimatData.from_file. The external files are referenced
+    with absolute paths and must not be moved.
+
+    """
+    import h5py
+    from farms_core.io.hdf5 import dict_to_hdf5
+    dictionary = data.to_dict(iteration)
+    for name in memmaps:
+        dictionary['sensors'][name].pop('array')
+    dict_to_hdf5(filename=path, data=dictionary)
+    with h5py.File(path, 'a') as hfile:
+        for name, memmap in memmaps.items():
+            memmap.flush()
+            shape = (min(iteration, memmap.shape[0]),) + memmap.shape[1:]
+            hfile[f'sensors/{name}'].create_dataset(
+                'array',
+                shape=shape,
+                dtype=memmap.dtype,
+                external=[(
+                    os.path.abspath(memmap.filename),
+                    memmap.offset,
+                    int(np.prod(shape))*memmap.itemsize,
+                )],
+            )
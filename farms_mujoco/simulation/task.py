@@ -1,14 +1,13 @@
 """Task"""
 
-from typing import List, Dict
+import os
+from typing import List, Dict, TYPE_CHECKING
 
 import numpy as np
 
 from dm_control.rl.control import Task
-from dm_control.mujoco.wrapper import mjbindings
-from dm_control.viewer.application import Application
 from dm_control.mjcf.physics import Physics
-from dm_control.mujoco.wrapper import set_callback
+from dm_control.mujoco.wrapper import set_callback, mjbindings
 
 from farms_core import pylog
 from farms_core.model.options import AnimatOptions
@@ -22,10 +21,50 @@ except:
     rt_muscle = None
     pylog.warning("farms_muscle not installed!")
 
+if TYPE_CHECKING:
+    # Viewer application only imported when used, it loads the GUI backend
+    from dm_control.viewer.application import Application
+
+from .terrain import upload_hfield
+from .memory import memory_report
+from .control import CONTROL_KEYS, ControlArrays, array_controller
+from .process import ProcessController
+from .observation import OBSERVATION_FIELDS, ObservationPipeline
+from .watchdog import Watchdog
+from .adaptive import AdaptiveSubsteps
+from .storage import memmap_data
+from .tuning import set_substeps
+from .snapshot import (
+    data_state,
+    set_data_state,
+    controller_state,
+    set_controller_state,
+)
 from .physics import (
+    SENSORS_GROUPS,
     get_sensor_maps,
     get_physics2data_maps,
     physics2data,
+    hold_sensors,
+    clear_sensors,
+    merge_subscriptions,
+    subscribed_collectors,
+    subscribed_contacts,
+)
+
+
+# Callbacks hooks called during the episode, dispatched at each step
+CALLBACK_HOOKS = (
+    'before_step', 'after_step',
+    'action_spec', 'step_spec', 'observation_spec',
+    'get_observation', 'get_reward', 'get_termination',
+)
+
+
+# Joints types with a single qpos spring reference (slide and hinge)
+SPRINGREF_JOINTS = (
+    mjbindings.enums.mjtJoint.mjJNT_SLIDE,
+    mjbindings.enums.mjtJoint.mjJNT_HINGE,
 )
 
 
@@ -34,6 +73,13 @@ def duration2nit(duration: float, timestep: float) -> int:
     return int(duration/timestep)
 
 
+def callback_overrides(callback, hook: str) -> bool:
+    """Callback overrides the TaskCallback hook"""
+    if hook in getattr(callback, '__dict__', {}):  # Assigned to instance
+        return True
+    return getattr(type(callback), hook) is not getattr(TaskCallback, hook)
+
+
 class ExperimentTask(Task):
     """FARMS experiment"""
 
@@ -45,13 +91,20 @@ class ExperimentTask(Task):
             **kwargs,
     ):
         super().__init__()
-        self._app: Application = None
+        self._app: 'Application' = None
         self.iteration: int = 0
         self.timestep: float = timestep
         self.n_iterations: int = n_iterations
         self.base_link: str = base_link
+        self.prefix: str = kwargs.pop('prefix', '')
         self.data: AnimatData = kwargs.pop('data', None)
         self._controller: AnimatController = kwargs.pop('controller', None)
+        self._control = None
+        self._control_arrays: ControlArrays = None
+        # Run controller in separate process, with ProcessController kwargs
+        self._controller_process: Dict = kwargs.pop(
+            'controller_process', None,
+        )
         self.animat_options: AnimatOptions = kwargs.pop('animat_options', None)
         self.external_force: float = kwargs.pop('external_force', 0.2)
         self._restart: bool = kwargs.pop('restart', True)
@@ -60,7 +113,52 @@ class ExperimentTask(Task):
         self.units: SimulationUnits = kwargs.pop('units', SimulationUnits())
         self.substeps = max(1, kwargs.pop('substeps', 1))
         self.buffer_size = max(1, kwargs.pop('buffer_size', 1))
-        self.substeps_links = any(cb.substep for cb in self._callbacks)
+        self.show_memory = kwargs.pop('show_memory', True)
+        # Sensors arrays of initialised data memory-mapped to files in path
+        self.memmap_path: str = kwargs.pop('memmap_path', None)
+        self.memmaps: Dict[str, np.memmap] = {}
+        # Sensors groups sampled every given number of iterations, this
+        # only reduces the collection cost, the data buffers keep one row
+        # per iteration for all groups, see update_sensors, and the
+        # sampling times are saved with the data, see write_sensors_rates
+        self.sensors_rates: Dict[str, int] = kwargs.pop('sensors_rates', {})
+        for group, rate in self.sensors_rates.items():
+            assert group in SENSORS_GROUPS, f'Unknown sensors group {group}'
+            assert isinstance(rate, int) and rate >= 1, f'{group}: {rate=}'
+        # Sensors consumed by the logger, only subscribed sensors are
+        # collected if provided, see merge_subscriptions
+        self.sensors_subscriptions: Dict = kwargs.pop(
+            'sensors_subscriptions', None,
+        )
+        # Observation fields returned as views of the data, see
+        # ObservationPipeline
+        self.observation_fields: List[str] = kwargs.pop(
+            'observation_fields', None,
+        )
+        self._observations: ObservationPipeline = None
+        self._sensors_iteration: int = None
+        self._sensors_slot: int = None
+        # Divergence watchdog, with Watchdog kwargs
+        watchdog = kwargs.pop('watchdog', None)
+        self.watchdog: Watchdog = (
+            Watchdog(**watchdog)
+            if watchdog is not None
+            else None
+        )
+        # Adaptive substeps, with AdaptiveSubsteps kwargs, the substeps
+        # are then the maximum number of substeps by default, and the task
+        # is stepped once per iteration
+        adaptive_substeps = kwargs.pop('adaptive_substeps', None)
+        self.adaptive: AdaptiveSubsteps = None
+        if adaptive_substeps is not None:
+            self.adaptive = AdaptiveSubsteps(**{
+                'max_substeps': self.substeps,
+                **adaptive_substeps,
+            })
+            self.substeps = 1
+        self.substeps_links = False
+        self._dispatch: Dict[str, List[TaskCallback]] = {}
+        self.initialize_dispatch()
         self.sim_iteration = 0
         self.sim_iterations = self.n_iterations*self.substeps
         self.sim_timestep = self.timestep/self.substeps
@@ -68,7 +166,7 @@ class ExperimentTask(Task):
             'sensors': {}, 'ctrl': {},
             'xpos': {}, 'qpos': {}, 'geoms': {},
             'links': {}, 'joints': {}, 'contacts': {}, 'xfrc': {},
-            'muscles': {}
+            'muscles': {}, 'collectors': None,
         }
         assert not kwargs, kwargs
 
@@ -78,9 +176,12 @@ class ExperimentTask(Task):
         # mujoco reruns
         set_callback("mjcb_act_gain", None)
         set_callback("mjcb_act_bias", None)
+        if isinstance(self._control, ProcessController):
+            self._control.close()
 
-    def set_app(self, app: Application):
+    def set_app(self, app: 'Application'):
         """Set application"""
+        from dm_control.viewer.application import Application
         assert isinstance(app, Application)
         self._app = app
 
@@ -96,31 +197,30 @@ class ExperimentTask(Task):
         # Links masses
         links_row = physics.named.model.body_mass.axes.row
         self.data.sensors.links.masses = np.array([
-            physics.model.body_mass[links_row.convert_key_item(link_name)]
+            physics.model.body_mass[
+                links_row.convert_key_item(f'{self.prefix}{link_name}')
+            ]
             for link_name in self.data.sensors.links.names
         ], dtype=float)/self.units.kilograms
 
         # Initialise iterations
         self.iteration = 0
         self.sim_iteration = 0
-
-        # Initialise terrain
-        if self._extras['hfield'] is not None:
-            data = self._extras['hfield']['data']
-            hfield = self._extras['hfield']['asset']
-            nrow = physics.bind(hfield).nrow
-            ncol = physics.bind(hfield).ncol
-            idx0 = physics.bind(hfield).adr
-            size = nrow*ncol
-            physics.model.hfield_data[idx0:idx0+size] = 2*(data.flatten()-0.5)
-            if physics.contexts:
-                with physics.contexts.gl.make_current() as ctx:
-                    ctx.call(
-                        mjbindings.mjlib.mjr_uploadHField,
-                        physics.model.ptr,
-                        physics.contexts.mujoco.ptr,
-                        physics.bind(hfield).element_id,
-                    )
+        self._sensors_iteration = None
+        self._sensors_slot = None
+
+        # Initialise terrain, static heightfields are only loaded once
+        hfield = self._extras['hfield']
+        if hfield is not None and hfield.get('data') is not None:
+            if hfield.get('loaded') is not physics.model.ptr:
+                hfield_bind = physics.bind(hfield['asset'])
+                idx0 = hfield_bind.adr
+                size = hfield_bind.nrow*hfield_bind.ncol
+                physics.model.hfield_data[idx0:idx0+size] = (
+                    2*(hfield['data'].flatten()-0.5)
+                )
+                upload_hfield(physics=physics, hfield_id=hfield_bind.element_id)
+                hfield['loaded'] = physics.model.ptr
 
         # Maps, data and sensors
         self.initialize_maps(physics)
@@ -128,6 +228,7 @@ class ExperimentTask(Task):
             pylog.info('No data provided, initialising default')
             self.initialize_data()
         self.initialize_sensors(physics)
+        self._observations = None
 
         # Control
         if self._controller is not None:
@@ -136,6 +237,15 @@ class ExperimentTask(Task):
         # Initialize joints to keyframe 0
         physics.reset(keyframe_id=0)
 
+        # Tiled terrain window around animat
+        if hfield is not None and hfield.get('tiles') is not None:
+            hfield['tiles'].reset(
+                physics=physics,
+                hfield=hfield['asset'],
+                geom=hfield['geom'],
+                position=physics.named.data.xpos[self.base_link],
+            )
+
         if self._app is not None:
             cam = self._app._viewer.camera  # pylint: disable=protected-access
             links = self.data.sensors.links
@@ -145,17 +255,139 @@ class ExperimentTask(Task):
             )
 
         # Callbacks
+        self.initialize_dispatch()
         for callback in self._callbacks:
             callback.initialize_episode(task=self, physics=physics)
 
+        # Memory footprint, buffers are allocated at this point
+        if self.show_memory:
+            pylog.info(self.memory_report(physics))
+
         # Mujoco callbacks for muscle
         if rt_muscle:
             set_callback("mjcb_act_gain", rt_muscle.mjcb_muscle_gain)
             set_callback("mjcb_act_bias", rt_muscle.mjcb_muscle_bias)
 
+        # Watchdog initial state
+        if self.watchdog is not None:
+            self.watchdog.reset(task=self, physics=physics)
+
+        # Adaptive substeps
+        if self.adaptive is not None:
+            self.adaptive.reset(n_iterations=self.n_iterations)
+
+    def initialize_dispatch(self):
+        """Dispatch tables of callbacks overriding each hook
+
+        Callbacks are only called for the hooks they override, which
+        avoids calling the empty TaskCallback methods at every step. The
+        before_substep table contains the before_step callbacks that are
+        also called during substeps.
+
+        """
+        self._dispatch = {
+            hook: [
+                callback
+                for callback in self._callbacks
+                if callback_overrides(callback, hook)
+            ]
+            for hook in CALLBACK_HOOKS
+        }
+        self._dispatch['before_substep'] = [
+            callback
+            for callback in self._dispatch['before_step']
+            if callback.substep
+        ]
+        self.substeps_links = any(cb.substep for cb in self._callbacks)
+
+    def memory_report(self, physics: Physics) -> str:
+        """Memory footprint of physics, data and callbacks buffers"""
+        return memory_report(
+            physics=physics,
+            data=self.data,
+            callbacks=self._callbacks,
+        )
+
+    def get_state(self, data: bool = True) -> Dict:
+        """Task state, with controller state and optionally data buffers"""
+        state = {
+            'iteration': self.iteration,
+            'sim_iteration': self.sim_iteration,
+            'sensors_iteration': (
+                -1
+                if self._sensors_iteration is None
+                else self._sensors_iteration
+            ),
+            'controller': controller_state(self._controller),
+        }
+        if data:
+            state['data'] = data_state(self.data)
+        return state
+
+    def set_state(self, physics: Physics, state: Dict):
+        """Restore task state after the physics state"""
+        self.iteration = int(state['iteration'])
+        self.sim_iteration = int(state['sim_iteration'])
+        self._sensors_iteration = (
+            None
+            if state['sensors_iteration'] < 0
+            else int(state['sensors_iteration'])
+        )
+        self._sensors_slot = (
+            None
+            if self._sensors_iteration is None
+            else self.iteration % self.buffer_size
+        )
+        if 'data' in state:
+            set_data_state(self.data, state['data'])
+        set_controller_state(self._controller, state.get('controller'))
+        hfield = self._extras['hfield']
+        if hfield is not None and hfield.get('tiles') is not None:
+            hfield['tiles'].reset(
+                physics=physics,
+                hfield=hfield['asset'],
+                geom=hfield['geom'],
+                position=physics.named.data.xpos[self.base_link],
+            )
+
     def update_sensors(self, physics: Physics, links_only=False):
-        """Update sensors"""
+        """Update sensors
+
+        Sensors groups with a sampling rate are only collected every rate
+        iterations, their previous samples are held in between. The data
+        buffers are allocated by farms_core with one row per iteration for
+        all groups, so decimated groups use as much memory as others, the
+        actual sample times being given by sensors_times.
+
+        """
         index = self.iteration % self.buffer_size
+        if not links_only:
+            self._sensors_iteration = self.sim_iteration
+            self._sensors_slot = index
+        groups = None
+        if self.sensors_rates and not links_only:
+            groups = [
+                group
+                for group in SENSORS_GROUPS
+                if not self.iteration % self.sensors_rates.get(group, 1)
+            ]
+            if self.iteration and self.buffer_size > 1:
+                hold_sensors(
+                    data=self.data,
+                    groups=[
+                        group
+                        for group in SENSORS_GROUPS
+                        if group not in groups
+                    ],
+                    iteration=index,
+                    previous=(self.iteration-1) % self.buffer_size,
+                )
+        if not links_only:
+            clear_sensors(
+                data=self.data,
+                groups=SENSORS_GROUPS if groups is None else groups,
+                iteration=index,
+            )
         physics2data(
             physics=physics,
             iteration=index,
@@ -163,99 +395,243 @@ class ExperimentTask(Task):
             maps=self.maps,
             units=self.units,
             links_only=links_only,
+            groups=groups,
         )
 
+    def sensors_times(self, group: str, iteration: int) -> np.ndarray:
+        """Times at which the sensors group was sampled up to iteration"""
+        rate = self.sensors_rates.get(group, 1)
+        return np.arange(0, iteration, rate)*self.timestep
+
     def before_step(self, action, physics: Physics):
         """Operations before physics step"""
 
         # Checks
         assert self.iteration < self.n_iterations
 
+        # Substep
+        if self.sim_iteration % self.substeps:
+            self.before_substep(physics=physics, action=action)
+            return
+
         # Sensors
-        full_step = not self.sim_iteration % self.substeps
-        if full_step or self.substeps_links:
-            self.update_sensors(physics=physics, links_only=not full_step)
+        collected = self._sensors_iteration == self.sim_iteration  # Observed
+        if not collected:
+            self.update_sensors(physics=physics)
 
         # Callbacks
-        for callback in self._callbacks:
-            if full_step or callback.substep:
-                callback.before_step(task=self, action=action, physics=physics)
+        for callback in self._dispatch['before_step']:
+            callback.before_step(task=self, action=action, physics=physics)
 
         # Control
-        if full_step and self._controller is not None:
+        if self._controller is not None:
             self.step_control(physics)
 
+        # Adaptive substeps
+        if self.adaptive is not None:
+            self.adaptive.step(task=self, physics=physics)
+
+    def before_substep(self, physics: Physics, action=None):
+        """Operations before physics substep"""
+        if self.substeps_links:
+            self.update_sensors(physics=physics, links_only=True)
+        for callback in self._dispatch['before_substep']:
+            callback.before_step(task=self, action=action, physics=physics)
+
+    def animat_names(self, names: List[str]) -> List[str]:
+        """Names of elements belonging to animat, without prefix"""
+        if not self.prefix:
+            return names
+        return [
+            name[len(self.prefix):]
+            for name in names
+            if name.startswith(self.prefix)
+        ]
+
     def initialize_maps(self, physics: Physics):
         """Initialise data"""
         physics_named = physics.named.data
         # Links indices
-        self.maps['xpos']['names'] = physics_named.xpos.axes.row.names
+        self.maps['xpos']['names'] = self.animat_names(
+            physics_named.xpos.axes.row.names
+        )
         # Joints indices
-        self.maps['qpos']['names'] = physics_named.qpos.axes.row.names
+        self.maps['qpos']['names'] = self.animat_names(
+            physics_named.qpos.axes.row.names
+        )
         # External forces indices
-        self.maps['xfrc']['names'] = physics_named.xfrc_applied.axes.row.names
+        self.maps['xfrc']['names'] = self.animat_names(
+            physics_named.xfrc_applied.axes.row.names
+        )
         # Geoms indices
-        self.maps['geoms']['names'] = physics_named.geom_xpos.axes.row.names
+        self.maps['geoms']['names'] = self.animat_names(
+            physics_named.geom_xpos.axes.row.names
+        )
         # Muscles indices
         # Check if any muscles present in the model
         if len(physics.model.tendon_adr) > 0:
-            self.maps['muscles']['names'] = physics_named.ten_length.axes.row.names
+            self.maps['muscles']['names'] = self.animat_names(
+                physics_named.ten_length.axes.row.names
+            )
         else:
             self.maps['muscles']['names'] = []
 
     def initialize_data(self):
         """Initialise data"""
+        memmap = self.memmap_path is not None
         self.data = AnimatData.from_sensors_names(
             timestep=self.timestep,
-            buffer_size=self.buffer_size,
+            buffer_size=1 if memmap else self.buffer_size,
             links=self.maps['xpos']['names'],
             joints=self.maps['qpos']['names'],
             muscles=self.maps['muscles']['names']
             # contacts=[],
             # xfrc=[],
         )
+        if memmap:
+            self.data, self.memmaps = memmap_data(
+                data=self.data,
+                path=(
+                    os.path.join(self.memmap_path, self.prefix.strip('_'))
+                    if self.prefix
+                    else self.memmap_path
+                ),
+                buffer_size=self.buffer_size,
+            )
+
+    def subscriptions(self) -> Dict:
+        """Sensors subscriptions of logger, controller and callbacks
+
+        None if the logger does not subscribe, in which case all sensors
+        are collected. Otherwise, the controller and callbacks consuming
+        sensors declare them with a sensors_subscriptions attribute, and
+        the groups of the observation fields are collected.
+
+        """
+        if self.sensors_subscriptions is None:
+            return None
+        return merge_subscriptions(
+            self.sensors_subscriptions,
+            {
+                OBSERVATION_FIELDS[field][0]: True
+                for field in self.observation_fields or []
+            },
+            getattr(self._controller, 'sensors_subscriptions', None),
+            *[
+                getattr(callback, 'sensors_subscriptions', None)
+                for callback in self._callbacks
+            ],
+        )
 
     def initialize_sensors(self, physics: Physics):
         """Initialise sensors"""
+        subscriptions = self.subscriptions()
         self.maps['sensors'] = get_sensor_maps(physics)
         get_physics2data_maps(
             physics=physics,
             sensor_data=self.data.sensors,
             sensor_maps=self.maps['sensors'],
+            prefix=self.prefix,
+            contacts=(
+                subscribed_contacts(
+                    subscriptions=subscriptions,
+                    contacts_names=self.data.sensors.contacts.names,
+                )
+                if subscriptions is not None
+                else None
+            ),
+        )
+        self.maps['collectors'] = (
+            subscribed_collectors(subscriptions)
+            if subscriptions is not None
+            else None
         )
 
     def initialize_control(self, physics: Physics):
         """Initialise controller"""
+        prefix = self.prefix
         ctrl_names = np.array(physics.named.data.ctrl.axes.row.names)
         for joint in self._controller.joints_names[ControlType.POSITION]:
-            assert f'actuator_position_{joint}' in ctrl_names, (
+            assert f'actuator_position_{prefix}{joint}' in ctrl_names, (
                 f'{joint} not in {ctrl_names}'
             )
 
         # Joints maps
-        self.maps['ctrl']['pos'] = [
-            np.argwhere(ctrl_names == f'actuator_position_{joint}')[0, 0]
-            for joint in self._controller.joints_names[ControlType.POSITION]
-        ]
-        self.maps['ctrl']['vel'] = [
-            np.argwhere(ctrl_names == f'actuator_velocity_{joint}')[0, 0]
-            for joint in self._controller.joints_names[ControlType.VELOCITY]
-        ]
-        self.maps['ctrl']['trq'] = [
-            np.argwhere(ctrl_names == f'actuator_torque_{joint}')[0, 0]
-            for joint in self._controller.joints_names[ControlType.TORQUE]
-        ]
-        if self._controller.muscles_names:
-            self.maps['ctrl']['mus'] = [
-                np.argwhere(ctrl_names == f'{name}')[0, 0]
-                for name in self._controller.muscles_names
-            ]
-        # Filter only actuated joints
-        qpos_spring = physics.named.model.qpos_spring
+        joints_names = self._controller.joints_names
+        names = {
+            'pos': joints_names[ControlType.POSITION],
+            'vel': joints_names[ControlType.VELOCITY],
+            'trq': joints_names[ControlType.TORQUE],
+            'mus': self._controller.muscles_names or [],
+        }
+        actuators = {
+            'pos': f'actuator_position_{prefix}',
+            'vel': f'actuator_velocity_{prefix}',
+            'trq': f'actuator_torque_{prefix}',
+            'mus': prefix,
+        }
+        for key in CONTROL_KEYS:
+            self.maps['ctrl'][key] = np.array([
+                np.argwhere(ctrl_names == f'{actuators[key]}{name}')[0, 0]
+                for name in names[key]
+            ], dtype=int)
+        # Spring references qpos addresses of hinge and slide joints, the
+        # root freejoint is excluded
+        joints_qposadr = physics.named.model.jnt_qposadr
+        joints_types = physics.named.model.jnt_type
         self.maps['ctrl']['springref'] = {
-            joint: qpos_spring.axes.row.convert_key_item(joint)
-            for joint_i, joint in enumerate(qpos_spring.axes.row.names)
+            joint: int(joints_qposadr[f'{prefix}{joint}'])
+            for joint in self.animat_names(joints_qposadr.axes.row.names)
+            if joints_types[f'{prefix}{joint}'] in SPRINGREF_JOINTS
         }
+
+        # Control arrays, written by controller and copied with one
+        # indexed assignment into the physics at each step
+        if isinstance(self._control, ProcessController):
+            self._control.close()
+        self._control = array_controller(self._controller)
+        if self._controller_process is not None:
+            self._control = ProcessController(
+                control=self._control,
+                controller=self._controller,
+                data=self.data,
+                **self._controller_process,
+            )
+        springref_names = (
+            self._control.springref_names(list(self.maps['ctrl']['springref']))
+            if hasattr(self._control, 'springref_names')
+            else []
+        )
+        self.maps['ctrl']['springref_index'] = np.array([
+            self.maps['ctrl']['springref'][joint]
+            for joint in springref_names
+        ], dtype=int)
+        self._control_arrays = ControlArrays(
+            names=names,
+            springref_names=springref_names,
+            springrefs=physics.model.qpos_spring[
+                self.maps['ctrl']['springref_index']
+            ],
+        )
+        control_types = getattr(self._control, 'control_types', CONTROL_KEYS)
+        scales = {
+            'pos': 1,
+            'vel': self.units.angular_velocity,
+            'trq': self.units.torques,
+            'mus': 1,
+        }
+        slices = self._control_arrays.slices
+        self.maps['ctrl']['index'] = np.concatenate([
+            self.maps['ctrl'][key] for key in control_types
+        ]).astype(int)
+        self.maps['ctrl']['block'] = np.concatenate([
+            np.arange(slices[key].start, slices[key].stop)
+            for key in control_types
+        ]).astype(int)
+        self.maps['ctrl']['scale'] = np.concatenate([
+            np.full(len(names[key]), scales[key], dtype=float)
+            for key in control_types
+        ])
         act_trnid = physics.named.model.actuator_trnid
         act_trntype = physics.named.model.actuator_trntype
         jnt_names = physics.named.model.jnt_type.axes.row.names
@@ -274,7 +650,7 @@ class ExperimentTask(Task):
         if self.animat_options is not None:
             animat_options = self.animat_options
             for mtr_opts in animat_options.control.motors:
-                jnt_name = mtr_opts['joint_name']
+                jnt_name = f"{prefix}{mtr_opts['joint_name']}"
                 if 'position' not in mtr_opts.control_types:
                     for act_type in ('pos', 'vel'):
                         if act_type in jntname2actid[jnt_name]:
@@ -289,65 +665,36 @@ class ExperimentTask(Task):
         """Step control"""
         current_time = self.iteration*self.timestep
         index = self.iteration % self.buffer_size
-        self._controller.step(
-            iteration=index,
-            time=current_time,
-            timestep=self.timestep,
-        )
-        if self._controller.joints_names[ControlType.POSITION]:
-            self.step_joints_control_position(physics, current_time)
-        if self._controller.joints_names[ControlType.TORQUE]:
-            self.step_joints_control_torque(physics, current_time)
-        if self._controller.muscles_names:
-            muscles_excitations = self._controller.excitations(
+        if self._controller_process is None:
+            self._controller.step(
                 iteration=index,
                 time=current_time,
-                timestep=self.timestep
+                timestep=self.timestep,
             )
-            physics.data.ctrl[self.maps['ctrl']['mus']] = muscles_excitations
-
-    def step_joints_control_position(self, physics: Physics, time: float):
-        """Step position control"""
-        index = self.iteration % self.buffer_size
-        joints_positions = self._controller.positions(
+        arrays = self._control_arrays
+        self._control.write_controls(
             iteration=index,
-            time=time,
+            time=current_time,
             timestep=self.timestep,
+            arrays=arrays,
         )
-        physics.data.ctrl[self.maps['ctrl']['pos']] = [
-            joints_positions[joint]
-            for joint
-            in self._controller.joints_names[ControlType.POSITION]
-        ]
-
-    def step_joints_control_torque(self, physics: Physics, time: float):
-        """Step torque control"""
-        index = self.iteration % self.buffer_size
-        joints_torques = self._controller.torques(
-            iteration=index,
-            time=time,
-            timestep=self.timestep,
+        ctrl_maps = self.maps['ctrl']
+        physics.data.ctrl[ctrl_maps['index']] = (
+            arrays.ctrl[ctrl_maps['block']]*ctrl_maps['scale']
         )
-        torques = self.units.torques
-        physics.data.ctrl[self.maps['ctrl']['trq']] = [
-            joints_torques[joint]*torques
-            for joint
-            in self._controller.joints_names[ControlType.TORQUE]
-        ]
         # Spring reference
-        springrefs = self._controller.springrefs(
-            iteration=index,
-            time=time,
-            timestep=self.timestep,
-        )
-        qpos_spring = physics.model.qpos_spring
-        springref_map = self.maps['ctrl']['springref']
-        for joint, value in springrefs.items():
-            qpos_spring[springref_map[joint]] = value
+        if len(arrays.springrefs):
+            physics.model.qpos_spring[ctrl_maps['springref_index']] = (
+                arrays.springrefs
+            )
 
     def after_step(self, physics: Physics):
         """Operations after physics step"""
 
+        # Divergence, the recovery integrates this step again
+        if self.watchdog is not None and self.watchdog.check(self, physics):
+            return
+
         # Checks
         self.sim_iteration += 1
         fullstep = not (self.sim_iteration + 1) % self.substeps
@@ -363,15 +710,27 @@ class ExperimentTask(Task):
             else:
                 pylog.info('Simulation can be restarted')
 
+        # Terrain
+        hfield = self._extras['hfield']
+        if fullstep and hfield is not None and hfield.get('tiles') is not None:
+            hfield['tiles'].update(
+                physics=physics,
+                position=physics.named.data.xpos[self.base_link],
+            )
+
         # Callbacks
         if fullstep:
-            for callback in self._callbacks:
+            for callback in self._dispatch['after_step']:
                 callback.after_step(task=self, physics=physics)
 
+        # Watchdog state
+        if self.watchdog is not None:
+            self.watchdog.after_step(task=self, physics=physics)
+
     def action_spec(self, physics: Physics):
         """Action specifications"""
         specs = []
-        for callback in self._callbacks:
+        for callback in self._dispatch['action_spec']:
             spec = callback.action_spec(task=self, physics=physics)
             if spec is not None:
                 specs += spec
@@ -379,18 +738,50 @@ class ExperimentTask(Task):
 
     def step_spec(self, physics: Physics):
         """Timestep specifications"""
-        for callback in self._callbacks:
+        for callback in self._dispatch['step_spec']:
             callback.step_spec(task=self, physics=physics)
 
+    @property
+    def observations(self) -> ObservationPipeline:
+        """Observation pipeline, None without observation fields"""
+        if self._observations is None and self.observation_fields:
+            self._observations = ObservationPipeline(
+                data=self.data,
+                fields=self.observation_fields,
+                prefix=self.prefix,
+            )
+        return self._observations
+
     def get_observation(self, physics: Physics):
-        """Environment observation"""
-        for callback in self._callbacks:
+        """Environment observation
+
+        With observation fields, the sensors of the current iteration are
+        collected at full steps if they were not already, and the
+        observation contains read-only views of the current data buffer
+        slot. Between substeps, the slot of the last collected iteration
+        is returned, since collecting again would accumulate the contacts
+        and torques twice.
+
+        """
+        for callback in self._dispatch['get_observation']:
             callback.get_observation(task=self, physics=physics)
+        if self.observations is None:
+            return None
+        full_step = not self.sim_iteration % self.substeps
+        if self.iteration >= self.n_iterations:
+            index = (self.iteration - 1) % self.buffer_size
+        elif full_step or self._sensors_slot is None:
+            if self._sensors_iteration != self.sim_iteration:
+                self.update_sensors(physics=physics)
+            index = self.iteration % self.buffer_size
+        else:  # Substep, slot of the last collected iteration
+            index = self._sensors_slot
+        return self.observations.observation(index)
 
     def get_reward(self, physics: Physics):
         """Reward"""
         reward = 0
-        for callback in self._callbacks:
+        for callback in self._dispatch['get_reward']:
             callback_reward = callback.get_reward(task=self, physics=physics)
             if callback_reward is not None:
                 reward += callback_reward
@@ -399,7 +790,7 @@ class ExperimentTask(Task):
     def get_termination(self, physics: Physics):
         """Return final discount if episode should end, else None"""
         terminate = None
-        for callback in self._callbacks:
+        for callback in self._dispatch['get_termination']:
             if callback.get_termination(task=self, physics=physics):
                 terminate = 1
         if self.iteration >= self.n_iterations:
@@ -408,8 +799,186 @@ class ExperimentTask(Task):
 
     def observation_spec(self, physics: Physics):
         """Observation specifications"""
-        for callback in self._callbacks:
+        for callback in self._dispatch['observation_spec']:
             callback.observation_spec(task=self, physics=physics)
+        if self.observations is None:
+            return None
+        return self.observations.observation_spec()
+
+
+class PopulationTask(Task):
+    """Population of animats sharing the same physics
+
+    Each animat is handled by its own experiment task, with its own data
+    and controller, and all are advanced by a single physics step.
+
+    """
+
+    def __init__(self, tasks: List[ExperimentTask], **kwargs):
+        super().__init__()
+        assert tasks, 'Population requires at least one task'
+        self.tasks: List[ExperimentTask] = tasks
+        # Divergence watchdog of the shared physics, with Watchdog kwargs
+        watchdog = kwargs.pop('watchdog', None)
+        self.watchdog: Watchdog = (
+            Watchdog(**watchdog)
+            if watchdog is not None
+            else None
+        )
+        assert all(task.watchdog is None for task in tasks), (
+            'Population watchdog must be set on the population task'
+        )
+        # Adaptive substeps of the shared physics, see ExperimentTask
+        adaptive_substeps = kwargs.pop('adaptive_substeps', None)
+        self.adaptive: AdaptiveSubsteps = None
+        if adaptive_substeps is not None:
+            assert all(task.adaptive is None for task in tasks), (
+                'Population adaptive substeps must be set on the population'
+                ' task'
+            )
+            self.adaptive = AdaptiveSubsteps(**{
+                'max_substeps': self.substeps,
+                **adaptive_substeps,
+            })
+            for task in tasks:
+                set_substeps(task, 1)
+        assert not kwargs, kwargs
+
+    @property
+    def iteration(self) -> int:
+        """Iteration"""
+        return self.tasks[0].iteration
+
+    @property
+    def n_iterations(self) -> int:
+        """Number of iterations"""
+        return self.tasks[0].n_iterations
+
+    @property
+    def sim_iteration(self) -> int:
+        """Physics iteration"""
+        return self.tasks[0].sim_iteration
+
+    @property
+    def sim_iterations(self) -> int:
+        """Number of physics iterations"""
+        return self.tasks[0].sim_iterations
+
+    @property
+    def substeps(self) -> int:
+        """Number of substeps"""
+        return self.tasks[0].substeps
+
+    @property
+    def timestep(self) -> float:
+        """Timestep"""
+        return self.tasks[0].timestep
+
+    @property
+    def data(self) -> List[AnimatData]:
+        """Animats data"""
+        return [task.data for task in self.tasks]
+
+    @property
+    def animat_options(self) -> List[AnimatOptions]:
+        """Animats options"""
+        return [task.animat_options for task in self.tasks]
+
+    def set_app(self, app: 'Application'):
+        """Set application"""
+        for task in self.tasks:
+            task.set_app(app=app)
+
+    def initialize_episode(self, physics: Physics):
+        """Sets the state of the environment at the start of each episode"""
+        for task in self.tasks:
+            task.initialize_episode(physics=physics)
+        if self.watchdog is not None:
+            self.watchdog.reset(task=self, physics=physics)
+        if self.adaptive is not None:
+            self.adaptive.reset(n_iterations=self.n_iterations)
+
+    def get_state(self, data: bool = True) -> List[Dict]:
+        """Animats tasks states"""
+        return [task.get_state(data=data) for task in self.tasks]
+
+    def set_state(self, physics: Physics, state: List[Dict]):
+        """Restore animats tasks states"""
+        for task, task_state in zip(self.tasks, state):
+            task.set_state(physics=physics, state=task_state)
+
+    def before_step(self, action, physics: Physics):
+        """Operations before physics step"""
+        for task in self.tasks:
+            task.before_step(action=action, physics=physics)
+        if self.adaptive is not None:
+            self.adaptive.step(task=self, physics=physics)
+
+    def before_substep(self, physics: Physics, action=None):
+        """Operations before physics substep"""
+        for task in self.tasks:
+            task.before_substep(physics=physics, action=action)
+
+    def after_step(self, physics: Physics):
+        """Operations after physics step"""
+        if self.watchdog is not None and self.watchdog.check(self, physics):
+            return
+        for task in self.tasks:
+            task.after_step(physics=physics)
+        if self.watchdog is not None:
+            self.watchdog.after_step(task=self, physics=physics)
+
+    def action_spec(self, physics: Physics):
+        """Action specifications"""
+        return [
+            spec
+            for task in self.tasks
+            for spec in task.action_spec(physics=physics)
+        ]
+
+    def step_spec(self, physics: Physics):
+        """Timestep specifications"""
+        for task in self.tasks:
+            task.step_spec(physics=physics)
+
+    def get_observation(self, physics: Physics):
+        """Environment observation, merged from animats observations"""
+        observations = [
+            task.get_observation(physics=physics)
+            for task in self.tasks
+        ]
+        if all(observation is None for observation in observations):
+            return None
+        return {
+            name: view
+            for observation in observations
+            if observation is not None
+            for name, view in observation.items()
+        }
+
+    def get_reward(self, physics: Physics):
+        """Reward"""
+        return sum(task.get_reward(physics=physics) for task in self.tasks)
+
+    def get_termination(self, physics: Physics):
+        """Return final discount if episode should end, else None"""
+        terminations = [
+            task.get_termination(physics=physics)
+            for task in self.tasks
+        ]
+        return 1 if any(terminations) else None
+
+    def observation_spec(self, physics: Physics):
+        """Observation specifications, merged from animats specifications"""
+        specs = [task.observation_spec(physics=physics) for task in self.tasks]
+        if all(spec is None for spec in specs):
+            return None
+        return {
+            name: array_spec
+            for spec in specs
+            if spec is not None
+            for name, array_spec in spec.items()
+        }
 
 
 class TaskCallback:
@@ -0,0 +1,240 @@
+"""Terrain"""
+
+import os
+import hashlib
+import tempfile
+from typing import Tuple
+
+import numpy as np
+
+from dm_control.mujoco.wrapper import mjbindings
+from dm_control.mjcf.physics import Physics
+
+from farms_core.array.types import NDARRAY_3
+
+
+def read_heightmap(path: str) -> np.ndarray:
+    """Read heightmap image normalised in [0, 1] in cartesian coordinates"""
+    from imageio import imread
+    img = imread(path)  # Read PNG image
+    img = img[:, :, 0] if img.ndim == 3 else img[:, :]  # RGB vs Grey
+    vmin, vmax = (np.iinfo(img.dtype).min, np.iinfo(img.dtype).max)
+    img = (img - vmin)/(vmax-vmin)  # Normalize
+    return np.flip(img, axis=0)  # Cartesian coordinates
+
+
+def heightmap_source(
+        path: str,
+        overwrite: bool = False,
+        cache_dir: str = None,
+) -> np.ndarray:
+    """Memory-mapped normalised heightmap
+
+    Images are converted once to a .npy file in cache_dir, by default in
+    the temporary directory, which is then memory-mapped so that only the
+    accessed tiles are paged in. The cache file is named after the path,
+    modification time and size of the image, so that a modified image is
+    converted again.
+
+    """
+    if os.path.splitext(path)[1] != '.npy':
+        if cache_dir is None:
+            cache_dir = os.path.join(tempfile.gettempdir(), 'farms_heightmaps')
+        os.makedirs(cache_dir, exist_ok=True)
+        stat = os.stat(path)
+        key = hashlib.sha1(
+            f'{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}'
+            .encode()
+        ).hexdigest()
+        name = os.path.splitext(os.path.basename(path))[0]
+        cache = os.path.join(cache_dir, f'{name}_{key}.npy')
+        if overwrite or not os.path.isfile(cache):
+            # Written atomically for concurrent simulations
+            partial = f'{cache}.{os.getpid()}.tmp'
+            with open(partial, 'wb') as handle:
+                np.save(handle, read_heightmap(path).astype(np.float32))
+            os.replace(partial, cache)
+        path = cache
+    return np.load(path, mmap_mode='r')
+
+
+def upload_hfield(physics: Physics, hfield_id: int):
+    """Upload heightfield to existing rendering contexts"""
+    # Contexts are only checked, not created, rendering contexts created
+    # later will upload the model heightfield data themselves
+    # pylint: disable=protected-access
+    if physics._contexts is not None:
+        with physics.contexts.gl.make_current() as ctx:
+            ctx.call(
+                mjbindings.mjlib.mjr_uploadHField,
+                physics.model.ptr,
+                physics.contexts.mujoco.ptr,
+                hfield_id,
+            )
+
+
+def quat2mat(quat: np.ndarray) -> np.ndarray:
+    """MuJoCo quaternion to rotation matrix"""
+    w, x, y, z = quat/np.linalg.norm(quat)
+    return np.array([
+        [1-2*(y*y+z*z), 2*(x*y-z*w), 2*(x*z+y*w)],
+        [2*(x*y+z*w), 1-2*(x*x+z*z), 2*(y*z-x*w)],
+        [2*(x*z-y*w), 2*(y*z+x*w), 1-2*(x*x+y*y)],
+    ])
+
+
+class TiledHeightfield:
+    """Heightfield window streamed from a large memory-mapped terrain
+
+    Only a window of the full terrain is resident in the model hfield
+    data. The window follows a given position by whole tiles, moving the
+    heightfield geom and copying only the newly uncovered rows and
+    columns from the memory-mapped source.
+
+    """
+
+    def __init__(
+            self,
+            source: np.ndarray,
+            size: Tuple[float, float],
+            window: Tuple[int, int],
+            tile: int = None,
+    ):
+        super().__init__()
+        self.source = source
+        self.window = (
+            min(window[0], source.shape[0]),
+            min(window[1], source.shape[1]),
+        )
+        self.tile = max(1, tile if tile is not None else min(self.window)//4)
+        self.cell = (  # Cell size along x (columns) and y (rows)
+            2*size[0]/(source.shape[1]-1),
+            2*size[1]/(source.shape[0]-1),
+        )
+        self.size = size
+        self.start: Tuple[int, int] = None
+        self.resident: np.ndarray = None
+        self._ids = None
+        self._frame = None
+        self._model = None
+
+    @property
+    def window_size(self) -> Tuple[float, float]:
+        """Window half extents"""
+        return (
+            0.5*self.cell[0]*(self.window[1]-1),
+            0.5*self.cell[1]*(self.window[0]-1),
+        )
+
+    def bind(self, physics: Physics, hfield, geom):
+        """Bind to compiled physics"""
+        hfield_bind = physics.bind(hfield)
+        geom_id = physics.bind(geom).element_id
+        body_id = physics.model.geom_bodyid[geom_id]
+        adr = hfield_bind.adr
+        self._model = physics.model.ptr
+        self.start = None
+        self._ids = {'hfield': hfield_bind.element_id, 'geom': geom_id}
+        self.resident = physics.model.hfield_data[
+            adr:adr+self.window[0]*self.window[1]
+        ].reshape(self.window)
+        # Terrain frame, requires forward kinematics of the static body
+        geom_pos = physics.model.geom_pos[geom_id].copy()
+        geom_rot = quat2mat(physics.model.geom_quat[geom_id])
+        body_rot = physics.data.xmat[body_id].reshape([3, 3])
+        self._frame = {
+            'geom_pos': geom_pos,
+            'geom_rot': geom_rot,
+            'origin': physics.data.xpos[body_id] + body_rot @ geom_pos,
+            'rotation': body_rot @ geom_rot,
+        }
+
+    def cell_index(self, position: NDARRAY_3) -> Tuple[float, float]:
+        """Terrain cell (row, column) of world position"""
+        local = self._frame['rotation'].T @ (position - self._frame['origin'])
+        return (
+            (local[1] + self.size[1])/self.cell[1],
+            (local[0] + self.size[0])/self.cell[0],
+        )
+
+    def window_start(self, cell: Tuple[float, float]) -> Tuple[int, int]:
+        """Window start centred on cell, snapped to tiles"""
+        return tuple(
+            int(np.clip(
+                round((index - 0.5*(window-1))/self.tile)*self.tile,
+                0, full - window,
+            ))
+            for index, window, full in zip(cell, self.window, self.source.shape)
+        )
+
+    def reset(self, physics: Physics, hfield, geom, position: NDARRAY_3):
+        """Load window around position"""
+        if self._model is not physics.model.ptr:
+            self.bind(physics=physics, hfield=hfield, geom=geom)
+        start = self.window_start(self.cell_index(position))
+        if start != self.start:
+            self.load(physics=physics, start=start, full=self.start is None)
+
+    def update(self, physics: Physics, position: NDARRAY_3) -> bool:
+        """Move window by whole tiles if position drifted from its centre"""
+        row, col = self.cell_index(position)
+        if (
+                abs(row - self.start[0] - 0.5*(self.window[0]-1)) < self.tile
+                and abs(col - self.start[1] - 0.5*(self.window[1]-1)) < self.tile
+        ):
+            return False
+        start = self.window_start((row, col))
+        if start == self.start:
+            return False
+        self.load(physics=physics, start=start)
+        return True
+
+    def copy_source(self, rows: slice, cols: slice):
+        """Copy source region into resident window"""
+        self.resident[rows, cols] = 2*(self.source[
+            self.start[0]+rows.start:self.start[0]+rows.stop,
+            self.start[1]+cols.start:self.start[1]+cols.stop,
+        ] - 0.5)
+
+    def load(self, physics: Physics, start: Tuple[int, int], full=False):
+        """Move window to start, copying only uncovered regions"""
+        nrow, ncol = self.window
+        shift = (
+            (start[0]-self.start[0], start[1]-self.start[1])
+            if not full
+            else (nrow, ncol)
+        )
+        self.start = start
+        if abs(shift[0]) >= nrow or abs(shift[1]) >= ncol:
+            self.copy_source(slice(0, nrow), slice(0, ncol))
+        else:
+            # Move overlapping region in place
+            d_row, d_col = shift
+            self.resident[
+                max(0, -d_row):nrow-max(0, d_row),
+                max(0, -d_col):ncol-max(0, d_col),
+            ] = self.resident[
+                max(0, d_row):nrow-max(0, -d_row),
+                max(0, d_col):ncol-max(0, -d_col),
+            ]
+            # Newly uncovered rows and columns
+            if d_row:
+                self.copy_source(
+                    slice(nrow-d_row, nrow) if d_row > 0 else slice(0, -d_row),
+                    slice(0, ncol),
+                )
+            if d_col:
+                self.copy_source(
+                    slice(0, nrow),
+                    slice(ncol-d_col, ncol) if d_col > 0 else slice(0, -d_col),
+                )
+        # Window centre in terrain frame
+        centre = np.array([
+            -self.size[0] + (start[1] + 0.5*(ncol-1))*self.cell[0],
+            -self.size[1] + (start[0] + 0.5*(nrow-1))*self.cell[1],
+            0,
+        ])
+        physics.model.geom_pos[self._ids['geom']] = (
+            self._frame['geom_pos'] + self._frame['geom_rot'] @ centre
+        )
+        upload_hfield(physics=physics, hfield_id=self._ids['hfield'])
@@ -0,0 +1,270 @@
+"""Solver and integrator tuning"""
+
+import time
+import itertools
+from typing import Dict, List
+
+import numpy as np
+
+from dm_control.rl.control import PhysicsError
+from dm_control.mjcf.physics import Physics
+
+from farms_core import pylog
+
+from .patch import physics_set_options
+
+
+# Physics options which can be tuned, with the names used in setup_mjcf_xml
+TUNING_OPTIONS = (
+    'solver', 'solver_iterations', 'integrator', 'cone', 'impratio',
+    'mpr_iterations', 'mpr_tolerance', 'noslip_iterations', 'noslip_tolerance',
+)
+# High accuracy reference, substeps are relative to the simulation substeps
+REFERENCE_CONFIGURATION = {
+    'solver': 'Newton',
+    'solver_iterations': 1000,
+    'integrator': 'RK4',
+    'substeps_factor': 10,
+}
+
+
+def tuning_grid(**kwargs) -> List[Dict]:
+    """Configurations from all combinations of the given values
+
+    Keyword arguments are lists of values for the TUNING_OPTIONS and for
+    substeps, the number of physics steps per control step.
+
+    """
+    for key in kwargs:
+        assert key in TUNING_OPTIONS + ('substeps',), f'Cannot tune {key}'
+    keys = list(kwargs.keys())
+    return [
+        dict(zip(keys, values))
+        for values in itertools.product(*[kwargs[key] for key in keys])
+    ]
+
+
+def physics_get_options(physics: Physics, keys: List[str]) -> Dict:
+    """Current physics options, as could be set with physics_set_options"""
+    opt = physics.model.opt
+    options = {}
+    for key in keys:
+        name = 'iterations' if key == 'solver_iterations' else key
+        value = getattr(opt, name)
+        options[key] = np.copy(value) if key == 'gravity' else value
+    return options
+
+
+def solver_iterations(physics: Physics) -> int:
+    """Number of solver iterations used at the last step"""
+    data = physics.data
+    if hasattr(data, 'solver_niter'):
+        return int(np.sum(data.solver_niter))
+    return int(data.solver_iter)
+
+
+def contacts_penetration(physics: Physics) -> float:
+    """Maximum contact penetration depth"""
+    ncon = physics.data.ncon
+    if not ncon:
+        return 0.0
+    return max(0.0, -float(np.min(physics.data.contact.dist[:ncon])))
+
+
+def set_substeps(task, substeps: int):
+    """Set number of physics substeps per control step of task"""
+    task.substeps = max(1, substeps)
+    task.sim_iterations = task.n_iterations*task.substeps
+    task.sim_timestep = task.timestep/task.substeps
+
+
+def rollout(
+        simulation,
+        configuration: Dict,
+        n_iterations: int,
+        base_options: Dict = None,
+) -> Dict:
+    """Run simulation with configuration and collect metrics
+
+    The base options, if provided, and then the configuration options are
+    written into the compiled physics, so that options of previous
+    configurations do not remain, and the task is stepped as the
+    environment would, with the control timestep kept constant so that
+    trajectories can be compared.
+
+    """
+    physics = simulation.physics
+    tasks = simulation.tasks
+    if base_options is not None:
+        physics_set_options(physics, **base_options)
+    substeps = configuration.get('substeps', tasks[0].substeps)
+    for task in tasks:
+        set_substeps(task, substeps)
+    physics_set_options(
+        physics,
+        timestep=tasks[0].sim_timestep,
+        **{
+            key: value
+            for key, value in configuration.items()
+            if key in TUNING_OPTIONS
+        },
+    )
+    with physics.reset_context():
+        simulation.task.initialize_episode(physics)
+    qpos = np.zeros([n_iterations+1, physics.model.nq])
+    qpos[0] = physics.data.qpos
+    iterations = np.zeros(n_iterations*substeps, dtype=int)
+    penetration = np.zeros(n_iterations*substeps)
+    error = None
+    step = 0
+    tic = time.perf_counter()
+    try:
+        for iteration in range(n_iterations):
+            for _ in range(substeps):
+                simulation.task.before_step(action=None, physics=physics)
+                physics.step()
+                simulation.task.after_step(physics=physics)
+                iterations[step] = solver_iterations(physics)
+                penetration[step] = contacts_penetration(physics)
+                step += 1
+            qpos[iteration+1] = physics.data.qpos
+    except PhysicsError as err:
+        error = str(err)
+    toc = time.perf_counter()
+    wall_time = max(toc - tic, 1e-12)
+    duration = step*tasks[0].sim_timestep
+    iterations, penetration = iterations[:step], penetration[:step]
+    return {
+        'configuration': configuration,
+        'timestep': tasks[0].sim_timestep,
+        'steps': step,
+        'wall_time': wall_time,
+        'steps_per_second': step/wall_time,
+        'real_time_factor': duration/wall_time,
+        'solver_iterations_mean': float(np.mean(iterations)) if step else 0.0,
+        'solver_iterations_max': int(np.max(iterations)) if step else 0,
+        'penetration_max': float(np.max(penetration)) if step else 0.0,
+        'penetration_mean': float(np.mean(penetration)) if step else 0.0,
+        'error': error,
+        'qpos': qpos,
+    }
+
+
+def trajectory_divergence(qpos: np.ndarray, reference: np.ndarray) -> float:
+    """Root mean square difference between trajectories"""
+    return float(np.sqrt(np.mean((qpos - reference)**2)))
+
+
+def tune_simulation(
+        simulation,
+        configurations: List[Dict],
+        **kwargs,
+) -> List[Dict]:
+    """Run simulation for each configuration and compare to reference
+
+    The simulation data is overwritten during tuning, but the physics
+    options and the tasks substeps are restored afterwards. Each result
+    contains the measured speed, the solver iterations, the contacts
+    penetration and the trajectory divergence from the reference.
+
+    """
+    n_iterations = kwargs.pop('n_iterations', simulation.task.n_iterations)
+    reference = kwargs.pop('reference', REFERENCE_CONFIGURATION)
+    verbose = kwargs.pop('verbose', True)
+    assert not kwargs, kwargs
+    assert n_iterations <= simulation.task.n_iterations, (
+        f'{n_iterations=} > {simulation.task.n_iterations=}'
+    )
+    tasks = simulation.tasks
+    initial_substeps = tasks[0].substeps
+    show_memory = [task.show_memory for task in tasks]
+    for task in tasks:
+        task.show_memory = False
+    initial_options = physics_get_options(
+        physics=simulation.physics,
+        keys=('timestep',) + TUNING_OPTIONS,
+    )
+
+    try:
+        # Reference
+        reference = dict(reference)
+        factor = reference.pop('substeps_factor', None)
+        if factor is not None:
+            reference['substeps'] = factor*initial_substeps
+        if verbose:
+            pylog.info('Running tuning reference: %s', reference)
+        reference_result = rollout(
+            simulation=simulation,
+            configuration=reference,
+            n_iterations=n_iterations,
+            base_options=initial_options,
+        )
+        assert reference_result['error'] is None, (
+            f'Reference failed: {reference_result["error"]}'
+        )
+
+        # Configurations
+        results = []
+        for configuration in configurations:
+            if verbose:
+                pylog.info('Running tuning configuration: %s', configuration)
+            result = rollout(
+                simulation=simulation,
+                configuration=configuration,
+                n_iterations=n_iterations,
+                base_options=initial_options,
+            )
+            result['divergence'] = (
+                trajectory_divergence(
+                    qpos=result['qpos'],
+                    reference=reference_result['qpos'],
+                )
+                if result['error'] is None
+                else np.inf
+            )
+            del result['qpos']
+            results.append(result)
+    finally:
+        for task, show in zip(tasks, show_memory):
+            set_substeps(task, initial_substeps)
+            task.show_memory = show
+        physics_set_options(simulation.physics, **initial_options)
+
+    if verbose:
+        pylog.info(tuning_report(results))
+    return results
+
+
+def recommend(results: List[Dict], tolerance: float, **kwargs) -> Dict:
+    """Fastest configuration within accuracy tolerance, None if none is"""
+    penetration_tolerance = kwargs.pop('penetration_tolerance', np.inf)
+    assert not kwargs, kwargs
+    valid = [
+        result
+        for result in results
+        if result['error'] is None
+        and result['divergence'] <= tolerance
+        and result['penetration_max'] <= penetration_tolerance
+    ]
+    if not valid:
+        pylog.warning('No configuration within tolerance %s', tolerance)
+        return None
+    return max(valid, key=lambda result: result['real_time_factor'])
+
+
+def tuning_report(results: List[Dict]) -> str:
+    """Tuning results as table"""
+    lines = [
+        f'{"Configuration":<60} {"RTF":>9} {"Iters":>7}'
+        f' {"Penetration":>12} {"Divergence":>11}'
+    ]
+    for result in results:
+        lines.append(
+            f'{str(result["configuration"]):<60}'
+            f' {result["real_time_factor"]:>9.3f}'
+            f' {result["solver_iterations_mean"]:>7.1f}'
+            f' {result["penetration_max"]:>12.3e}'
+            f' {result.get("divergence", np.nan):>11.3e}'
+            + (' (failed)' if result['error'] is not None else '')
+        )
+    return '\n'.join(lines)
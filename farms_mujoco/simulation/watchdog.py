@@ -0,0 +1,171 @@
+"""Divergence watchdog with rollback and timestep refinement"""
+
+from collections import deque
+from typing import Dict
+
+import numpy as np
+
+from dm_control.rl.control import PhysicsError
+from dm_control.mujoco.wrapper import mjbindings
+from dm_control.mjcf.physics import Physics
+
+from farms_core import pylog
+
+from .snapshot import physics_state, set_physics_state
+from .tuning import contacts_penetration
+from .memory import check_buffers
+
+
+class DivergenceError(PhysicsError):
+    """Divergence detected by the watchdog"""
+
+
+def kinetic_energy(physics: Physics, buffer: np.ndarray) -> float:
+    """Kinetic energy from the joint space inertia"""
+    mjbindings.mjlib.mj_mulM(
+        physics.model.ptr,
+        physics.data.ptr,
+        buffer,
+        physics.data.qvel,
+    )
+    return 0.5*float(np.dot(physics.data.qvel, buffer))
+
+
+class Watchdog:
+    """Detect divergence after each step and roll back with finer steps
+
+    The state is checked after each physics step for non-finite values,
+    kinetic energy spikes and excessive contacts penetration. States are
+    saved in memory every interval iterations. On divergence, the task is
+    rolled back to the oldest saved state and the window up to the failed
+    step is integrated again with the physics timestep divided by
+    refinement, which is doubled at each failure up to max_refinement,
+    after which the divergence is raised. The control and sensors still
+    run at their usual rate during refinement, the sensors rows of the
+    window being cleared and collected again, and the callbacks of the
+    window are called again.
+
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.interval: int = kwargs.pop('interval', 10)
+        self.energy_ratio: float = kwargs.pop('energy_ratio', 100)
+        self.energy_floor: float = kwargs.pop('energy_floor', 1.0)
+        self.penetration_max: float = kwargs.pop('penetration_max', np.inf)
+        self.refinement: int = kwargs.pop('refinement', 4)
+        self.max_refinement: int = kwargs.pop('max_refinement', 64)
+        n_snapshots = kwargs.pop('n_snapshots', 2)
+        assert not kwargs, kwargs
+        self.snapshots = deque(maxlen=n_snapshots)
+        self.recovering: bool = False
+        self.n_recoveries: int = 0
+        self._energy: float = None
+        self._buffer: np.ndarray = None
+
+    def reset(self, task, physics: Physics):
+        """Reset at episode start and save initial state"""
+        self.snapshots.clear()
+        self.recovering = False
+        self._energy = None
+        self._buffer = None
+        self.save(task=task, physics=physics)
+
+    def diverged(self, physics: Physics) -> str:
+        """Reason of divergence, None if state is valid"""
+        data = physics.data
+        finite = np.isfinite(data.qpos).all() and np.isfinite(data.qvel).all()
+        if not finite:
+            return 'non-finite state'
+        if self._buffer is None:
+            self._buffer = np.zeros(physics.model.nv)
+        energy = kinetic_energy(physics, self._buffer)
+        previous, self._energy = self._energy, energy
+        if previous is not None and energy > self.energy_ratio*max(
+                previous, self.energy_floor,
+        ):
+            return f'kinetic energy spike from {previous:.3e} to {energy:.3e}'
+        penetration = contacts_penetration(physics)
+        if penetration > self.penetration_max:
+            return f'contacts penetration of {penetration:.3e}'
+        return None
+
+    def save(self, task, physics: Physics):
+        """Save state in memory"""
+        self.snapshots.append({
+            'physics': physics_state(physics),
+            'task': task.get_state(data=False),
+            'energy': self._energy,
+        })
+
+    def check(self, task, physics: Physics) -> bool:
+        """Check physics step, returns True if the step was recovered
+
+        Called at the start of the task after_step, if the step diverged
+        it is integrated again by the recovery, including the task
+        after_step, which must then be skipped.
+
+        """
+        reason = self.diverged(physics)
+        if reason is None:
+            return False
+        if self.recovering:
+            raise DivergenceError(reason)
+        pylog.warning(
+            'Divergence at iteration %s (%s), rolling back',
+            task.iteration, reason,
+        )
+        self.recover(task=task, physics=physics)
+        return True
+
+    def after_step(self, task, physics: Physics):
+        """Save state every interval iterations, at the end of after_step"""
+        if self.recovering or task.iteration % self.interval:
+            return
+        if not task.sim_iteration % task.substeps:  # Next step is full
+            self.save(task=task, physics=physics)
+
+    def recover(self, task, physics: Physics):
+        """Roll back and integrate again up to the current step included"""
+        if not self.snapshots:
+            raise DivergenceError('No state to roll back to')
+        target = task.sim_iteration + 1
+        timestep = physics.model.opt.timestep
+        refinement = self.refinement
+        self.recovering = True
+        try:
+            while True:
+                snapshot = self.snapshots[0]
+                set_physics_state(physics, snapshot['physics'])
+                task.set_state(physics=physics, state=snapshot['task'])
+                self._energy = snapshot['energy']
+                physics.model.opt.timestep = (
+                    task.timestep/task.substeps/refinement
+                )
+                try:
+                    while task.sim_iteration < target:
+                        task.before_step(action=None, physics=physics)
+                        physics.step(refinement)
+                        task.after_step(physics=physics)
+                    break
+                except PhysicsError as err:
+                    check_buffers(physics)
+                    if 2*refinement > self.max_refinement:
+                        raise err
+                    refinement *= 2
+                    pylog.warning(
+                        'Divergence during recovery (%s), refining to %s',
+                        err, refinement,
+                    )
+        finally:
+            physics.model.opt.timestep = timestep
+            self.recovering = False
+        self.n_recoveries += 1
+        pylog.info(
+            'Recovered at iteration %s with refinement %s',
+            task.iteration, refinement,
+        )
+
+    def statistics(self) -> Dict:
+        """Watchdog statistics"""
+        return {'recoveries': self.n_recoveries}
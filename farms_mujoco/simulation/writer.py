@@ -0,0 +1,172 @@
+"""Background and incremental data writers"""
+
+import queue
+import threading
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+
+from farms_core import pylog
+
+
+# Compression filters, lz4 and zstd require hdf5plugin
+COMPRESSIONS = ('gzip', 'lzf', 'lz4', 'zstd')
+
+
+def compression_kwargs(compression: str = None, level: int = None) -> Dict:
+    """HDF5 dataset creation kwargs of compression filter
+
+    The byte shuffle filter is applied before compression, which improves
+    the compression of floating point data.
+
+    """
+    if compression is None:
+        return {}
+    assert compression in COMPRESSIONS, (
+        f'Unknown compression {compression} (available: {COMPRESSIONS})'
+    )
+    if compression in ('gzip', 'lzf'):
+        kwargs = {'compression': compression, 'shuffle': True}
+        if compression == 'gzip' and level is not None:
+            kwargs['compression_opts'] = level
+        return kwargs
+    try:
+        import hdf5plugin
+    except ImportError as err:
+        raise ImportError(
+            f'{compression} compression requires hdf5plugin'
+        ) from err
+    if compression == 'lz4':
+        return {**hdf5plugin.LZ4(), 'shuffle': True}
+    return {
+        **hdf5plugin.Zstd(**({} if level is None else {'clevel': level})),
+        'shuffle': True,
+    }
+
+
+class BackgroundWriter:
+    """Run write jobs sequentially in a background thread
+
+    Jobs are executed in submission order, so that a job can rely on the
+    previous ones being complete. An exception raised by a job is raised
+    again in the submitting thread at the next submit, flush or close.
+    With max_jobs, submit blocks while max_jobs jobs are queued. A daemon
+    writer does not prevent the interpreter from exiting, it must be
+    closed explicitly, for example at exit.
+
+    """
+
+    def __init__(self, max_jobs: int = 0, daemon: bool = False):
+        super().__init__()
+        self._jobs = queue.Queue(maxsize=max_jobs)
+        self._error: BaseException = None
+        self._thread = threading.Thread(target=self._run, daemon=daemon)
+        self._thread.start()
+
+    def _run(self):
+        """Jobs loop"""
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    function, args, kwargs = job
+                    function(*args, **kwargs)
+            except BaseException as err:  # pylint: disable=broad-except
+                pylog.error('Background write failed: %s', err)
+                self._error = err
+            finally:
+                self._jobs.task_done()
+
+    def check(self):
+        """Raise exception from failed job"""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Background write failed') from error
+
+    def submit(self, function: Callable, *args, **kwargs):
+        """Submit write job, the arguments must not be modified afterwards"""
+        self.check()
+        assert self._thread.is_alive(), 'Writer is closed'
+        self._jobs.put((function, args, kwargs))
+
+    def flush(self):
+        """Wait for submitted jobs"""
+        self._jobs.join()
+        self.check()
+
+    def close(self):
+        """Complete submitted jobs and stop thread"""
+        if self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+        self.check()
+
+
+class HDF5Appender:
+    """Append rows to resizable HDF5 datasets
+
+    Each dataset grows along its first axis, and the number of complete
+    rows is stored in the rows attribute of the file once all datasets
+    are written and flushed, which marks the file as consistent. Datasets
+    are stored with dtype, values being converted when written, and
+    compressed by chunks of chunk_rows rows, see compression_kwargs.
+
+    """
+
+    def __init__(self, path: str, shapes: Dict[str, Tuple], **kwargs):
+        super().__init__()
+        import h5py
+        self.path = path
+        self.chunk_rows = kwargs.pop('chunk_rows', 64)
+        dtype = kwargs.pop('dtype', np.float64)
+        mode = kwargs.pop('mode', 'a')
+        compression = compression_kwargs(
+            compression=kwargs.pop('compression', None),
+            level=kwargs.pop('compression_level', None),
+        )
+        assert not kwargs, kwargs
+        self.file = h5py.File(path, mode)
+        self.datasets = {}
+        for name, shape in shapes.items():
+            if name in self.file:
+                self.datasets[name] = self.file[name]
+                continue
+            self.datasets[name] = self.file.create_dataset(
+                name,
+                shape=(0,) + tuple(shape),
+                maxshape=(None,) + tuple(shape),
+                chunks=(self.chunk_rows,) + tuple(max(1, n) for n in shape),
+                dtype=dtype,
+                **compression,
+            )
+        if 'rows' not in self.file.attrs:
+            self.file.attrs['rows'] = 0
+
+    @property
+    def rows(self) -> int:
+        """Number of consistent rows"""
+        return int(self.file.attrs['rows'])
+
+    def append(self, rows: Dict[str, np.ndarray], start: int):
+        """Write rows from row index start"""
+        stop = None
+        for name, values in rows.items():
+            dataset = self.datasets[name]
+            stop = start + len(values)
+            dataset.resize(stop, axis=0)  # Also discards inconsistent rows
+            dataset[start:stop] = values
+        if stop is not None:
+            self.file.flush()
+            self.file.attrs['rows'] = stop
+            self.file.flush()
+
+    def read(self, name: str, start: int, stop: int) -> np.ndarray:
+        """Read rows of dataset"""
+        return self.datasets[name][start:stop]
+
+    def close(self):
+        """Close file"""
+        if self.file:
+            self.file.close()